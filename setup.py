@@ -40,6 +40,12 @@ core_dependencies = [
 
 install_requires = core_dependencies + ['wheel']
 
+compression_requires = ['zstandard']
+
+sidecar_requires = ['brotli']
+
+speedups_requires = ['orjson']
+
 setup_requires = ['setuptools_scm']
 
 doc_requires = setup_requires + ['sphinx', 'sphinx-argparse', 'alabaster']
@@ -85,6 +91,9 @@ setup(
     install_requires=install_requires,
     setup_requires=setup_requires,
     extras_require={
+        'compression': compression_requires,
+        'sidecars': sidecar_requires,
+        'speedups': speedups_requires,
         'docs': doc_requires,
         'tests': test_requires,
         'build': build_requires,
@@ -1,14 +1,21 @@
 
 
+import json
+import errno
+import asyncio
+import mimetypes
 from typing import List
+from urllib.parse import urlencode
 from typing import Optional
 from fastapi import APIRouter
 from fastapi import Depends
+from fastapi import Query
 from fastapi import Request
 from fastapi import Response
-from fastapi import File
-from fastapi import UploadFile
 from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile as FormFile
 from fastapi_pagination import Page
 from fastapi_pagination import Params
 
@@ -20,13 +27,34 @@ from tendril.authn.pydantic import UserReferenceTModel
 from tendril.filestore.buckets import get_bucket
 from tendril.filestore.buckets import available_buckets
 from tendril.filestore.actual import FilestoreBucket
+from tendril.filestore.admission import UploadRejected
+from tendril.filestore import archive
+from tendril.filestore import authz_cache
+from tendril.filestore import caching
+from tendril.filestore import compression
+from tendril.filestore import events
+from tendril.filestore import manifest
+from tendril.filestore import signing
 
 from tendril.common.filestore.formats import BucketName
 from tendril.common.filestore.formats import MoveRequest
+from tendril.common.filestore.formats import CopyRequest
+from tendril.common.filestore.formats import SignRequest
+from tendril.common.filestore.formats import SignPrefixRequest
+from tendril.common.filestore.formats import ExposeBatchRequest
+from tendril.common.filestore.formats import DeleteBatchRequest
+from tendril.common.filestore.formats import ArchiveRequest
 from tendril.common.filestore.formats import StoredFileTModel
 
 from tendril.config import FILESTORE_ENABLED
 from tendril.config import FILESTORE_EXPOSE_ENABLED
+from tendril.config import FILESTORE_EXPOSE_BATCH_MAX
+from tendril.config import FILESTORE_EVENTS_KEEPALIVE
+from tendril.config import FILESTORE_DELETE_BATCH_MAX
+from tendril.config import FILESTORE_LIST_FAST_MAX_SIZE
+from tendril.config import FILESTORE_ARCHIVE_MAX_FILES
+from tendril.config import FILESTORE_ARCHIVE_UPLOAD_MAX_FILES
+from tendril.config import FILESTORE_ARCHIVE_UPLOAD_MAX_BYTES
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
@@ -48,30 +76,85 @@ expose = APIRouter(prefix='/filestore',
                    dependencies=[Depends(authn_dependency)])
 
 
+signed_expose = APIRouter(prefix='/filestore',
+                          tags=['Filestore Signed Expose API'])
+
+
 @filestore.get("/buckets")
 async def get_available_buckets():
-    return {'available_buckets': available_buckets()}
+    return {'available_buckets': available_buckets(),
+            'buckets': {name: get_bucket(name).describe()
+                        for name in available_buckets()}}
+
+
+def _content_length(request):
+    try:
+        return int(request.headers.get('content-length', 0))
+    except ValueError:
+        return 0
+
+
+def _upload_rejected(e):
+    logger.info(f"Refusing upload : {e}")
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={'Retry-After': str(e.retry_after)}
+    )
 
 
-@filestore.post("/{bucket}/upload")
+async def _admitted_upload(request: Request,
+                           bucket: BucketName,
+                           user: AuthUserModel = auth_spec()):
+    # Parsing a multipart form spools the whole of the body, so the upload
+    # is admitted on its Content-Length before the form is read, and holds
+    # its admission until the request is done with.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        logger.info(f"Got upload request with bad bucket '{bucket}'")
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    try:
+        async with bucket.admission.admit(user.id, _content_length(request)):
+            form = await request.form()
+            try:
+                file = form.get('file')
+                if not isinstance(file, FormFile):
+                    raise HTTPException(
+                        status_code=422,
+                        detail="Uploads need to include the file in a 'file' form field"
+                    )
+                yield file
+            finally:
+                await form.close()
+    except UploadRejected as e:
+        raise _upload_rejected(e)
+
+
+@filestore.post("/{bucket}/upload",
+                openapi_extra={'requestBody': {
+                    'required': True,
+                    'content': {'multipart/form-data': {'schema': {
+                        'type': 'object',
+                        'required': ['file'],
+                        'properties': {'file': {'type': 'string', 'format': 'binary'}}
+                    }}}
+                }})
 async def upload_file_to_bucket(
         request: Request,
         bucket: BucketName,
         overwrite: bool = False,
         actual_user: Optional[UserReferenceTModel] = None,
-        file: UploadFile = File(...),
+        file: FormFile = Depends(_admitted_upload),
         interest: Optional[int] = None,
         label: Optional[str] = None,
         user: AuthUserModel = auth_spec()):
 
-    try:
-        bucket: FilestoreBucket = get_bucket(bucket)
-    except KeyError:
-        logger.info(f"Got upload request with bad bucket '{bucket}' ({file.filename})")
-        raise HTTPException(
-            status_code=404,
-            detail=f'{bucket} is not a recognized filestore bucket'
-        )
+    bucket: FilestoreBucket = get_bucket(bucket)
 
     if not bucket.check_accepts(file.filename):
         logger.info(f"Got upload request with bad extension ({file.filename})")
@@ -80,15 +163,37 @@ async def upload_file_to_bucket(
             detail=f"This bucket does not allow uploads with this extension"
         )
 
+    if not bucket.check_filename(file.filename):
+        logger.info(f"Got upload request with bad filename ({file.filename})")
+        raise HTTPException(
+            status_code=400,
+            detail="This filename is not permitted in this bucket"
+        )
+
     try:
         actual_user = actual_user or user.id
-        sf = bucket.upload(file, actual_user, interest=interest, label=label, overwrite=overwrite)
+        # Written from a worker thread, so that reads are still served
+        # while uploads are being written out.
+        sf = await run_in_threadpool(bucket.upload, file, actual_user, interest=interest,
+                                     label=label, overwrite=overwrite)
     except FileExistsError as e:
         logger.info(e)
         raise HTTPException(
             status_code=409,
             detail=str(e)
         )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except OSError as e:
+        if e.errno != errno.EDQUOT:
+            raise
+        raise HTTPException(
+            status_code=507,
+            detail=e.strerror
+        )
 
     return {'storedfileid': sf.id}
     # print(request.headers.get('authorization'))
@@ -96,6 +201,220 @@ async def upload_file_to_bucket(
     # print(file, file.filename)
 
 
+@filestore.put("/{bucket}/ingest/{filepath:path}")
+async def ingest_file_to_bucket(
+        request: Request,
+        bucket: BucketName,
+        filepath: str,
+        overwrite: bool = False,
+        actual_user: Optional[UserReferenceTModel] = None,
+        interest: Optional[int] = None,
+        label: Optional[str] = None,
+        user: AuthUserModel = auth_spec()):
+
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        logger.info(f"Got ingest request with bad bucket '{bucket}' ({filepath})")
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if not bucket.check_accepts(filepath):
+        logger.info(f"Got ingest request with bad extension ({filepath})")
+        raise HTTPException(
+            status_code=415,
+            detail="This bucket does not allow uploads with this extension"
+        )
+
+    if not bucket.check_filename(filepath):
+        logger.info(f"Got ingest request with bad filename ({filepath})")
+        raise HTTPException(
+            status_code=400,
+            detail="This filename is not permitted in this bucket"
+        )
+
+    spool = bucket.spool()
+    try:
+        async with bucket.admission.admit(user.id, _content_length(request)):
+            async for chunk in request.stream():
+                spool.write(chunk)
+            actual_user = actual_user or user.id
+            sf = await run_in_threadpool(bucket.ingest, spool, filepath, actual_user,
+                                         interest=interest, label=label, overwrite=overwrite)
+    except UploadRejected as e:
+        raise _upload_rejected(e)
+    except FileExistsError as e:
+        logger.info(e)
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except OSError as e:
+        if e.errno != errno.EDQUOT:
+            raise
+        raise HTTPException(
+            status_code=507,
+            detail=e.strerror
+        )
+    finally:
+        spool.discard()
+
+    return {'storedfileid': sf.id}
+
+
+@filestore.post("/{bucket}/upload_archive")
+async def upload_archive_to_bucket(
+        request: Request,
+        bucket: BucketName,
+        format: str = 'tar',
+        prefix: Optional[str] = None,
+        overwrite: bool = False,
+        actual_user: Optional[UserReferenceTModel] = None,
+        interest: Optional[int] = None,
+        label: Optional[str] = None,
+        user: AuthUserModel = auth_spec()):
+    # Extracts a zip or tar archive sent as the request body into the
+    # bucket, optionally under a prefix. Tar archives, compressed or not,
+    # are extracted as they arrive.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        logger.info(f"Got archive upload request with bad bucket '{bucket}'")
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if format not in archive.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported archive format. Use one of {list(archive.FORMATS.keys())}"
+        )
+
+    spool = None
+    try:
+        async with bucket.admission.admit(user.id, _content_length(request)):
+            if format == archive.ZIP:
+                # The index of a zip archive is at its end, so it has to
+                # be received in full before anything can be extracted.
+                spool = bucket.spool()
+                async for chunk in request.stream():
+                    spool.write(chunk)
+                spool.close()
+                source = spool.path
+            else:
+                source = archive.BodyReader(request.stream())
+            members = archive.ArchiveMembers(source, format, prefix=prefix,
+                                             accept=bucket.check_accepts,
+                                             max_files=FILESTORE_ARCHIVE_UPLOAD_MAX_FILES,
+                                             max_bytes=FILESTORE_ARCHIVE_UPLOAD_MAX_BYTES)
+            actual_user = actual_user or user.id
+            ids = await run_in_threadpool(bucket.upload_archive, members, actual_user,
+                                          interest=interest, label=label, overwrite=overwrite)
+    except UploadRejected as e:
+        raise _upload_rejected(e)
+    except archive.MemberRejected as e:
+        logger.info(e)
+        raise HTTPException(
+            status_code=415,
+            detail=str(e)
+        )
+    except FileExistsError as e:
+        logger.info(e)
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
+        )
+    except ValueError as e:
+        logger.info(e)
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except OSError as e:
+        if e.errno == errno.EFBIG:
+            raise HTTPException(
+                status_code=413,
+                detail=e.strerror
+            )
+        if e.errno != errno.EDQUOT:
+            raise
+        raise HTTPException(
+            status_code=507,
+            detail=e.strerror
+        )
+    finally:
+        if spool is not None:
+            spool.discard()
+
+    return {'storedfileids': ids, 'skipped': members.skipped}
+
+
+@filestore.get("/{bucket}/jobs/{filepath:path}")
+async def get_file_processing_status(
+        request: Request,
+        bucket: BucketName,
+        filepath: str,
+        user: AuthUserModel = auth_spec()):
+
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    return {'filename': filepath,
+            'jobs': [{'stage': job['stage'],
+                      'status': job['status'],
+                      'attempts': job['attempts'],
+                      'error': job['error'],
+                      'created_at': job['created_at'],
+                      'updated_at': job['updated_at']}
+                     for job in bucket.processing_status(filepath)]}
+
+
+@filestore.get("/{bucket}/download/{filepath:path}")
+async def download_file_from_bucket(
+        request: Request,
+        bucket: BucketName,
+        filepath: str,
+        user: AuthUserModel = auth_spec()):
+    # Streams the logical content of the file to other components. The
+    # ETag carries the content hash, which clients use to verify and
+    # cache what they receive.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    try:
+        fileinfo = bucket.get_fileinfo(filepath)
+    except FileNotFoundError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+
+    headers = caching.validator_headers(fileinfo)
+    if caching.is_not_modified(request.headers, fileinfo):
+        return Response(status_code=304, headers=headers)
+    media_type = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+    return StreamingResponse(bucket.iter_bytes(filepath, fileinfo=fileinfo),
+                             media_type=media_type, headers=headers)
+
+
 @filestore_management.post("/{bucket}/move")
 async def move_file_from_bucket(
         request: Request,
@@ -121,15 +440,82 @@ async def move_file_from_bucket(
         )
 
     try:
-        sf = source_bucket.move(filename=move_request.filename,
-                                target_bucket=target_bucket,
-                                user=actual_user or user.id,
-                                overwrite=move_request.overwrite)
+        sf = await run_in_threadpool(source_bucket.move, filename=move_request.filename,
+                                     target_bucket=target_bucket,
+                                     user=actual_user or user.id,
+                                     overwrite=move_request.overwrite)
     except FileNotFoundError:
         raise HTTPException(
             status_code=404,
             detail=f'{move_request.filename} does not exist in the source bucket'
         )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except OSError as e:
+        if e.errno != errno.EDQUOT:
+            raise
+        raise HTTPException(
+            status_code=507,
+            detail=e.strerror
+        )
+    return {'storedfileid': sf.id}
+
+
+@filestore_management.post("/{bucket}/copy")
+async def copy_file_from_bucket(
+        request: Request,
+        bucket: BucketName,
+        copy_request: CopyRequest,
+        actual_user: Optional[UserReferenceTModel] = None,
+        user: AuthUserModel = auth_spec()):
+
+    try:
+        source_bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    try:
+        target_bucket: FilestoreBucket = get_bucket(copy_request.to_bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{copy_request.to_bucket} is not a recognized filestore bucket'
+        )
+
+    try:
+        sf = await run_in_threadpool(source_bucket.copy, filename=copy_request.filename,
+                                     target_bucket=target_bucket,
+                                     user=actual_user or user.id,
+                                     overwrite=copy_request.overwrite)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{copy_request.filename} does not exist in the source bucket'
+        )
+    except FileExistsError as e:
+        logger.info(e)
+        raise HTTPException(
+            status_code=409,
+            detail=str(e)
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    except OSError as e:
+        if e.errno != errno.EDQUOT:
+            raise
+        raise HTTPException(
+            status_code=507,
+            detail=e.strerror
+        )
     return {'storedfileid': sf.id}
 
 
@@ -150,7 +536,7 @@ async def delete_file_from_bucket(
         )
 
     try:
-        bucket.delete(filename, actual_user or user.id)
+        await run_in_threadpool(bucket.delete, filename, actual_user or user.id)
     except FileNotFoundError as e:
         raise HTTPException(
             status_code=404,
@@ -165,6 +551,106 @@ async def delete_file_from_bucket(
     return {'deleted': filename}
 
 
+@filestore_management.post("/{bucket}/delete_batch")
+async def delete_files_batch_from_bucket(
+        request: Request,
+        bucket: BucketName,
+        batch_request: DeleteBatchRequest,
+        actual_user: Optional[UserReferenceTModel] = None,
+        user: AuthUserModel = auth_spec()):
+
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if len(batch_request.filenames) > FILESTORE_DELETE_BATCH_MAX:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {FILESTORE_DELETE_BATCH_MAX} files may be deleted in one request"
+        )
+
+    return await run_in_threadpool(bucket.delete_batch, batch_request.filenames,
+                                   actual_user or user.id)
+
+
+@filestore_management.get("/events")
+async def get_change_feed_stats(request: Request,
+                                user: AuthUserModel = auth_spec()):
+    return events.stats()
+
+
+@filestore_management.get("/{bucket}/events")
+async def get_bucket_change_feed(
+        request: Request,
+        bucket: BucketName,
+        user: AuthUserModel = auth_spec()):
+    # Streams changes to the bucket as Server-Sent Events, in place of
+    # polling the listing. Each event is sent with an id, and a client
+    # reconnecting with Last-Event-ID resumes from there. A 'reset' event
+    # means changes may have been missed, and the client should list the
+    # bucket again before relying on the feed.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    subscription = events.subscribe(buckets=[bucket.name],
+                                    last_event_id=request.headers.get('last-event-id'))
+    headers = {'Cache-Control': 'no-cache',
+               'X-Accel-Buffering': 'no'}
+    return StreamingResponse(_iter_change_feed(request, subscription),
+                             media_type='text/event-stream', headers=headers)
+
+
+async def _iter_change_feed(request, subscription):
+    try:
+        if subscription.reset:
+            yield b'event: reset\ndata: {}\n\n'
+        while True:
+            try:
+                e = await asyncio.wait_for(subscription.get(), FILESTORE_EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield b': keepalive\n\n'
+                continue
+            if e is None:
+                yield b'event: reset\ndata: {}\n\n'
+                break
+            yield f"id: {e['id']}\nevent: {e['type']}\ndata: {json.dumps(e)}\n\n".encode()
+    finally:
+        subscription.close()
+
+
+@filestore_management.get("/authz_cache")
+async def get_authz_cache_stats(request: Request,
+                                user: AuthUserModel = auth_spec()):
+    return authz_cache.stats()
+
+
+@filestore_management.post("/authz_cache/invalidate")
+async def invalidate_authz_cache(request: Request,
+                                 invalidate_user: Optional[str] = None,
+                                 invalidate_interest: Optional[int] = None,
+                                 user: AuthUserModel = auth_spec()):
+    if invalidate_user is None and invalidate_interest is None:
+        count = authz_cache.clear()
+    else:
+        count = 0
+        if invalidate_user is not None:
+            count += authz_cache.invalidate_user(invalidate_user)
+        if invalidate_interest is not None:
+            count += authz_cache.invalidate_interest(invalidate_interest)
+    return {'invalidated': count}
+
+
 @filestore_management.get("/{bucket}/ls_fs",
                           response_model=List[str])
 async def list_files_in_bucket_fs(
@@ -189,6 +675,7 @@ async def list_files_in_bucket(
         request: Request,
         bucket: BucketName,
         include_owner: bool = False,
+        filenames: Optional[List[str]] = Query(None),
         params: Params = Depends(),
         user: AuthUserModel = auth_spec()):
 
@@ -200,13 +687,119 @@ async def list_files_in_bucket(
             detail=f'{bucket} is not a recognized filestore bucket'
         )
     return bucket.list_info(include_owner=include_owner,
+                            filenames=filenames,
                             pagination_params=params)
 
 
+@filestore_management.get("/{bucket}/ls_fast")
+async def list_files_in_bucket_fast(
+        request: Request,
+        bucket: BucketName,
+        include_owner: bool = False,
+        filenames: Optional[List[str]] = Query(None),
+        page: int = Query(1, ge=1),
+        size: int = Query(50, ge=1, le=FILESTORE_LIST_FAST_MAX_SIZE),
+        user: AuthUserModel = auth_spec()):
+    # Same page structure as /ls, serialized without building a model per
+    # item. Owners are returned as bare puids rather than user stubs. Pages
+    # may be much larger than /ls allows.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+    content = bucket.list_info_json(include_owner=include_owner,
+                                    filenames=filenames,
+                                    page=page, size=size)
+    return Response(content=content, media_type='application/json')
+
+
+@filestore_management.get("/{bucket}/export")
+async def export_bucket_manifest(
+        request: Request,
+        bucket: BucketName,
+        format: str = 'ndjson',
+        gzip: bool = False,
+        user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if format not in manifest.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported manifest format. Use one of {list(manifest.FORMATS.keys())}"
+        )
+
+    headers = {'Content-Disposition': f'attachment; filename="{bucket.name}.{format}"'}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(manifest.iter_manifest(bucket, fmt=format, gzip=gzip),
+                             media_type=manifest.FORMATS[format],
+                             headers=headers)
+
+
+@filestore_management.get("/{bucket}/stats")
+async def get_bucket_usage_stats(
+        request: Request,
+        bucket: BucketName,
+        include_owners: bool = False,
+        user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+    rv = bucket.usage(include_owners=include_owners)
+    rv['uploads'] = bucket.admission.stats()
+    return rv
+
+
+@filestore_management.post("/{bucket}/stats/rebuild")
+async def rebuild_bucket_usage_stats(
+        request: Request,
+        bucket: BucketName,
+        user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+    bucket.rebuild_usage()
+    return bucket.usage()
+
+
+@filestore_management.get("/{bucket}/replication")
+async def get_bucket_replication_status(
+        request: Request,
+        bucket: BucketName,
+        user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+    return {'bucket': bucket.name,
+            'replicas': bucket.replication_status()}
+
+
 @filestore_management.post("/{bucket}/purge")
 async def purge_all_files_in_bucket(
         request: Request,
         bucket: BucketName,
+        actual_user: Optional[UserReferenceTModel] = None,
         user: AuthUserModel = auth_spec()):
     try:
         bucket: FilestoreBucket = get_bucket(bucket)
@@ -215,7 +808,7 @@ async def purge_all_files_in_bucket(
             status_code=404,
             detail=f'{bucket} is not a recognized filestore bucket'
         )
-    return bucket.purge(user.id)
+    return await run_in_threadpool(bucket.purge, actual_user or user.id)
 
 
 @expose.get("/{bucket}/expose/{filepath:path}")
@@ -229,10 +822,275 @@ async def get_exposed_file(request: Request, bucket: BucketName,
             status_code=404,
             detail=f'{bucket} is not a recognized filestore bucket'
         )
-    response.headers['X-Accel-Redirect'] = bucket.expose(filepath, user=user)
+    try:
+        uri, fileinfo = bucket.expose_info(filepath, user=user)
+    except FileNotFoundError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    except PermissionError as e:
+        raise HTTPException(
+            status_code=403,
+            detail=str(e)
+        )
+
+    return _exposed_file_response(request, response, bucket, filepath, uri,
+                                  fileinfo['props'].get('encoding'), fileinfo)
+
+
+def _exposed_file_response(request, response, bucket, filepath, uri, encoding, fileinfo=None):
+    headers = {}
+    if encoding:
+        headers['Vary'] = 'Accept-Encoding'
+        if not compression.accepts_encoding(request.headers.get('accept-encoding'), encoding):
+            # The client cannot take the stored form. Decompress on the fly.
+            stored = {'props': {'encoding': encoding}}
+            encoding = None
+            uri = None
+    else:
+        stored = {'props': {}}
+
+    if fileinfo:
+        headers.update(caching.validator_headers(fileinfo, encoding, bucket.cache_control))
+        if caching.is_not_modified(request.headers, fileinfo, encoding):
+            return Response(status_code=304, headers=headers)
+    elif bucket.cache_control:
+        headers['Cache-Control'] = bucket.cache_control
+
+    if not uri:
+        media_type = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+        return StreamingResponse(bucket.iter_bytes(filepath, fileinfo=fileinfo or stored),
+                                 media_type=media_type, headers=headers)
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    headers['X-Accel-Redirect'] = uri
+    response.headers.update(headers)
     return
 
 
+@expose.post("/{bucket}/sign")
+async def sign_exposed_file(request: Request, bucket: BucketName,
+                            sign_request: SignRequest,
+                            user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if not signing.enabled():
+        raise HTTPException(
+            status_code=501,
+            detail="Signed URLs are not enabled on this filestore"
+        )
+
+    try:
+        _, fileinfo = bucket.expose_info(sign_request.filename, user=user)
+    except FileNotFoundError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    except PermissionError as e:
+        raise HTTPException(
+            status_code=403,
+            detail=str(e)
+        )
+
+    try:
+        params = signing.sign(bucket.name, filepath=sign_request.filename,
+                              ttl=sign_request.ttl,
+                              encoding=fileinfo['props'].get('encoding'))
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    return _signed_url(request, bucket, sign_request.filename, params)
+
+
+@filestore_management.post("/{bucket}/sign_prefix")
+async def sign_exposed_prefix(request: Request, bucket: BucketName,
+                              sign_request: SignPrefixRequest,
+                              user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if not signing.enabled():
+        raise HTTPException(
+            status_code=501,
+            detail="Signed URLs are not enabled on this filestore"
+        )
+
+    try:
+        params = signing.sign(bucket.name, prefix=sign_request.prefix,
+                              ttl=sign_request.ttl)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+        )
+    return {'prefix': sign_request.prefix,
+            'expires': params['expires'],
+            'query': urlencode(params)}
+
+
+@expose.post("/{bucket}/expose_batch")
+async def expose_files_batch(request: Request, bucket: BucketName,
+                             batch_request: ExposeBatchRequest,
+                             user: AuthUserModel = auth_spec()):
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if len(batch_request.filenames) > FILESTORE_EXPOSE_BATCH_MAX:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {FILESTORE_EXPOSE_BATCH_MAX} files may be exposed in one request"
+        )
+
+    sign = batch_request.sign and signing.enabled()
+    results = {}
+    for filename, result in bucket.expose_batch(batch_request.filenames, user=user,
+                                                sign=sign, ttl=batch_request.ttl).items():
+        if 'error' in result:
+            results[filename] = result
+        elif sign:
+            results[filename] = _signed_url(request, bucket, filename, result['signed'])
+        else:
+            results[filename] = {'filename': filename, 'x_accel': result['uri']}
+    return {'files': results}
+
+
+@expose.get("/{bucket}/archive")
+async def get_archive(request: Request, bucket: BucketName,
+                      prefix: Optional[str] = None,
+                      filenames: Optional[List[str]] = Query(None),
+                      format: str = 'zip',
+                      user: AuthUserModel = auth_spec()):
+    return _archive_response(bucket, filenames, prefix, format, user)
+
+
+@expose.post("/{bucket}/archive")
+async def post_archive(request: Request, bucket: BucketName,
+                       archive_request: ArchiveRequest,
+                       user: AuthUserModel = auth_spec()):
+    return _archive_response(bucket, archive_request.filenames, archive_request.prefix,
+                             archive_request.format, user)
+
+
+def _archive_response(bucket, filenames, prefix, format, user):
+    # Streams a zip or tar of several files, named explicitly or by a
+    # common prefix, as they are read from the bucket.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if format not in archive.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported archive format. Use one of {list(archive.FORMATS.keys())}"
+        )
+
+    if (filenames is None) == (prefix is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide either a list of filenames or a prefix"
+        )
+
+    if filenames is not None and len(filenames) > FILESTORE_ARCHIVE_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {FILESTORE_ARCHIVE_MAX_FILES} files may be archived in one request"
+        )
+
+    try:
+        entries = bucket.archive_entries(user, filenames=filenames, prefix=prefix)
+    except FileNotFoundError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    except PermissionError as e:
+        raise HTTPException(
+            status_code=403,
+            detail=str(e)
+        )
+
+    if not entries:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No files found under {prefix} in the bucket {bucket.name}"
+        )
+
+    if len(entries) > FILESTORE_ARCHIVE_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {FILESTORE_ARCHIVE_MAX_FILES} files may be archived in one request"
+        )
+
+    name = archive.archive_name(bucket, prefix, format)
+    headers = {'Content-Disposition': f'attachment; filename="{name}"'}
+    return StreamingResponse(archive.iter_archive(bucket, entries, fmt=format,
+                                                  root=archive.archive_root(prefix)),
+                             media_type=archive.FORMATS[format],
+                             headers=headers)
+
+
+def _signed_url(request, bucket, filepath, params):
+    url = request.url_for('get_signed_file', bucket=bucket.name, filepath=filepath)
+    return {'filename': filepath,
+            'expires': params['expires'],
+            'url': f'{url}?{urlencode(params)}'}
+
+
+@signed_expose.get("/{bucket}/signed/{filepath:path}")
+async def get_signed_file(request: Request, bucket: str,
+                          filepath: str, response: Response,
+                          expires: int, sig: str,
+                          prefix: Optional[str] = None,
+                          enc: Optional[str] = None):
+    # No authentication and no database access. The signature is all
+    # the authorization this route needs.
+    try:
+        bucket: FilestoreBucket = get_bucket(bucket)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f'{bucket} is not a recognized filestore bucket'
+        )
+
+    if not signing.verify(bucket.name, filepath, expires, sig, prefix=prefix, encoding=enc):
+        raise HTTPException(
+            status_code=403,
+            detail="Invalid or expired signature"
+        )
+
+    if prefix is not None:
+        # Not known when the prefix was signed. Read from the stored file.
+        enc = bucket.stored_encoding(filepath)
+
+    return _exposed_file_response(request, response, bucket, filepath,
+                                  bucket.x_sendfile_path(filepath), enc)
+
+
 if FILESTORE_ENABLED:
     routers = [
         filestore,
@@ -244,3 +1102,5 @@ else:
 
 if FILESTORE_EXPOSE_ENABLED:
     routers.append(expose)
+    if signing.enabled():
+        routers.append(signed_expose)
@@ -2,6 +2,7 @@
 
 import json
 import datetime
+from typing import List
 from typing import Union
 from pydantic import Field
 from pydantic import root_validator
@@ -31,10 +32,44 @@ class MoveRequest(TendrilTBaseModel):
     overwrite: bool = False
 
 
+class CopyRequest(TendrilTBaseModel):
+    to_bucket: BucketName
+    filename: str
+    overwrite: bool = False
+
+
+class SignRequest(TendrilTBaseModel):
+    filename: str
+    ttl: Union[int, None] = None
+
+
+class SignPrefixRequest(TendrilTBaseModel):
+    prefix: str = Field(..., example="releases/v1.2/")
+    ttl: Union[int, None] = None
+
+
+class ExposeBatchRequest(TendrilTBaseModel):
+    filenames: List[str] = Field(..., example=["some_filename.jpg", "another.png"])
+    sign: bool = True
+    ttl: Union[int, None] = None
+
+
+class DeleteBatchRequest(TendrilTBaseModel):
+    filenames: List[str] = Field(..., example=["some_filename.jpg", "another.png"])
+
+
+class ArchiveRequest(TendrilTBaseModel):
+    filenames: Union[List[str], None] = Field(None, example=["some_filename.jpg", "another.png"])
+    prefix: Union[str, None] = Field(None, example="releases/v1.2/")
+    format: str = Field('zip', example='tar.gz')
+
+
 class StoredFilePropsTModel(TendrilTBaseModel):
     size: int = Field(..., example=714794)
     created: Union[datetime.datetime, None]
     modified: Union[datetime.datetime, None]
+    stored_size: Union[int, None] = Field(None, example=181307)
+    encoding: Union[str, None] = Field(None, example='zstd')
 
 
 class StoredFileHashTModel(TendrilTBaseModel):
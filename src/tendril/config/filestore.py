@@ -71,6 +71,121 @@ def _filestore_config_template(filestore_name):
             "the default FILESTORE_ACTUAL path. This should either be a local file path or "
             "a pyfilesystems2 supported URI."
         ),
+        ConfigOption(
+            'FILESTORE_{}_COMPRESS_EXT'.format(filestore_name),
+            "[]",
+            "List of file extensions which should be stored zstd compressed in this "
+            "filestore bucket. Compression is transparent to API consumers and is "
+            "applied as the upload is written. Leave empty to disable compression. "
+            "Requires the zstandard package."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_COMPRESS_LEVEL'.format(filestore_name),
+            "3",
+            "zstd compression level to use for files compressed in this filestore bucket."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_SIDECAR_EXT'.format(filestore_name),
+            "[]",
+            "List of file extensions for which precompressed .gz and .br sidecars "
+            "should be generated after upload, for use with nginx gzip_static and "
+            "brotli_static. Sidecars are kept in sync with the file, and are not "
+            "listed or registered in the database. Only supported for buckets on "
+            "a local filesystem. Leave empty to disable."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_PROCESSING_STAGES'.format(filestore_name),
+            "[]",
+            "List of post-upload processing stages to run on files uploaded to this "
+            "filestore bucket. Stages are queued on upload and run asynchronously by "
+            "the filestore processing workers, and their results are written into "
+            "the stored file's fileinfo."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_DURABILITY'.format(filestore_name),
+            "'none'",
+            "Durability of writes to this filestore bucket. Files are always written "
+            "to a temporary name and atomically renamed into place. With 'none', the "
+            "data is left to the OS to flush. With 'fsync', every file and its "
+            "directory entry are synced before the upload completes. With 'group', "
+            "writes completing within FILESTORE_<BUCKET>_GROUP_FSYNC_WINDOW share a "
+            "single filesystem sync. Only applies to buckets on a local filesystem."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_GROUP_FSYNC_WINDOW'.format(filestore_name),
+            "0.01",
+            "Window in seconds over which writes to this filestore bucket are batched "
+            "into a single sync, when FILESTORE_<BUCKET>_DURABILITY is 'group'."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_CACHE_CONTROL'.format(filestore_name),
+            "'private, no-cache'",
+            "Cache-Control header to send with files from this filestore bucket served "
+            "through the expose API. Responses also carry an ETag derived from the file "
+            "hash and a Last-Modified header, so the default allows clients to cache "
+            "files and cheaply revalidate them. Set to None to omit the header."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_QUOTA_FILES'.format(filestore_name),
+            "None",
+            "Maximum number of files this filestore bucket may hold. Uploads beyond "
+            "this are refused. Leave as None for no limit."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_QUOTA_BYTES'.format(filestore_name),
+            "None",
+            "Maximum number of bytes this filestore bucket may hold on disk. Uploads "
+            "which would exceed it are refused. Leave as None for no limit."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_OWNER_QUOTA_BYTES'.format(filestore_name),
+            "None",
+            "Maximum number of bytes any single owner may hold in this filestore bucket. "
+            "Leave as None for no limit."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_MAX_CONCURRENT_UPLOADS'.format(filestore_name),
+            "None",
+            "Maximum number of uploads each filestore process writes into this bucket "
+            "at once. Further uploads wait in a queue served fairly across users. "
+            "Leave as None for no limit."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_MAX_UPLOAD_BYTES_IN_FLIGHT'.format(filestore_name),
+            "None",
+            "Maximum total size in bytes of the uploads each filestore process writes "
+            "into this bucket at once. Leave as None for no limit."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_UPLOAD_QUEUE_LENGTH'.format(filestore_name),
+            "16",
+            "Number of uploads which may wait for capacity in this bucket when its "
+            "upload limits are reached. Uploads beyond this are refused with a 503 "
+            "and a Retry-After header."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_UPLOAD_QUEUE_TIMEOUT'.format(filestore_name),
+            "30",
+            "Time in seconds an upload may wait for capacity in this bucket before "
+            "it is refused with a 503 and a Retry-After header."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_HARDLINK_COPIES'.format(filestore_name),
+            "False",
+            "Whether files copied into this filestore bucket from another bucket on "
+            "the same volume are hardlinked rather than cloned. Files are only ever "
+            "replaced by renaming a new file over them, never modified in place, but "
+            "this is intended for buckets whose files are also not changed by other "
+            "means. Where the filesystem supports reflinks, copies are cheap anyway."
+        ),
+        ConfigOption(
+            'FILESTORE_{}_REPLICAS'.format(filestore_name),
+            "[]",
+            "List of pyfilesystem URIs to which this filestore bucket is replicated. "
+            "Uploads, moves and deletes are queued and applied to each replica "
+            "asynchronously by the filestore replication workers.",
+            masked=True
+        ),
         FileStoreActualURI(
             'FILESTORE_{}_ACTUAL_URI'.format(filestore_name),
             filestore_name,
@@ -71,12 +71,242 @@ config_elements_filestore_core = [
         "presently not configured per-bucket and is intended for use only as an Auth0 M2M "
         "application", masked=True
     ),
+    ConfigOption(
+        'FILESTORE_REMOTE_NODES',
+        "None",
+        "List of network URLs of filestore components across which buckets are "
+        "spread. When set, this takes the place of FILESTORE_REMOTE_URI, and each "
+        "bucket, or each file in a partitioned bucket, is placed on one of these "
+        "nodes by consistent hashing. Each node is a complete filestore component "
+        "with its own storage and database, configured with the same buckets. "
+        "Changing this list requires running the rebalance tool."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_PARTITIONED_BUCKETS',
+        "[]",
+        "Buckets whose files are spread across all the filestore nodes, rather "
+        "than the whole bucket being placed on a single node."
+    ),
+    ConfigOption(
+        'FILESTORE_RING_VNODES',
+        "64",
+        "Number of points each filestore node occupies on the consistent hash ring."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_PAGE_SIZE',
+        "100",
+        "Number of entries requested per page when remote filestore components "
+        "iterate over the contents of a bucket. The next page is fetched while "
+        "the current one is being consumed."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_DISCOVERY_TTL',
+        "300",
+        "Time in seconds for which the list of buckets discovered from the remote "
+        "filestore is used before it is refreshed in the background."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_DISCOVERY_CACHE',
+        "os.path.join(INSTANCE_ROOT, 'cache', 'filestore_remote_buckets.json')",
+        "File in which the list of buckets discovered from the remote filestore is "
+        "kept, so that it is shared between processes and survives restarts. "
+        "Set to None to keep it only in memory."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_CACHE_DIR',
+        "os.path.join(INSTANCE_ROOT, 'cache', 'filestore_content')",
+        "Folder in which components using a remote filestore cache the content "
+        "of files they read, keyed by content hash. It may be shared by all "
+        "components on a host."
+    ),
+    ConfigOption(
+        'FILESTORE_REMOTE_CACHE_SIZE',
+        "2 ** 30",
+        "Maximum size in bytes of the remote filestore content cache. Least "
+        "recently used content is evicted beyond this. Set to 0 to disable the cache."
+    ),
     ConfigOption(
         'FILESTORE_ACTUAL',
         "os.path.join(INSTANCE_ROOT, 'filestore')",
         "Default path to create filestore folders at. This may "
         "be overridden by individual filestore bucket configurations."
     ),
+    ConfigOption(
+        'FILESTORE_SIDECAR_WORKERS',
+        "2",
+        "Number of worker processes to use for generating precompressed sidecars "
+        "for buckets which have them enabled."
+    ),
+    ConfigOption(
+        'FILESTORE_PROCESSING_WORKERS',
+        "2",
+        "Number of worker threads running post-upload processing stages on this "
+        "component. Jobs are claimed from a table in the database, so workers on "
+        "several processes can share the queue."
+    ),
+    ConfigOption(
+        'FILESTORE_PROCESSING_POLL_INTERVAL',
+        "5",
+        "Interval in seconds at which idle processing workers check for queued "
+        "jobs. Jobs queued by this process are picked up immediately."
+    ),
+    ConfigOption(
+        'FILESTORE_PROCESSING_LEASE',
+        "300",
+        "Time in seconds a processing worker may hold a job before it is considered "
+        "abandoned and made available to other workers."
+    ),
+    ConfigOption(
+        'FILESTORE_PROCESSING_MAX_ATTEMPTS',
+        "3",
+        "Number of times a failing processing job is attempted before it is marked "
+        "as failed. This includes attempts abandoned by a worker which crashed or "
+        "hung, and whose lease expired."
+    ),
+    ConfigOption(
+        'FILESTORE_FILE_LOCKS',
+        "'process'",
+        "How concurrent operations on the same file are serialized. 'process' "
+        "serializes them within each filestore process. 'database' additionally "
+        "takes a Postgres advisory lock, and is needed when several processes or "
+        "hosts serve the same buckets."
+    ),
+    ConfigOption(
+        'FILESTORE_REPLICATION_WORKERS',
+        "1",
+        "Number of worker threads applying queued changes to bucket replicas on "
+        "this component."
+    ),
+    ConfigOption(
+        'FILESTORE_REPLICATION_BATCH_SIZE',
+        "100",
+        "Maximum number of queued replication events a worker claims and applies "
+        "at once. Several events for the same file within a batch are applied as one."
+    ),
+    ConfigOption(
+        'FILESTORE_REPLICATION_POLL_INTERVAL',
+        "5",
+        "Interval in seconds at which idle replication workers check for queued "
+        "events. Events queued by this process are picked up immediately."
+    ),
+    ConfigOption(
+        'FILESTORE_REPLICATION_LEASE',
+        "300",
+        "Time in seconds a replication worker may hold a batch of events before it is "
+        "considered abandoned and made available to other workers."
+    ),
+    ConfigOption(
+        'FILESTORE_REPLICATION_MAX_BACKOFF',
+        "300",
+        "Maximum time in seconds between attempts to apply a failing replication "
+        "event. Events are retried until they succeed."
+    ),
+    ConfigOption(
+        'FILESTORE_JOURNAL_STALE_AGE',
+        "3600",
+        "Age in seconds after which an uncleared write-intent journal entry recorded "
+        "by a process on another host is considered abandoned and is recovered on "
+        "startup. Entries from processes on this host are recovered as soon as the "
+        "process that recorded them is no longer running."
+    ),
+    ConfigOption(
+        'FILESTORE_SIGNING_KEY',
+        "None",
+        "Secret key used to sign and verify expiring filestore URLs. Signed URLs "
+        "are served without authentication or database access, so this key should "
+        "be kept as carefully as any other credential. Leave unset to disable "
+        "signed URLs.", masked=True
+    ),
+    ConfigOption(
+        'FILESTORE_SIGNED_URL_TTL',
+        "300",
+        "Default lifetime in seconds of signed filestore URLs."
+    ),
+    ConfigOption(
+        'FILESTORE_SIGNED_URL_MAX_TTL',
+        "86400",
+        "Maximum lifetime in seconds which may be requested for signed filestore URLs."
+    ),
+    ConfigOption(
+        'FILESTORE_EXPOSE_BATCH_MAX',
+        "1000",
+        "Maximum number of files which may be requested in a single batch expose request."
+    ),
+    ConfigOption(
+        'FILESTORE_LIST_FAST_MAX_SIZE',
+        "5000",
+        "Maximum page size which may be requested from the /ls_fast listing."
+    ),
+    ConfigOption(
+        'FILESTORE_DELETE_BATCH_MAX',
+        "1000",
+        "Maximum number of files which may be deleted in a single batch delete request."
+    ),
+    ConfigOption(
+        'FILESTORE_ARCHIVE_MAX_FILES',
+        "20000",
+        "Maximum number of files which may be included in a single archive download."
+    ),
+    ConfigOption(
+        'FILESTORE_ARCHIVE_STORED_EXT',
+        "['.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', "
+        "'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', "
+        "'.webm', '.docx', '.xlsx', '.pptx', '.odt', '.ods']",
+        "Extensions of files which are already compressed. These are added to zip "
+        "archive downloads without compressing them again."
+    ),
+    ConfigOption(
+        'FILESTORE_ARCHIVE_UPLOAD_MAX_FILES',
+        "10000",
+        "Maximum number of files which may be extracted from a single uploaded archive."
+    ),
+    ConfigOption(
+        'FILESTORE_ARCHIVE_UPLOAD_MAX_BYTES',
+        "2 ** 34",
+        "Maximum total size in bytes of the files extracted from a single uploaded "
+        "archive. Extraction stops as soon as this is exceeded, which also guards "
+        "against archives built to expand far beyond their own size."
+    ),
+    ConfigOption(
+        'FILESTORE_AUTHZ_CACHE_SIZE',
+        "10000",
+        "Maximum number of interest based access decisions cached by the filestore. "
+        "Set to 0 to disable the cache."
+    ),
+    ConfigOption(
+        'FILESTORE_AUTHZ_CACHE_TTL',
+        "60",
+        "Time in seconds for which a cached interest based access decision is used "
+        "before it is checked again. This bounds how long a change in interest "
+        "membership may take to be reflected in filestore access."
+    ),
+    ConfigOption(
+        'FILESTORE_EVENTS_BACKEND',
+        "'process'",
+        "How bucket change events are distributed to change feed subscribers. "
+        "'process' delivers events only to subscribers of the process in which "
+        "the change was made. 'postgres' publishes them with Postgres NOTIFY, so "
+        "that subscribers of every process serving the buckets receive them, and "
+        "requires psycopg2."
+    ),
+    ConfigOption(
+        'FILESTORE_EVENTS_BACKLOG',
+        "1000",
+        "Number of recent change events kept by each process, so that change feed "
+        "subscribers which reconnect can pick up where they left off."
+    ),
+    ConfigOption(
+        'FILESTORE_EVENTS_MAX_PENDING',
+        "1000",
+        "Number of undelivered change events a change feed subscriber may fall "
+        "behind by before it is disconnected and told to start over."
+    ),
+    ConfigOption(
+        'FILESTORE_EVENTS_KEEPALIVE',
+        "15",
+        "Interval in seconds at which idle change feed connections are sent a "
+        "keepalive comment."
+    ),
     ConfigOption(
         'FILESTORE_EXPOSE_ENABLED',
         'True',
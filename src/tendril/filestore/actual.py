@@ -1,22 +1,50 @@
 
 
+import errno
 import hashlib
 import os
+import time
+import uuid
+import tempfile
 
 from fs import open_fs
 from fs import move
+from fs.copy import copy_file
 from fs.osfs import OSFS
+from fs.errors import FileExpected
+from fs.errors import ResourceNotFound
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 
 # Causes a circular import issue. Does not actually seem to be needed.
 # from tendril.authn.users import get_user_stub
+from tendril.filestore import clone
+from tendril.filestore import compression
+from tendril.filestore import durability
+from tendril.filestore import events
+from tendril.filestore import journal
+from tendril.filestore import processing
+from tendril.filestore import replication
 from tendril.filestore.base import FilestoreBucketBase
+from tendril.filestore.admission import UploadAdmission
+from tendril.filestore.locks import lock_files
+from tendril.filestore.sidecars import SidecarGenerator
 from tendril.filestore.db.controller import register_bucket
-from tendril.filestore.db.controller import get_storedfile_owner
-from tendril.filestore.db.controller import register_stored_file
+from tendril.filestore.db.controller import get_stored_file
+from tendril.filestore.db.controller import get_stored_file_with_owner
+from tendril.filestore.db.controller import insert_stored_file
+from tendril.filestore.db.controller import register_stored_files
 from tendril.filestore.db.controller import change_file_bucket
 from tendril.filestore.db.controller import delete_stored_file
 from tendril.filestore.db.controller import get_paginated_stored_files
+from tendril.filestore.db.controller import get_stored_files_page_json
+from tendril.filestore.db.controller import get_file_jobs
+from tendril.filestore.db.controller import stored_bytes
+from tendril.filestore.db.controller import has_usage
+from tendril.filestore.db.controller import rebuild_usage
+from tendril.filestore.db.controller import get_bucket_usage
+from tendril.filestore.db.controller import get_owner_usage
+from tendril.filestore.db.controller import get_owners_usage
 
 from tendril.utils.db import with_db
 from tendril.utils.db import get_session
@@ -24,18 +52,82 @@ from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
 
+# Spools are created private to this process. Files renamed into
+# the bucket from them should get the same mode as any other file.
+_umask = os.umask(0)
+os.umask(_umask)
+_file_mode = 0o666 & ~_umask
+
+
+class IngestSpool(object):
+    # Receives an upload as it streams in, hashing it on the way. When
+    # the spool lives on the bucket's own volume, the completed file can
+    # be renamed into place instead of being copied.
+    def __init__(self, directory=None):
+        fd, self._path = tempfile.mkstemp(dir=directory, prefix='spool-')
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    @property
+    def size(self):
+        return self._size
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._size += len(chunk)
+        self._file.write(chunk)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
 class FilestoreBucket(FilestoreBucketBase):
-    _exclude_filenames = []
+    # Files being written under a temporary name, and any left behind
+    # by writes which never completed.
+    _exclude_filenames = [
+        '.*.partial',
+    ]
 
     _exclude_directories = [
-        'lost+found'
+        'lost+found',
+        '.ingest',
     ]
 
+    _ingest_dirname = '.ingest'
+    _ingest_stale_age = 24 * 3600
+
     def __init__(self, *args, **kwargs):
         super(FilestoreBucket, self).__init__(*args, **kwargs)
         self._fs = None
+        self._ingest_dir = None
+        self._syncer = None
         self._create_in_db()
+        self._seed_usage()
         self._prep_fs()
+        self._sidecars = SidecarGenerator(self, self.sidecar_ext)
+        self._admission = UploadAdmission(
+            max_concurrent=self.max_concurrent_uploads,
+            max_bytes=self.max_upload_bytes_in_flight,
+            max_queue=self.upload_queue_length,
+            queue_timeout=self.upload_queue_timeout,
+        )
 
     def _prep_fs(self):
         if self._uri.startswith("osfs://"):
@@ -44,8 +136,30 @@ class FilestoreBucket(FilestoreBucketBase):
                 path = os.path.expanduser(path)
             path = os.path.normpath(path)
             os.makedirs(path, exist_ok=True)
+            self._ingest_dir = os.path.join(path, self._ingest_dirname)
+            os.makedirs(self._ingest_dir, exist_ok=True)
+            self._clean_ingest_dir()
+            if self.durability == durability.GROUP:
+                self._syncer = durability.GroupSyncer(path, window=self.group_fsync_window)
+        elif self.durability != durability.NONE:
+            logger.warning(f"Durability mode '{self.durability}' is only supported for "
+                           f"buckets on a local filesystem. Bucket {self.name} will "
+                           f"not be explicitly synced.")
         self._fs = open_fs(self._uri)
 
+    def _clean_ingest_dir(self):
+        # Other processes may be ingesting into the same directory, so
+        # only spools which have clearly been abandoned are removed.
+        threshold = time.time() - self._ingest_stale_age
+        for entry in os.scandir(self._ingest_dir):
+            if entry.is_file() and entry.stat().st_mtime < threshold:
+                logger.info(f"Removing stale ingest spool {entry.name} from bucket {self.name}")
+                os.remove(entry.path)
+
+    @property
+    def admission(self):
+        return self._admission
+
     @property
     def fs(self) -> OSFS:
         return self._fs
@@ -55,7 +169,8 @@ class FilestoreBucket(FilestoreBucketBase):
         self._id = b.id
 
     @with_db
-    def _prep_for_upload(self, bucket, filename, user, interest=None, overwrite=False, auto_prune=True, session=None):
+    def _prep_for_upload(self, bucket, filename, user, interest=None, overwrite=False, auto_prune=True,
+                         size=None, session=None):
         subdir, _ = os.path.split(filename)
         if subdir:
             bucket.fs.makedirs(subdir, recreate=True)
@@ -65,7 +180,7 @@ class FilestoreBucket(FilestoreBucketBase):
                 # We have no way to remove the existing file.
                 raise FileExistsError(f'{filename} already exists in the {bucket.name} bucket. Delete it first.')
             try:
-                owner = get_storedfile_owner(filename=filename, bucket=bucket.id, session=session)
+                sf, owner = get_stored_file_with_owner(filename, bucket.id, session=session)
             except NoResultFound:
                 # File exists in fs but not in the DB.
                 if not auto_prune:
@@ -74,7 +189,7 @@ class FilestoreBucket(FilestoreBucketBase):
                                           f"not in the database. This needs to be manually resolved.")
                 logger.warning(f"'{filename}' exists in the '{bucket.name}' filesystem but "
                                f"not in the database. Pruning. Possible Data Loss.")
-                bucket.fs.remove(filename)
+                bucket._remove_file(filename)
             else:
                 # File also exists in the database.
                 if not overwrite:
@@ -89,17 +204,124 @@ class FilestoreBucket(FilestoreBucketBase):
                     raise FileExistsError(f'{filename} already exists in the {bucket.name} bucket '
                                       f'and owned by someone else.')
                 logger.warning(f"Overwriting file {filename} in bucket {bucket.name}.")
-                bucket.delete(filename, user, interest, session=session)
+                # The existing file is left in place until the new one is
+                # renamed over it, so a failed write loses nothing.
+                delete_stored_file(filename, bucket.id, user, storedfile=sf, session=session)
+                bucket._sidecars.remove(filename)
+        if size is not None:
+            bucket._check_quota(user, size, session=session)
 
     @with_db
-    def upload(self, file, user, interest=None, label=None, overwrite=False, session=None):
-        filename = file.filename
-        self._prep_for_upload(self, filename, user, interest, overwrite, session=session)
+    def _check_quota(self, user, size, files=1, session=None):
+        # Quotas are checked against the logical size of the incoming
+        # file, which is an upper bound on what it will occupy once stored.
+        if self.quota_files is not None or self.quota_bytes is not None:
+            usage = get_bucket_usage(self.id, session=session)
+            if self.quota_files is not None and usage['file_count'] + files > self.quota_files:
+                raise OSError(errno.EDQUOT, f"The {self.name} bucket has reached its "
+                                            f"quota of {self.quota_files} files.")
+            if self.quota_bytes is not None and usage['total_bytes'] + size > self.quota_bytes:
+                raise OSError(errno.EDQUOT, f"Storing {size} bytes would exceed the "
+                                            f"{self.name} bucket's quota of {self.quota_bytes} bytes.")
+        if self.owner_quota_bytes is not None:
+            usage = get_owner_usage(self.id, user, session=session)
+            if usage['total_bytes'] + size > self.owner_quota_bytes:
+                raise OSError(errno.EDQUOT, f"Storing {size} bytes would exceed the per-owner "
+                                            f"quota of {self.owner_quota_bytes} bytes in the "
+                                            f"{self.name} bucket.")
 
-        with self._fs.open(filename, 'wb') as target:
-            logger.debug(f"Writing file {filename} to bucket {self.name}")
-            target.write(file.file.read())
+    @with_db
+    def usage(self, include_owners=False, session=None):
+        rv = {'bucket': self.name,
+              'usage': get_bucket_usage(self.id, session=session),
+              'quota': {'file_count': self.quota_files,
+                        'total_bytes': self.quota_bytes,
+                        'owner_total_bytes': self.owner_quota_bytes}}
+        if include_owners:
+            rv['owners'] = get_owners_usage(self.id, session=session)
+        return rv
 
+    @with_db
+    def rebuild_usage(self, session=None):
+        logger.info(f"Rebuilding usage counters for bucket {self.name}")
+        rebuild_usage(self.id, session=session)
+
+    def _seed_usage(self):
+        if has_usage(self.id):
+            return
+        logger.info(f"Seeding usage counters for bucket {self.name}")
+        try:
+            rebuild_usage(self.id)
+        except IntegrityError:
+            # Another process got there first.
+            pass
+
+    _chunk_size = 2 ** 20
+
+    def _write(self, source, filename):
+        # Files are written under a temporary name and renamed into place
+        # once complete, so the final name never refers to a partial file.
+        logger.debug(f"Writing file {filename} to bucket {self.name}")
+        if self._ingest_dir:
+            fd, path = tempfile.mkstemp(dir=self._ingest_dir, prefix='write-')
+            try:
+                with os.fdopen(fd, 'wb') as target:
+                    result = self._copy_into(source, target, filename)
+                self._commit(path, filename)
+            except BaseException:
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+            return result
+
+        subdir, name = os.path.split(filename)
+        partial = os.path.join(subdir, f'.{name}.{uuid.uuid4().hex}.partial')
+        try:
+            with self._fs.open(partial, 'wb') as target:
+                result = self._copy_into(source, target, filename)
+            self._fs.move(partial, filename, overwrite=True)
+        except BaseException:
+            if self._fs.exists(partial):
+                self._fs.remove(partial)
+            raise
+        return result
+
+    def _commit(self, path, filename):
+        # Moves a completed temporary file on the bucket's volume into
+        # place, making it as durable as the bucket has been asked to.
+        if self.durability == durability.FSYNC:
+            durability.fsync_path(path)
+        os.chmod(path, _file_mode)
+        target = self._fs.getsyspath(filename)
+        os.replace(path, target)
+        if self.durability == durability.FSYNC:
+            durability.fsync_path(os.path.dirname(target))
+        elif self.durability == durability.GROUP:
+            self._syncer.sync(target)
+
+    def _copy_into(self, source, target, filename):
+        # Streams the source into the target, hashing the logical content
+        # and compressing it on the way in if the bucket asks for it.
+        sha256hash = hashlib.sha256()
+        size = 0
+        encoding = None
+        if self.check_compresses(filename):
+            encoding = compression.ENCODING
+            sink = compression.compressing_writer(target, self.compress_level)
+        else:
+            sink = target
+        while True:
+            chunk = source.read(self._chunk_size)
+            if not chunk:
+                break
+            sha256hash.update(chunk)
+            size += len(chunk)
+            sink.write(chunk)
+        if encoding:
+            sink.close()
+        return sha256hash.hexdigest(), size, encoding
+
+    def _fileinfo(self, filename, sha256, size, encoding=None):
         info = self._fs.getinfo(filename, namespaces=['details'])
 
         created = info.created
@@ -110,38 +332,308 @@ class FilestoreBucket(FilestoreBucketBase):
         if modified:
             modified = info.modified.isoformat()
 
+        props = {'size': size, 'stored_size': info.size,
+                 'created': created, 'modified': modified}
+        if encoding:
+            props['encoding'] = encoding
+
+        return {'props': props,
+                'hash': {'sha256': sha256},
+                'ext': ''.join(info.suffixes)}
+
+    def _require_filename(self, filename):
+        if not self.check_filename(filename):
+            raise ValueError(f"{filename} is not a permitted filename in the {self.name} bucket")
+
+    @with_db
+    def upload(self, file, user, interest=None, label=None, overwrite=False, session=None):
+        filename = file.filename
+        self._require_filename(filename)
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
         file.file.seek(0)
-        sha256hash = hashlib.sha256()
-        chunk = 0
-        while True:
-            chunk = file.file.read(2**10)
-            if not chunk: break
-            sha256hash.update(chunk)
+        intent = self._begin_upload(filename, user, interest, label, overwrite)
+        with lock_files(session, (self, filename)):
+            with journal.refusable(session, intent):
+                self._prep_for_upload(self, filename, user, interest, overwrite,
+                                      size=size, session=session)
+
+            sha256, size, encoding = self._write(file.file, filename)
+            fileinfo = self._fileinfo(filename, sha256, size, encoding)
+
+            sf = insert_stored_file(filename, self._id, user, interest, fileinfo,
+                                    label=label, intent=intent, session=session)
+            self._after_write(filename, fileinfo, session=session)
+            self._publish_write(filename, fileinfo, session=session)
+            return sf
+
+    def _begin_upload(self, filename, user, interest, label, overwrite):
+        encoding = compression.ENCODING if self.check_compresses(filename) else None
+        return journal.begin(self, journal.UPLOAD, filename,
+                             user=user, interest=interest, label=label,
+                             overwrite=overwrite, encoding=encoding)
+
+    def _after_write(self, filename, fileinfo, session=None):
+        self._sidecars.generate(filename, fileinfo['props'].get('encoding'))
+        if self.processing_stages and session is not None:
+            processing.enqueue(self, filename, self.processing_stages, session=session)
+        if session is not None:
+            replication.record(self, filename, replication.PUT, session=session)
+
+    def _publish_write(self, filename, fileinfo, session=None, **data):
+        events.publish(self, events.UPLOAD, filename, session=session,
+                       sha256=fileinfo['hash']['sha256'], size=fileinfo['props']['size'],
+                       **data)
+
+    def _remove_file(self, filename):
+        self.fs.remove(filename)
+        self._sidecars.remove(filename)
 
-        fileinfo = {'props': {'size': info.size, 'created': created, 'modified': modified},
-                    'hash': {'sha256': sha256hash.hexdigest()},
-                    'ext': ''.join(info.suffixes)}
+    def spool(self):
+        return IngestSpool(directory=self._ingest_dir)
 
-        sf = register_stored_file(filename, self._id, user, interest, fileinfo,
-                                  label=label, session=session)
+    @with_db
+    def ingest(self, spool, filename, user, interest=None, label=None, overwrite=False, session=None):
+        # Completes an upload received into a spool from this bucket. On
+        # local buckets the spool is already on the bucket's volume and is
+        # renamed into place, so the content is written to disk only once.
+        self._require_filename(filename)
+        spool.close()
+        intent = self._begin_upload(filename, user, interest, label, overwrite)
+        with lock_files(session, (self, filename)):
+            with journal.refusable(session, intent):
+                self._prep_for_upload(self, filename, user, interest, overwrite,
+                                      size=spool.size, session=session)
+
+            if self._ingest_dir and not self.check_compresses(filename):
+                logger.debug(f"Ingesting file {filename} into bucket {self.name}")
+                self._commit(spool.path, filename)
+                sha256, size, encoding = spool.sha256, spool.size, None
+            else:
+                with open(spool.path, 'rb') as source:
+                    sha256, size, encoding = self._write(source, filename)
+                spool.discard()
 
-        return sf
+            fileinfo = self._fileinfo(filename, sha256, size, encoding)
+            sf = insert_stored_file(filename, self._id, user, interest, fileinfo,
+                                    label=label, intent=intent, session=session)
+            self._after_write(filename, fileinfo, session=session)
+            self._publish_write(filename, fileinfo, session=session)
+            return sf
 
     @with_db
-    def move(self, filename, target_bucket, user, overwrite=False, session=None):
-        if not self._fs.exists(filename):
-            raise FileNotFoundError(f"Move of nonexisting file {filename} "
-                                    f"from bucket {self.name} requested.")
+    def upload_archive(self, members, user, interest=None, label=None, overwrite=False, session=None):
+        # Extracts an archive into the bucket. members is an iterable of
+        # (filename, file object) pairs, such as archive.ArchiveMembers.
+        # Each member is written to a spool on the bucket's volume as it
+        # arrives, hashing it on the way. Nothing is locked or recorded
+        # until the whole archive has been received, after which the
+        # files are moved into place and registered together in one
+        # transaction. Returns the ids of the stored files by filename.
+        spools = {}
+        try:
+            for filename, source in members:
+                if filename in spools:
+                    raise ValueError(f"{filename} appears more than once in the archive")
+                self._require_filename(filename)
+                spool = spools[filename] = self.spool()
+                while True:
+                    chunk = source.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                spool.close()
+            return self._commit_archive(spools, user, interest, label, overwrite, session=session)
+        finally:
+            for spool in spools.values():
+                spool.discard()
+
+    def _commit_archive(self, spools, user, interest, label, overwrite, session=None):
+        filenames = sorted(spools.keys())
+        intents = journal.begin_batch(self, journal.UPLOAD, {
+            filename: {'user': user, 'interest': interest, 'label': label,
+                       'overwrite': overwrite,
+                       'encoding': compression.ENCODING if self.check_compresses(filename) else None}
+            for filename in filenames
+        })
+        with lock_files(session, *[(self, filename) for filename in filenames]):
+            with journal.refusable(session, *intents):
+                for filename in filenames:
+                    self._prep_for_upload(self, filename, user, interest, overwrite, session=session)
+                self._check_quota(user, sum(spool.size for spool in spools.values()),
+                                  files=len(filenames), session=session)
+
+            written = []
+            for filename in filenames:
+                spool = spools[filename]
+                if self._ingest_dir and not self.check_compresses(filename):
+                    self._commit(spool.path, filename)
+                    sha256, size, encoding = spool.sha256, spool.size, None
+                else:
+                    with open(spool.path, 'rb') as source:
+                        sha256, size, encoding = self._write(source, filename)
+                written.append((filename, self._fileinfo(filename, sha256, size, encoding)))
+
+            ids = register_stored_files(self._id, user, written, interest=interest,
+                                        label=label, session=session)
+            journal.clear_batch(intents, session=session)
+            for filename, fileinfo in written:
+                self._after_write(filename, fileinfo, session=session)
+                self._publish_write(filename, fileinfo, session=session)
+            return ids
 
-        self._prep_for_upload(target_bucket, filename, user, overwrite)
+    @with_db
+    def get_fileinfo(self, filename, session=None):
+        try:
+            sf = get_stored_file(filename=filename, bucket=self.id, session=session)
+        except NoResultFound:
+            raise FileNotFoundError(f"Requested file {filename} does not exist in "
+                                    f"the bucket {self.name}.")
+        return dict(sf.fileinfo or {})
+
+    def stored_encoding(self, filename):
+        # Reads the encoding of the stored file from the file itself,
+        # without the database. Files keep the form they were stored in
+        # when moved, copied, or when the bucket's settings change, so the
+        # bucket's present settings are no guide to it.
+        try:
+            with self._fs.openbin(filename) as fp:
+                head = fp.read(len(compression.MAGIC))
+        except (ResourceNotFound, FileExpected):
+            return None
+        return compression.stored_encoding(filename, head)
+
+    def open(self, filename, fileinfo=None):
+        # Returns a binary file object producing the logical content
+        # of the file, decompressing it if it is stored compressed.
+        if fileinfo is None:
+            fileinfo = get_stored_file(filename=filename, bucket=self.id).fileinfo
+        encoding = fileinfo['props'].get('encoding')
+        fp = self._fs.open(filename, 'rb')
+        if not encoding:
+            return fp
+        if encoding != compression.ENCODING:
+            fp.close()
+            raise ValueError(f"Unsupported stored encoding {encoding} "
+                             f"for {filename} in bucket {self.name}")
+        return compression.decompressing_reader(fp)
+
+    def iter_bytes(self, filename, fileinfo=None):
+        with self.open(filename, fileinfo=fileinfo) as fp:
+            while True:
+                chunk = fp.read(self._chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    @with_db
+    def move(self, filename, target_bucket, user, overwrite=False, session=None):
+        # Both ends are locked, so neither the file being moved nor the
+        # file it may replace can change underneath the move.
+        target_bucket._require_filename(filename)
+        intent = journal.begin(self, journal.MOVE, filename, target_bucket=target_bucket,
+                               user=user, overwrite=overwrite)
+        with lock_files(session, (self, filename), (target_bucket, filename)):
+            with journal.refusable(session, intent):
+                if not self._fs.exists(filename):
+                    raise FileNotFoundError(f"Move of nonexisting file {filename} "
+                                            f"from bucket {self.name} requested.")
+
+                fileinfo = get_stored_file(filename=filename, bucket=self.id, session=session).fileinfo
+                self._prep_for_upload(target_bucket, filename, user, overwrite=overwrite,
+                                      size=stored_bytes(fileinfo), session=session)
+
+            logger.debug(f"Moving file {filename} from bucket {self.name} to {target_bucket.name}")
+            move.move_file(self.fs, filename, target_bucket.fs, filename)
+            self._sidecars.remove(filename)
+            sf = change_file_bucket(filename, self.id, target_bucket.id, user, session=session)
+            replication.record(self, filename, replication.DELETE, session=session)
+            journal.clear(intent, session=session)
+            target_bucket._after_write(filename, sf.fileinfo, session=session)
+            events.publish(self, events.MOVE, filename, session=session,
+                           to_bucket=target_bucket.name)
+            return sf
 
-        logger.debug(f"Moving file {filename} from bucket {self.name} to {target_bucket.name}")
-        move.move_file(self.fs, filename, target_bucket.fs, filename)
-        return change_file_bucket(filename, self.id, target_bucket.id, user, session=session)
+    @with_db
+    def copy(self, filename, target_bucket, user, overwrite=False, session=None):
+        # The copy is a new stored file owned by user. Its content is the
+        # source's exactly as stored, so the source's hash and logical size
+        # are reused and nothing is read or rehashed.
+        if target_bucket.id == self.id:
+            raise ValueError(f"Cannot copy {filename} onto itself in bucket {self.name}.")
+        target_bucket._require_filename(filename)
+        # Recovered like an upload into the target, should it not
+        # complete. The intent is written ahead of the locks, from the
+        # source as it is then. The copy itself is made from the source
+        # as it is found under the locks.
+        intent = self._begin_copy(filename, target_bucket, user, overwrite)
+        with lock_files(session, (self, filename), (target_bucket, filename)):
+            with journal.refusable(session, intent):
+                if not self._fs.exists(filename):
+                    raise FileNotFoundError(f"Copy of nonexisting file {filename} "
+                                            f"from bucket {self.name} requested.")
+
+                sf = get_stored_file(filename=filename, bucket=self.id, session=session)
+                fileinfo, label, interest = dict(sf.fileinfo), sf.label, sf.interest_id
+                encoding = fileinfo['props'].get('encoding')
+                self._prep_for_upload(target_bucket, filename, user, interest, overwrite=overwrite,
+                                      size=stored_bytes(fileinfo), session=session)
+
+            logger.debug(f"Copying file {filename} from bucket {self.name} to {target_bucket.name}")
+            target_bucket._copy_in(self, filename)
+            fileinfo = target_bucket._fileinfo(filename, fileinfo['hash']['sha256'],
+                                               fileinfo['props']['size'], encoding)
+            copied = insert_stored_file(filename, target_bucket.id, user, interest, fileinfo,
+                                        label=label, intent=intent, session=session)
+            target_bucket._after_write(filename, fileinfo, session=session)
+            target_bucket._publish_write(filename, fileinfo, session=session,
+                                         source_bucket=self.name)
+            return copied
+
+    def _begin_copy(self, filename, target_bucket, user, overwrite):
+        try:
+            with get_session() as session:
+                sf = get_stored_file(filename=filename, bucket=self.id, session=session)
+                interest, label = sf.interest_id, sf.label
+                encoding = sf.fileinfo['props'].get('encoding')
+        except NoResultFound:
+            raise FileNotFoundError(f"Copy of nonexisting file {filename} "
+                                    f"from bucket {self.name} requested.")
+        return journal.begin(target_bucket, journal.UPLOAD, filename,
+                             user=user, interest=interest, label=label,
+                             overwrite=overwrite, encoding=encoding)
+
+    def _copy_in(self, source_bucket, filename):
+        # Places a copy of the stored form of a file from another bucket.
+        # Between buckets on local filesystems, the copy is made in the
+        # ingest directory by the cheapest means the filesystem offers,
+        # and renamed into place.
+        if self._ingest_dir and source_bucket._ingest_dir:
+            path = os.path.join(self._ingest_dir, f'copy-{uuid.uuid4().hex}')
+            method = clone.clone_file(source_bucket.fs.getsyspath(filename), path,
+                                      hardlink=self.hardlink_copies)
+            logger.debug(f"Copied {filename} into bucket {self.name} by {method}")
+            try:
+                self._commit(path, filename)
+            except BaseException:
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+            return
+
+        subdir, name = os.path.split(filename)
+        partial = os.path.join(subdir, f'.{name}.{uuid.uuid4().hex}.partial')
+        try:
+            copy_file(source_bucket.fs, filename, self._fs, partial)
+            self._fs.move(partial, filename, overwrite=True)
+        except BaseException:
+            if self._fs.exists(partial):
+                self._fs.remove(partial)
+            raise
 
     def _list(self, path='/', page=None):
         for f in self.fs.filterdir(path, page=page,
-                                   exclude_files=self._exclude_filenames,
+                                   exclude_files=self._exclude_filenames + self._sidecars.exclude_patterns,
                                    exclude_dirs=self._exclude_directories):
             yield f.name
 
@@ -159,32 +651,81 @@ class FilestoreBucket(FilestoreBucketBase):
             **kwargs
         )
 
+    def list_info_json(self, include_owner=False, filenames=None, page=1, size=50):
+        return get_stored_files_page_json(
+            bucket=self.id, page=page, size=size,
+            filenames=filenames, include_owner=include_owner
+        )
+
+    @with_db
+    def processing_status(self, filename, session=None):
+        return get_file_jobs(self.id, filename, session=session)
+
     @with_db
     def delete(self, filename, user, session=None):
-        if not self._fs.exists(filename):
-            raise FileNotFoundError(f"Delete of nonexisting file {filename} "
-                                    f"from bucket {self.name} requested.")
+        intent = journal.begin(self, journal.DELETE, filename, user=user)
+        with lock_files(session, (self, filename)):
+            with journal.refusable(session, intent):
+                if not self._fs.exists(filename):
+                    raise FileNotFoundError(f"Delete of nonexisting file {filename} "
+                                            f"from bucket {self.name} requested.")
+
+                if not self._allow_delete:
+                    _, owner = get_stored_file_with_owner(filename, self._id, session=session)
+                    if not self._check_ownership(owner, user):
+                        raise PermissionError(f"Deletion of file {filename} "
+                                              f"not permitted from bucket {self.name}")
+
+            logger.info(f"Deleting {filename} from bucket {self.name}")
+            self._delete(filename, user, intent, session=session)
+
+    def delete_batch(self, filenames, user):
+        # Each file is deleted in its own transaction, so one file which
+        # cannot be deleted does not hold back the rest of the batch.
+        deleted, failed = [], {}
+        for filename in filenames:
+            try:
+                with get_session() as session:
+                    self.delete(filename, user, session=session)
+            except (FileNotFoundError, PermissionError) as e:
+                failed[filename] = str(e)
+            else:
+                deleted.append(filename)
+        return {'deleted': deleted, 'failed': failed}
 
-        if not self._allow_delete:
-            owner = get_storedfile_owner(filename=filename, bucket=self._id, session=session)
-            if not self._check_ownership(owner, user):
-                raise PermissionError(f"Deletion of file {filename} "
-                                      f"not permitted from bucket {self.name}")
+    def _delete(self, filename, user, intent, session, publish=True):
+        with lock_files(session, (self, filename)):
+            self._remove_file(filename)
+            delete_stored_file(filename, self.id, user, session=session)
+            replication.record(self, filename, replication.DELETE, session=session)
+            journal.clear(intent, session=session)
+            if publish:
+                events.publish(self, events.DELETE, filename, session=session)
 
-        logger.info(f"Deleting {filename} from bucket {self.name}")
-        self.fs.remove(filename)
-        delete_stored_file(filename, self.id, user, session=session)
+    def replication_status(self):
+        return replication.status(self)
 
     def purge(self, user):
         if not self._allow_delete:
             raise PermissionError(f"Deletion of files from bucket {self.name} "
                                   f"is not permitted")
         logger.warning(f"Purging all files from bucket {self.name}")
-        for filename in self.list():
-            with get_session() as session:
-                logger.info(f"Deleting file {filename} from bucket {self.name}")
-                self.fs.remove(filename)
-                delete_stored_file(filename, self.id, user, session=session)
+        # Subscribers are sent a single event for the purge rather than
+        # one for each file.
+        # Files may be nested in folders, which list() does not descend into.
+        filenames = [path.lstrip('/') for path in self.fs.walk.files(
+            exclude=self._exclude_filenames + self._sidecars.exclude_patterns,
+            exclude_dirs=self._exclude_directories)]
+        count = 0
+        try:
+            for filename in filenames:
+                intent = journal.begin(self, journal.DELETE, filename, user=user)
+                with get_session() as session:
+                    logger.info(f"Deleting file {filename} from bucket {self.name}")
+                    self._delete(filename, user, intent, session=session, publish=False)
+                count += 1
+        finally:
+            events.publish(self, events.PURGE, count=count)
 
     def __repr__(self):
         return "<FilestoreBucket {} at {}>".format(self.name, self.uri)
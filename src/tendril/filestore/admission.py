@@ -0,0 +1,158 @@
+
+
+import time
+import asyncio
+from collections import deque
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, retry_after):
+        super(UploadRejected, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    __slots__ = ('future', 'nbytes')
+
+    def __init__(self, future, nbytes):
+        self.future = future
+        self.nbytes = nbytes
+
+
+class UploadAdmission(object):
+    # Limits the uploads being written into a bucket by this process, by
+    # count and by bytes in flight. Uploads over the limits wait in a
+    # queue which is served round robin across users, so one client
+    # sending a burst does not hold back everyone else. Once the queue is
+    # full, or an upload has waited too long, it is turned away with an
+    # estimate of when to retry.
+    _duration_weight = 0.2
+
+    def __init__(self, max_concurrent=None, max_bytes=None,
+                 max_queue=16, queue_timeout=30):
+        self._max_concurrent = max_concurrent
+        self._max_bytes = max_bytes
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._queues = OrderedDict()
+        self._waiting = 0
+        self._active = 0
+        self._bytes = 0
+        self._avg_duration = 1.0
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = 0
+
+    @property
+    def enabled(self):
+        return self._max_concurrent is not None or self._max_bytes is not None
+
+    def _fits(self, nbytes):
+        if self._max_concurrent is not None and self._active >= self._max_concurrent:
+            return False
+        if self._max_bytes is not None and self._active and \
+                self._bytes + nbytes > self._max_bytes:
+            # A single upload larger than the limit is let through on
+            # its own rather than never.
+            return False
+        return True
+
+    def _grant(self, nbytes):
+        self._active += 1
+        self._bytes += nbytes
+        self._admitted += 1
+
+    def _dispatch(self):
+        while self._queues:
+            for user, queue in self._queues.items():
+                if not self._fits(queue[0].nbytes):
+                    continue
+                waiter = queue.popleft()
+                self._waiting -= 1
+                self._grant(waiter.nbytes)
+                waiter.future.set_result(True)
+                # The user goes to the back of the line.
+                self._queues.move_to_end(user)
+                if not queue:
+                    del self._queues[user]
+                break
+            else:
+                return
+
+    def retry_after(self):
+        slots = self._max_concurrent or 1
+        backlog = self._waiting + self._active
+        return max(1, int(self._avg_duration * backlog / slots + 0.5))
+
+    def _reject(self, reason):
+        self._rejected += 1
+        raise UploadRejected(reason, self.retry_after())
+
+    async def acquire(self, user, nbytes=0):
+        if not self._queues and self._fits(nbytes):
+            self._grant(nbytes)
+            return
+        if self._waiting >= self._max_queue:
+            self._reject("Too many uploads are waiting for this bucket.")
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), nbytes)
+        self._queues.setdefault(user, deque()).append(waiter)
+        self._waiting += 1
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self._queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done():
+                # Admitted just as the wait ended. Hand the slot on.
+                self.release(nbytes)
+            else:
+                waiter.future.cancel()
+                self._withdraw(user, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject("Timed out waiting for upload capacity in this bucket.")
+
+    def _withdraw(self, user, waiter):
+        queue = self._queues[user]
+        queue.remove(waiter)
+        self._waiting -= 1
+        if not queue:
+            del self._queues[user]
+        # The waiter may have been holding back others behind it.
+        self._dispatch()
+
+    def release(self, nbytes=0, duration=None):
+        self._active -= 1
+        self._bytes -= nbytes
+        if duration is not None:
+            self._avg_duration += self._duration_weight * (duration - self._avg_duration)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, user, nbytes=0):
+        if not self.enabled:
+            yield
+            return
+        await self.acquire(user, nbytes)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(nbytes, time.monotonic() - start)
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'max_concurrent': self._max_concurrent,
+                'max_bytes': self._max_bytes,
+                'max_queue': self._max_queue,
+                'active': self._active,
+                'bytes_in_flight': self._bytes,
+                'waiting': self._waiting,
+                'admitted': self._admitted,
+                'queued': self._queued,
+                'rejected': self._rejected,
+                'avg_duration': self._avg_duration}
@@ -0,0 +1,287 @@
+
+
+import os
+import gzip
+import stat
+import errno
+import tarfile
+import zipfile
+import datetime
+import posixpath
+from anyio import from_thread
+
+from tendril import config
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+ZIP = 'zip'
+TAR = 'tar'
+TAR_GZ = 'tar.gz'
+
+FORMATS = {
+    ZIP: 'application/zip',
+    TAR: 'application/x-tar',
+    TAR_GZ: 'application/gzip',
+}
+
+
+class _Sink(object):
+    # Unseekable target which collects the archive as it is written, so
+    # that it can be sent on in pieces. The archive writers never need
+    # to go back over what they have written, so nothing is kept once it
+    # has been drained.
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_root(prefix):
+    # Files archived by prefix are named relative to the directory
+    # holding the prefix, so 'releases/v1.2/' unpacks into 'v1.2/'.
+    if not prefix:
+        return ''
+    parent = posixpath.dirname(prefix.rstrip('/'))
+    return f'{parent}/' if parent else ''
+
+
+def archive_name(bucket, prefix=None, fmt=ZIP):
+    name = posixpath.basename(prefix.rstrip('/')) if prefix else ''
+    return f'{name or bucket.name}.{fmt}'
+
+
+def _modified(fileinfo):
+    modified = fileinfo.get('props', {}).get('modified')
+    if modified:
+        try:
+            return datetime.datetime.fromisoformat(modified)
+        except ValueError:
+            pass
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _compresses(filename):
+    _, ext = os.path.splitext(filename)
+    return ext.lower() not in (config.FILESTORE_ARCHIVE_STORED_EXT or [])
+
+
+def _iter_zip(bucket, entries, root):
+    sink = _Sink()
+    # Written without seeking, so sizes and checksums follow each file
+    # in a data descriptor rather than preceding it.
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as zf:
+        for entry in entries:
+            filename, fileinfo = entry['filename'], entry['fileinfo']
+            # Zip timestamps cannot go back before 1980.
+            date_time = max(_modified(fileinfo).timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+            info = zipfile.ZipInfo(filename[len(root):], date_time=date_time)
+            info.external_attr = 0o644 << 16
+            info.file_size = fileinfo.get('props', {}).get('size') or 0
+            info.compress_type = zipfile.ZIP_DEFLATED if _compresses(filename) \
+                else zipfile.ZIP_STORED
+            with zf.open(info, 'w') as target:
+                for chunk in bucket.iter_bytes(filename, fileinfo=fileinfo):
+                    target.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+    yield sink.drain()
+
+
+def _iter_tar(bucket, entries, root, compress=False):
+    sink = _Sink()
+    target = gzip.GzipFile(fileobj=sink, mode='wb', mtime=0) if compress else sink
+    offset = 0
+    for entry in entries:
+        filename, fileinfo = entry['filename'], entry['fileinfo']
+        info = tarfile.TarInfo(filename[len(root):])
+        info.size = fileinfo.get('props', {}).get('size') or 0
+        info.mtime = int(_modified(fileinfo).timestamp())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        target.write(header)
+        written = 0
+        for chunk in bucket.iter_bytes(filename, fileinfo=fileinfo):
+            target.write(chunk)
+            written += len(chunk)
+            data = sink.drain()
+            if data:
+                yield data
+        if written != info.size:
+            # The header has already gone out with the recorded size.
+            # Stop rather than send a corrupt archive.
+            raise IOError(f"{filename} in bucket {bucket.name} is not the "
+                          f"recorded size. Was it changed while being archived?")
+        remainder = written % tarfile.BLOCKSIZE
+        if remainder:
+            target.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            written += tarfile.BLOCKSIZE - remainder
+        offset += len(header) + written
+    # End of archive, padded out to a whole record.
+    end = 2 * tarfile.BLOCKSIZE
+    remainder = (offset + end) % tarfile.RECORDSIZE
+    if remainder:
+        end += tarfile.RECORDSIZE - remainder
+    target.write(tarfile.NUL * end)
+    if compress:
+        target.close()
+    yield sink.drain()
+
+
+def iter_archive(bucket, entries, fmt=ZIP, root=''):
+    # Streams an archive of the given entries, as returned by
+    # bucket.archive_entries, reading each file from the bucket as it
+    # is reached. Memory use does not grow with the size or number of
+    # files.
+    if fmt == ZIP:
+        return _iter_zip(bucket, entries, root)
+    if fmt == TAR:
+        return _iter_tar(bucket, entries, root)
+    if fmt == TAR_GZ:
+        return _iter_tar(bucket, entries, root, compress=True)
+    raise ValueError(f"Unsupported archive format {fmt}")
+
+
+class MemberRejected(ValueError):
+    # An archive member which the bucket does not accept.
+    pass
+
+
+class BodyReader(object):
+    # Presents a request body, as an async stream of chunks, as a
+    # blocking file-like object. It must be read from a worker thread
+    # started with run_in_threadpool, which fetches each chunk from the
+    # event loop as it is needed, so the body is consumed as it arrives.
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _fetch(self):
+        try:
+            chunk = from_thread.run(self._stream.__anext__)
+        except StopAsyncIteration:
+            self._eof = True
+        else:
+            self._buffer.extend(chunk)
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fetch()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def member_name(name, prefix=None):
+    # Maps the name of an archive member to a filename in the bucket,
+    # refusing anything which would land outside of it.
+    if prefix:
+        name = f'{prefix}/{name}'
+    if '\x00' in name or name.startswith('/') or '\\' in name:
+        raise ValueError(f"Unsafe name {name!r} in archive")
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        raise ValueError(f"Unsafe name {name!r} in archive")
+    return '/'.join(parts)
+
+
+class _LimitedReader(object):
+    def __init__(self, source, members):
+        self._source = source
+        self._members = members
+
+    def read(self, size=-1):
+        data = self._source.read(size)
+        self._members._count_bytes(len(data))
+        return data
+
+
+class ArchiveMembers(object):
+    # Iterates over the regular files in a zip or tar archive as
+    # (filename, file object) pairs, each of which must be read before
+    # moving on to the next. Tar archives, compressed or not, are read
+    # as a stream. Zip archives keep their index at the end, so they
+    # must be given as a path to the complete archive.
+    #
+    # Directories are implied by the filenames. Links and other special
+    # members are not extracted, and are listed in skipped.
+    def __init__(self, source, fmt, prefix=None, accept=None,
+                 max_files=None, max_bytes=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported archive format {fmt}")
+        self._source = source
+        self._fmt = fmt
+        self._prefix = prefix.strip('/') if prefix else None
+        self._accept = accept
+        self._max_files = max_files
+        self._max_bytes = max_bytes
+        self._files = 0
+        self._bytes = 0
+        self.skipped = []
+
+    def _count_bytes(self, nbytes):
+        self._bytes += nbytes
+        if self._max_bytes is not None and self._bytes > self._max_bytes:
+            raise OSError(errno.EFBIG, f"Archive expands to more than the allowed "
+                                       f"{self._max_bytes} bytes.")
+
+    def _member(self, name, fileobj):
+        filename = member_name(name, self._prefix)
+        if self._accept is not None and not self._accept(filename):
+            raise MemberRejected(f"This bucket does not allow uploads with the "
+                                 f"extension of {filename}")
+        self._files += 1
+        if self._max_files is not None and self._files > self._max_files:
+            raise OSError(errno.EFBIG, f"Archive contains more than the allowed "
+                                       f"{self._max_files} files.")
+        return filename, _LimitedReader(fileobj, self)
+
+    def _iter_tar(self):
+        try:
+            with tarfile.open(fileobj=self._source, mode='r|*') as tf:
+                for member in tf:
+                    if member.isdir():
+                        continue
+                    if not member.isfile():
+                        self.skipped.append(member.name)
+                        continue
+                    yield self._member(member.name, tf.extractfile(member))
+        except tarfile.TarError as e:
+            raise ValueError(f"Unable to read the tar archive : {e}")
+
+    def _iter_zip(self):
+        try:
+            with zipfile.ZipFile(self._source) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    if stat.S_ISLNK(info.external_attr >> 16):
+                        self.skipped.append(info.filename)
+                        continue
+                    if info.flag_bits & 0x1:
+                        raise ValueError(f"{info.filename} in the zip archive is encrypted")
+                    with zf.open(info) as fileobj:
+                        yield self._member(info.filename, fileobj)
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"Unable to read the zip archive : {e}")
+
+    def __iter__(self):
+        if self._fmt == ZIP:
+            return self._iter_zip()
+        return self._iter_tar()
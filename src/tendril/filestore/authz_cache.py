@@ -0,0 +1,115 @@
+
+
+import time
+import threading
+from collections import OrderedDict
+
+from tendril import config
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+class AccessDecisionCache(object):
+    # Bounded LRU of (user, interest, permission) -> decision, with each
+    # decision expiring after a fixed TTL. Membership changes made
+    # elsewhere are picked up once the TTL lapses, or immediately if the
+    # invalidation hooks are called.
+    def __init__(self, maxsize=10000, ttl=60):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self):
+        return self._maxsize > 0 and self._ttl > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            decision, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return decision
+
+    def put(self, key, decision):
+        with self._lock:
+            self._entries[key] = (decision, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, user=None, interest=None):
+        with self._lock:
+            if user is None and interest is None:
+                count = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [k for k in self._entries
+                        if (user is None or k[0] == user) and
+                           (interest is None or k[1] == interest)]
+                for k in keys:
+                    del self._entries[k]
+                count = len(keys)
+            self._invalidations += count
+        return count
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'size': len(self._entries),
+                    'maxsize': self._maxsize,
+                    'ttl': self._ttl,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else None,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations,
+                    'invalidations': self._invalidations}
+
+
+_cache = AccessDecisionCache(maxsize=config.FILESTORE_AUTHZ_CACHE_SIZE,
+                             ttl=config.FILESTORE_AUTHZ_CACHE_TTL)
+
+
+def check_user_access(interest, user, permission):
+    interest_id = getattr(interest, 'id', None)
+    if not _cache.enabled or interest_id is None:
+        return interest.check_user_access(user, permission)
+    key = (user, interest_id, permission)
+    decision = _cache.get(key)
+    if decision is None:
+        decision = bool(interest.check_user_access(user, permission))
+        _cache.put(key, decision)
+    return decision
+
+
+def invalidate_user(user):
+    return _cache.invalidate(user=user)
+
+
+def invalidate_interest(interest):
+    return _cache.invalidate(interest=interest)
+
+
+def clear():
+    return _cache.invalidate()
+
+
+def stats():
+    return _cache.stats()
@@ -1,16 +1,28 @@
 
 
 import os
+from urllib.parse import urljoin
 from sqlalchemy.orm.exc import NoResultFound
 
+from tendril.filestore import authz_cache
+from tendril.filestore import signing
 from tendril.filestore.db.controller import get_stored_file
 from tendril.filestore.db.controller import get_storedfile_owner
+from tendril.filestore.db.controller import get_stored_files_with_owners
 from tendril.utils.db import with_db
 
 
 class FilestoreBucketBase(object):
+    _exclude_directories = []
+
     def __init__(self, uri, name, expose_uri=None,
-                 accept_ext=None, allow_delete=False, allow_overwrite=False):
+                 accept_ext=None, allow_delete=False, allow_overwrite=False,
+                 compress_ext=None, compress_level=3, sidecar_ext=None,
+                 processing_stages=None, durability='none', group_fsync_window=0.01,
+                 cache_control=None, quota_files=None, quota_bytes=None,
+                 owner_quota_bytes=None, replicas=None, max_concurrent_uploads=None,
+                 max_upload_bytes_in_flight=None, upload_queue_length=16,
+                 upload_queue_timeout=30, hardlink_copies=False):
         self._id = None
         self._uri = uri
         self._name = name
@@ -19,6 +31,22 @@ class FilestoreBucketBase(object):
         self._accept_ext = accept_ext or []
         self._allow_delete = allow_delete
         self._allow_overwrite = allow_overwrite
+        self._compress_ext = compress_ext or []
+        self._compress_level = compress_level
+        self._sidecar_ext = sidecar_ext or []
+        self._processing_stages = processing_stages or []
+        self._durability = durability
+        self._group_fsync_window = group_fsync_window
+        self._cache_control = cache_control
+        self._quota_files = quota_files
+        self._quota_bytes = quota_bytes
+        self._owner_quota_bytes = owner_quota_bytes
+        self._replicas = replicas or []
+        self._max_concurrent_uploads = max_concurrent_uploads
+        self._max_upload_bytes_in_flight = max_upload_bytes_in_flight
+        self._upload_queue_length = upload_queue_length
+        self._upload_queue_timeout = upload_queue_timeout
+        self._hardlink_copies = hardlink_copies
 
     @property
     def id(self):
@@ -36,6 +64,9 @@ class FilestoreBucketBase(object):
     def x_sendfile_prefix(self):
         return self._x_sendfile_prefix
 
+    def x_sendfile_path(self, filename):
+        return urljoin(self._x_sendfile_prefix, filename)
+
     @property
     def uri(self):
         return self._uri
@@ -52,16 +83,104 @@ class FilestoreBucketBase(object):
     def accept_ext(self):
         return self._accept_ext
 
+    @property
+    def compress_ext(self):
+        return self._compress_ext
+
+    @property
+    def compress_level(self):
+        return self._compress_level
+
+    @property
+    def sidecar_ext(self):
+        return self._sidecar_ext
+
+    @property
+    def processing_stages(self):
+        return self._processing_stages
+
+    @property
+    def durability(self):
+        return self._durability
+
+    @property
+    def group_fsync_window(self):
+        return self._group_fsync_window
+
+    @property
+    def cache_control(self):
+        return self._cache_control
+
+    @property
+    def quota_files(self):
+        return self._quota_files
+
+    @property
+    def quota_bytes(self):
+        return self._quota_bytes
+
+    @property
+    def owner_quota_bytes(self):
+        return self._owner_quota_bytes
+
+    @property
+    def replicas(self):
+        return self._replicas
+
+    @property
+    def max_concurrent_uploads(self):
+        return self._max_concurrent_uploads
+
+    @property
+    def max_upload_bytes_in_flight(self):
+        return self._max_upload_bytes_in_flight
+
+    @property
+    def upload_queue_length(self):
+        return self._upload_queue_length
+
+    @property
+    def upload_queue_timeout(self):
+        return self._upload_queue_timeout
+
+    @property
+    def hardlink_copies(self):
+        return self._hardlink_copies
+
     def check_accepts(self, filename):
         name, ext = os.path.splitext(filename)
         return ext in self._accept_ext
 
+    def check_filename(self, filename):
+        # Stored files need plain, normalized relative names. Hidden names
+        # belong to the bucket's own working files, such as spools and
+        # partial writes, as do the directories it excludes from listings.
+        if filename == '.' or filename.endswith('/') or not signing.is_safe_path(filename):
+            return False
+        return filename.split('/')[0] not in self._exclude_directories
+
+    def check_compresses(self, filename):
+        name, ext = os.path.splitext(filename)
+        return ext in self._compress_ext
+
+    def describe(self):
+        return {'accept_ext': self.accept_ext,
+                'allow_delete': self.allow_delete,
+                'allow_overwrite': self.allow_overwrite,
+                'expose_uri': self.expose_uri}
+
     def upload(self, file, user, interest=None, label=None, overwrite=False):
         raise NotImplementedError
 
+    def upload_archive(self, members, user, interest=None, label=None, overwrite=False):
+        raise NotImplementedError
+
     def move(self, filename, target_bucket, user, overwrite=False):
         raise NotImplementedError
 
+    def copy(self, filename, target_bucket, user, overwrite=False):
+        raise NotImplementedError
+
     def list(self, page=None):
         raise NotImplementedError
 
@@ -74,18 +193,24 @@ class FilestoreBucketBase(object):
     def delete(self, filename, user):
         raise NotImplementedError
 
+    def delete_batch(self, filenames, user):
+        raise NotImplementedError
+
     def purge(self, user):
         raise NotImplementedError
 
     def prune(self, user):
         raise NotImplementedError
 
+    def stored_encoding(self, filename):
+        raise NotImplementedError
+
     def _check_ownership(self, owner, user):
         if owner['user'].puid == user:
             return True
         if 'interest' not in owner.keys() or not owner['interest']:
             return False
-        if owner['interest'].check_user_access(user, 'delete_artefact'):
+        if authz_cache.check_user_access(owner['interest'], user, 'delete_artefact'):
             return True
         return False
 
@@ -94,12 +219,12 @@ class FilestoreBucketBase(object):
             return True
         if 'interest' not in owner.keys() or not owner['interest']:
             return False
-        if owner['interest'].check_user_access(user.id, 'read_artefacts'):
+        if authz_cache.check_user_access(owner['interest'], user.id, 'read_artefacts'):
             return True
         return False
 
     @with_db
-    def expose(self, filename, user, session=None):
+    def expose_info(self, filename, user, session=None):
 
         try:
             owner = get_storedfile_owner(filename=filename, bucket=self._id, session=session)
@@ -112,4 +237,57 @@ class FilestoreBucketBase(object):
                                   f"granted to user {user.id}")
 
         sf = get_stored_file(filename=filename, bucket=self.id, session=session)
-        return sf.x_sendfile_uri
+        return sf.x_sendfile_uri, dict(sf.fileinfo or {})
+
+    @with_db
+    def expose_batch(self, filenames, user, sign=False, ttl=None, session=None):
+        # With sign, the signature parameters for each file are included.
+        # A file whose name cannot be signed is reported as such, without
+        # failing the rest of the batch.
+        results = {filename: {'error': 'not_found'} for filename in filenames}
+        for sf in get_stored_files_with_owners(self.id, filenames, session=session):
+            if not self._check_access(sf['owner'], user):
+                results[sf['filename']] = {'error': 'forbidden'}
+                continue
+            result = {'uri': self.x_sendfile_path(sf['filename']),
+                      'fileinfo': sf['fileinfo']}
+            if sign:
+                try:
+                    result['signed'] = signing.sign(self.name, filepath=sf['filename'], ttl=ttl,
+                                                    encoding=sf['fileinfo'].get('props', {}).get('encoding'))
+                except ValueError:
+                    result = {'error': 'unsignable'}
+            results[sf['filename']] = result
+        return results
+
+    @with_db
+    def archive_entries(self, user, filenames=None, prefix=None, session=None):
+        # Access to every file is checked up front, in one query, so that
+        # an archive is refused before any of it is sent. Files named
+        # explicitly must all be readable. Files found under a prefix
+        # which the user may not read are left out of the archive.
+        if prefix:
+            # A prefix names a folder. Without the trailing slash, 'v1.2'
+            # would also pick up 'v1.2-beta/'.
+            prefix = prefix.rstrip('/')
+            prefix = f'{prefix}/' if prefix else None
+        rows = get_stored_files_with_owners(self.id, filenames=filenames,
+                                            prefix=prefix, session=session)
+        entries = []
+        for sf in rows:
+            if self._check_access(sf['owner'], user):
+                entries.append({'filename': sf['filename'], 'fileinfo': sf['fileinfo']})
+            elif filenames is not None:
+                raise PermissionError(f"Access to the file {sf['filename']} is not "
+                                      f"granted to user {user.id}")
+        if filenames is not None:
+            missing = set(filenames) - set(sf['filename'] for sf in rows)
+            if missing:
+                raise FileNotFoundError(f"Requested file {sorted(missing)[0]} does not "
+                                        f"exist in the bucket {self.name}.")
+        return entries
+
+    @with_db
+    def expose(self, filename, user, session=None):
+        uri, _ = self.expose_info(filename, user, session=session)
+        return uri
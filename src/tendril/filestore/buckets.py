@@ -2,15 +2,21 @@
 
 import asyncio
 from tendril import config
+from tendril.filestore import events
+from tendril.filestore import journal
+from tendril.filestore import processing
+from tendril.filestore import replication
+from tendril.filestore import ring
 from tendril.filestore.actual import FilestoreBucket
 from tendril.filestore.remote import FilestoreBucketRemote
-from tendril.filestore.remote import get_remote_bucket_list
+from tendril.filestore.remote import get_remote_discovery
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
 
 _available_buckets = {}
+_remote_discovery = None
 
 
 def available_buckets():
@@ -18,9 +24,21 @@ def available_buckets():
 
 
 def get_bucket(bucket_name):
+    if _remote_discovery is not None:
+        # Picks up buckets added to or removed from the remote filestore
+        # without a restart. The refresh, if due, happens in the
+        # background and applies to subsequent calls.
+        _remote_discovery.refresh_in_background()
     return _available_buckets[bucket_name]
 
 
+def get_bucket_by_id(bucket_id):
+    for bucket in _available_buckets.values():
+        if bucket.id == bucket_id:
+            return bucket
+    return None
+
+
 def _bucket_config(bucket_name):
     bucket_name = bucket_name.upper()
     enabled = getattr(config, "FILESTORE_{}_ENABLED".format(bucket_name))
@@ -32,22 +50,98 @@ def _bucket_config(bucket_name):
     return enabled, accept_ext, expose_uri, allow_delete, allow_overwrite, actual_uri
 
 
+def _bucket_options(bucket_name):
+    bucket_name = bucket_name.upper()
+    return {
+        'compress_ext': getattr(config, "FILESTORE_{}_COMPRESS_EXT".format(bucket_name)),
+        'compress_level': getattr(config, "FILESTORE_{}_COMPRESS_LEVEL".format(bucket_name)),
+        'sidecar_ext': getattr(config, "FILESTORE_{}_SIDECAR_EXT".format(bucket_name)),
+        'processing_stages': getattr(config, "FILESTORE_{}_PROCESSING_STAGES".format(bucket_name)),
+        'durability': getattr(config, "FILESTORE_{}_DURABILITY".format(bucket_name)),
+        'group_fsync_window': getattr(config, "FILESTORE_{}_GROUP_FSYNC_WINDOW".format(bucket_name)),
+        'cache_control': getattr(config, "FILESTORE_{}_CACHE_CONTROL".format(bucket_name)),
+        'quota_files': getattr(config, "FILESTORE_{}_QUOTA_FILES".format(bucket_name)),
+        'quota_bytes': getattr(config, "FILESTORE_{}_QUOTA_BYTES".format(bucket_name)),
+        'owner_quota_bytes': getattr(config, "FILESTORE_{}_OWNER_QUOTA_BYTES".format(bucket_name)),
+        'replicas': getattr(config, "FILESTORE_{}_REPLICAS".format(bucket_name)),
+        'max_concurrent_uploads': getattr(config, "FILESTORE_{}_MAX_CONCURRENT_UPLOADS".format(bucket_name)),
+        'max_upload_bytes_in_flight': getattr(config, "FILESTORE_{}_MAX_UPLOAD_BYTES_IN_FLIGHT".format(bucket_name)),
+        'upload_queue_length': getattr(config, "FILESTORE_{}_UPLOAD_QUEUE_LENGTH".format(bucket_name)),
+        'upload_queue_timeout': getattr(config, "FILESTORE_{}_UPLOAD_QUEUE_TIMEOUT".format(bucket_name)),
+        'hardlink_copies': getattr(config, "FILESTORE_{}_HARDLINK_COPIES".format(bucket_name)),
+    }
+
+
+def _remote_bucket_settings(bucket_name, remote_settings):
+    # Buckets disabled in the local configuration are not proxied. The
+    # remote filestore is otherwise authoritative for the behaviour of
+    # its buckets, with the local configuration used only to fill in
+    # what an older remote does not report.
+    settings = {'accept_ext': None, 'allow_delete': False,
+                'allow_overwrite': False, 'expose_uri': None}
+    if bucket_name in config.FILESTORE_BUCKETS:
+        enabled, accept_ext, expose_uri, allow_delete, allow_overwrite, _ = _bucket_config(bucket_name)
+        if not enabled:
+            return None
+        settings.update({'accept_ext': accept_ext, 'allow_delete': allow_delete,
+                         'allow_overwrite': allow_overwrite, 'expose_uri': expose_uri})
+    settings.update({k: v for k, v in remote_settings.items()
+                     if k in settings and v is not None})
+    if bucket_name in config.FILESTORE_BUCKETS and settings['expose_uri'] is None:
+        settings['expose_uri'] = _bucket_config(bucket_name)[2]
+    settings['accept_ext'] = settings['accept_ext'] or []
+    settings['expose_uri'] = settings['expose_uri'] or ''
+    return settings
+
+
+def _apply_remote_buckets(remote_buckets):
+    uri = ring.configured_nodes()[0]
+    for bucket_name in list(_available_buckets.keys()):
+        if bucket_name not in remote_buckets:
+            logger.info(f"Remote filestore bucket {bucket_name} is no longer available.")
+            _available_buckets.pop(bucket_name)
+    for bucket_name, remote_settings in remote_buckets.items():
+        settings = _remote_bucket_settings(bucket_name, remote_settings)
+        if settings is None:
+            continue
+        current = _available_buckets.get(bucket_name)
+        if current is not None and current.describe() == settings:
+            continue
+        logger.info(f"Creating proxy to the remote filestore bucket {bucket_name} at {uri}.")
+        _available_buckets[bucket_name] = FilestoreBucketRemote(
+            uri, bucket_name, settings['expose_uri'], settings['accept_ext'],
+            settings['allow_delete'], settings['allow_overwrite']
+        )
+
+
+async def refresh_remote():
+    if _remote_discovery is None:
+        return
+    await _remote_discovery.refresh()
+
+
 def init_remote():
-    if not config.FILESTORE_REMOTE_URI:
+    global _remote_discovery
+    nodes = ring.configured_nodes()
+    if not nodes:
         logger.warning("Filestore is not enabled and a remote filestore "
                        "has not been configured. Filestore operations "
                        "should be executed via the appropriate API on "
                        "the filestore component. ")
     else:
-        logger.info("Attempting to make a connection to the remote filestore.")
-        uri = config.FILESTORE_REMOTE_URI
-        remote_bucket_list = get_remote_bucket_list(uri)
-        for bucket_name in config.FILESTORE_BUCKETS:
-            enabled, accept_ext, expose_uri, allow_delete, allow_overwrite, _ = _bucket_config(bucket_name)
-            if enabled and bucket_name in remote_bucket_list:
-                logger.info(f"Creating proxy to the remote filestore bucket {bucket_name} at {uri}.")
-                bucket = FilestoreBucketRemote(uri, bucket_name, expose_uri, accept_ext, allow_delete, allow_overwrite)
-                _available_buckets[bucket_name] = bucket
+        # Every node carries the same bucket configuration, so the
+        # buckets are discovered from the first.
+        _remote_discovery = get_remote_discovery(nodes[0])
+        _remote_discovery.add_listener(_apply_remote_buckets)
+        remote_buckets = _remote_discovery.buckets
+        if remote_buckets is None:
+            # Nothing has been discovered yet. Assume the locally configured
+            # buckets exist until the first refresh says otherwise, rather
+            # than block startup on the network.
+            logger.info("Remote filestore buckets not yet discovered. "
+                        "Using the locally configured bucket list.")
+            remote_buckets = {name: {} for name in config.FILESTORE_BUCKETS}
+        _apply_remote_buckets(remote_buckets)
 
 
 def init_actual():
@@ -57,8 +151,15 @@ def init_actual():
             logger.debug("Bucket '{}' not enabled. Skipping.".format(bucket_name))
             continue
         logger.info("Creating filestore bucket '{}' at {}".format(bucket_name, actual_uri))
-        bucket = FilestoreBucket(actual_uri, bucket_name, expose_uri, accept_ext, allow_delete, allow_overwrite)
+        bucket = FilestoreBucket(actual_uri, bucket_name, expose_uri, accept_ext, allow_delete, allow_overwrite,
+                                 **_bucket_options(bucket_name))
         _available_buckets[bucket_name] = bucket
+    journal.recover(get_bucket_by_id, [b.id for b in _available_buckets.values()])
+    if any(b.processing_stages for b in _available_buckets.values()):
+        processing.init(get_bucket_by_id)
+    if any(b.replicas for b in _available_buckets.values()):
+        replication.init(get_bucket_by_id)
+    events.init()
 
 
 def init():
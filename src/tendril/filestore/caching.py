@@ -0,0 +1,80 @@
+
+
+import datetime
+from email.utils import format_datetime
+from email.utils import parsedate_to_datetime
+
+
+def etag(fileinfo, encoding=None):
+    # Strong validator derived from the content hash. Each content
+    # coding of the same file is a different representation, and gets
+    # its own tag.
+    try:
+        digest = fileinfo['hash']['sha256']
+    except (KeyError, TypeError):
+        return None
+    if encoding:
+        return f'"{digest}-{encoding}"'
+    return f'"{digest}"'
+
+
+def last_modified(fileinfo):
+    try:
+        modified = fileinfo['props']['modified']
+    except (KeyError, TypeError):
+        return None
+    if not modified:
+        return None
+    modified = datetime.datetime.fromisoformat(modified)
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=datetime.timezone.utc)
+    return modified.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+
+def validator_headers(fileinfo, encoding=None, cache_control=None):
+    headers = {}
+    tag = etag(fileinfo, encoding)
+    if tag:
+        headers['ETag'] = tag
+    modified = last_modified(fileinfo)
+    if modified:
+        headers['Last-Modified'] = format_datetime(modified, usegmt=True)
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    return headers
+
+
+def _weak_match(tags, tag):
+    tag = tag[2:] if tag.startswith('W/') else tag
+    for candidate in tags.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def is_not_modified(request_headers, fileinfo, encoding=None):
+    # If-None-Match takes precedence over If-Modified-Since when both
+    # are present (RFC 7232, section 6).
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match:
+        tag = etag(fileinfo, encoding)
+        return bool(tag) and _weak_match(if_none_match, tag)
+
+    if_modified_since = request_headers.get('if-modified-since')
+    if if_modified_since:
+        modified = last_modified(fileinfo)
+        if not modified:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return modified <= since
+    return False
@@ -0,0 +1,87 @@
+
+
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY_RANGE = 'copy_range'
+COPY = 'copy'
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors which mean the method is not available for this pair of files,
+# rather than that something is wrong with them.
+_unsupported = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+                errno.ENOTTY, errno.ENOSYS, errno.EPERM, errno.EMLINK}
+
+
+def _reflink(source_fd, target_fd):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Reflinks are not supported on this platform")
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def _copy_range(source_fd, target_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported on this platform")
+    remaining = size
+    while remaining > 0:
+        copied = os.copy_file_range(source_fd, target_fd, remaining)
+        if not copied:
+            break
+        remaining -= copied
+    if remaining:
+        raise OSError(errno.EIO, "copy_file_range ended before the end of the file")
+
+
+def clone_file(source, target, hardlink=False):
+    # Creates target, which must not exist, with the content of source,
+    # as cheaply as the filesystem allows. A hardlink shares the file
+    # itself, and is only used when asked for. A reflink shares the data
+    # blocks copy-on-write, and copy_file_range lets the kernel copy, or
+    # share, them without passing them through this process. A plain
+    # copy is the last resort. Returns the method used.
+    if hardlink:
+        try:
+            os.link(source, target)
+            return HARDLINK
+        except OSError as e:
+            if e.errno not in _unsupported:
+                raise
+
+    with open(source, 'rb') as src:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for method in (REFLINK, COPY_RANGE):
+                    try:
+                        if method == REFLINK:
+                            _reflink(src.fileno(), dst.fileno())
+                        else:
+                            _copy_range(src.fileno(), dst.fileno(),
+                                        os.fstat(src.fileno()).st_size)
+                        return method
+                    except OSError as e:
+                        if e.errno not in _unsupported:
+                            raise
+                        # Anything partially copied is discarded.
+                        dst.truncate(0)
+                        src.seek(0)
+                        dst.seek(0)
+                shutil.copyfileobj(src, dst, 2 ** 20)
+                return COPY
+        except BaseException:
+            os.remove(target)
+            raise
@@ -0,0 +1,72 @@
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+ENCODING = 'zstd'
+
+# Every zstd frame starts with this, so files stored compressed can be
+# recognized from their content alone.
+MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Files which are zstd streams in their own right, and which are stored
+# as they are. Their content starts with the same magic.
+_native_ext = ('.zst', '.zstd', '.tzst')
+
+
+def available():
+    return zstandard is not None
+
+
+def compressing_writer(target, level=3):
+    # The returned writer must be closed before the target is. The
+    # target itself is left open so the caller retains control over it.
+    if not available():
+        raise EnvironmentError("zstandard is not installed. Install "
+                               "tendril-filestore[compression] to use "
+                               "compressed buckets.")
+    cctx = zstandard.ZstdCompressor(level=level)
+    return cctx.stream_writer(target, closefd=False)
+
+
+def decompressing_reader(source):
+    if not available():
+        raise EnvironmentError("zstandard is not installed. Install "
+                               "tendril-filestore[compression] to read "
+                               "files from compressed buckets.")
+    dctx = zstandard.ZstdDecompressor()
+    return dctx.stream_reader(source, closefd=True)
+
+
+def stored_encoding(filename, head):
+    # The encoding of a stored file, given the first bytes of what is
+    # stored. For use where the file's recorded fileinfo is not at hand.
+    if head[:len(MAGIC)] != MAGIC:
+        return None
+    if filename.lower().endswith(_native_ext):
+        return None
+    return ENCODING
+
+
+def accepts_encoding(accept_encoding, encoding=ENCODING):
+    if not accept_encoding:
+        return False
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        if token.strip().lower() not in (encoding, '*'):
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        return True
+    return False
@@ -0,0 +1,223 @@
+
+
+import os
+import asyncio
+import hashlib
+import tempfile
+import threading
+
+from tendril import config
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+class ContentCache(object):
+    # Size bounded on-disk cache of file content, keyed by the SHA-256 of
+    # the content. Entries are immutable, so an entry which exists is
+    # always correct, and freshness reduces to knowing the current hash
+    # of the file. Fills are written to a temporary file and renamed into
+    # place, so processes sharing the cache directory can fill it
+    # concurrently. Least recently used entries, going by mtime, are
+    # evicted once the cache grows past its size.
+    _low_water = 0.9
+    _write_batch = 2 ** 20
+
+    def __init__(self, root, max_bytes):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._tmp_dir = os.path.join(root, '.tmp') if root else None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._prepare_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._total = None
+        self._hits = 0
+        self._misses = 0
+        self._fills = 0
+        self._evictions = 0
+        self._bytes_hit = 0
+        self._bytes_filled = 0
+
+    @property
+    def enabled(self):
+        return bool(self._root) and self._max_bytes > 0
+
+    def _path(self, sha256):
+        return os.path.join(self._root, sha256[:2], sha256)
+
+    def _scan(self):
+        entries = []
+        for prefix in os.scandir(self._root):
+            if not prefix.is_dir() or prefix.name.startswith('.'):
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def _prepare(self):
+        # Done once, under a lock of its own rather than the one lookups
+        # need, since it scans the whole cache.
+        with self._prepare_lock:
+            if self._total is not None:
+                return
+            os.makedirs(self._tmp_dir, exist_ok=True)
+            for entry in os.scandir(self._tmp_dir):
+                # Leftovers from fills which never completed.
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            total = sum(size for _, size, _ in self._scan())
+            with self._lock:
+                self._total = total
+
+    def _evict(self):
+        # The directory is rescanned rather than trusting the running
+        # total, since other processes fill and evict the same cache.
+        # Only one eviction runs at a time in each process, and it holds
+        # no lock which lookups need.
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = sorted(self._scan())
+            total = sum(size for _, size, _ in entries)
+            target = self._max_bytes * self._low_water
+            evicted = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            with self._lock:
+                self._total = total
+                self._evictions += evicted
+        finally:
+            self._evict_lock.release()
+
+    def get(self, sha256):
+        # Returns the path to the cached content, or None on a miss.
+        path = self._path(sha256)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+            self._bytes_hit += size
+        return path
+
+    def _begin_fill(self):
+        self._prepare()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir, prefix='fill-')
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def _complete_fill(self, tmp_path, sha256, size):
+        path = self._path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._fills += 1
+            self._bytes_filled += size
+            self._total += size
+            over = self._total > self._max_bytes
+        if over:
+            self._evict()
+        return path
+
+    @staticmethod
+    def _discard_fill(f, tmp_path):
+        f.close()
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    async def _fill(self, sha256, chunks):
+        # Runs on the event loop, so everything which touches the disk
+        # is handed to the default executor. Chunks are gathered and
+        # written a batch at a time to keep the handoffs few.
+        loop = asyncio.get_running_loop()
+        f, tmp_path = await loop.run_in_executor(None, self._begin_fill)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            batch = []
+            batch_size = 0
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                batch.append(chunk)
+                batch_size += len(chunk)
+                if batch_size >= self._write_batch:
+                    await loop.run_in_executor(None, f.write, b''.join(batch))
+                    batch = []
+                    batch_size = 0
+            if batch:
+                await loop.run_in_executor(None, f.write, b''.join(batch))
+            await loop.run_in_executor(None, f.close)
+            if digest.hexdigest() != sha256:
+                raise ValueError(f"Fetched content does not match the expected hash {sha256}. "
+                                 f"The file may have changed while it was being fetched.")
+            return await loop.run_in_executor(None, self._complete_fill, tmp_path, sha256, size)
+        except BaseException:
+            self._discard_fill(f, tmp_path)
+            raise
+
+    async def get_or_fill(self, sha256, fetch):
+        # Returns the path to the cached content, calling fetch() for an
+        # async iterator of the content on a miss. Concurrent requests for
+        # the same content within a process share a single fill.
+        path = self.get(sha256)
+        if path:
+            return path
+        loop = asyncio.get_running_loop()
+        pending = self._inflight.get(sha256)
+        if pending is not None and pending.get_loop() is loop:
+            return await asyncio.shield(pending)
+        pending = loop.create_task(self._fill(sha256, fetch()))
+        self._inflight[sha256] = pending
+        pending.add_done_callback(lambda task: self._forget(sha256, task))
+        return await asyncio.shield(pending)
+
+    def _forget(self, sha256, task):
+        if self._inflight.get(sha256) is task:
+            self._inflight.pop(sha256)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'enabled': self.enabled,
+                    'root': self._root,
+                    'max_bytes': self._max_bytes,
+                    'size': self._total,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else None,
+                    'fills': self._fills,
+                    'evictions': self._evictions,
+                    'bytes_hit': self._bytes_hit,
+                    'bytes_filled': self._bytes_filled}
+
+
+_cache = ContentCache(config.FILESTORE_REMOTE_CACHE_DIR,
+                      config.FILESTORE_REMOTE_CACHE_SIZE)
+
+
+def get_cache():
+    return _cache
+
+
+def stats():
+    return _cache.stats()
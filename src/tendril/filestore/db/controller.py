@@ -1,19 +1,51 @@
 
 
+import json
+import arrow
+import datetime
 from functools import partial
+from sqlalchemy import func
+from sqlalchemy import cast
 from sqlalchemy import select
+from sqlalchemy import insert
+from sqlalchemy import delete
+from sqlalchemy import literal
+from sqlalchemy import bindparam
+from sqlalchemy import event
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import Boolean
+from sqlalchemy import BigInteger
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import or_
 from fastapi_pagination.ext.sqlalchemy import paginate
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from tendril import config
 from tendril.utils.db import with_db
 from tendril.authn.db.model import User
 from tendril.authn.db.controller import preprocess_user
 from tendril.artefacts.db.controller import get_artefact_owner
+from tendril.artefacts.db.model import ArtefactModel
 from tendril.db.controllers.interests import preprocess_interest
 
 from .model import FilestoreBucketModel
 from .model import StoredFileModel
+from .model import FilestoreJobModel
+from .model import FilestoreIntentModel
+from .model import FilestoreReplicationEventModel
+from .model import FilestoreBucketUsageModel
+from .model import FilestoreOwnerUsageModel
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
@@ -123,6 +155,10 @@ def get_paginated_stored_files(bucket, pagination_params=None, filenames=None, i
         stmt = select(StoredFileModel.filename, StoredFileModel.fileinfo)\
             .filter(*filters)
 
+    # A stable order is needed for consecutive pages to neither skip
+    # nor repeat rows.
+    stmt = stmt.order_by(StoredFileModel.id)
+
     if pagination_params:
         return paginate(query=stmt, conn=session, unique=False,
                         params=pagination_params,
@@ -133,6 +169,244 @@ def get_paginated_stored_files(bucket, pagination_params=None, filenames=None, i
                                         include_owner=include_owner)
 
 
+def _json_dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+@with_db
+def get_stored_files_page_json(bucket, page=1, size=50, filenames=None, include_owner=False, session=None):
+    # Renders a page of the listing straight to JSON bytes. fileinfo is
+    # fetched from the database as JSON text and spliced in as is, so no
+    # per-item dicts or models are built on the way out.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    filters = [StoredFileModel.bucket_id == bucket_id]
+
+    if filenames:
+        filters.append(StoredFileModel.filename.in_(filenames))
+
+    total = session.execute(
+        select(func.count(StoredFileModel.id)).filter(*filters)
+    ).scalar()
+
+    columns = [StoredFileModel.filename, cast(StoredFileModel.fileinfo, Text)]
+    if include_owner:
+        stmt = select(*columns, User.puid)\
+            .join(StoredFileModel.user)
+    else:
+        stmt = select(*columns)
+    stmt = stmt.filter(*filters)\
+        .order_by(StoredFileModel.id)\
+        .offset((page - 1) * size)\
+        .limit(size)
+
+    items = []
+    for row in session.execute(stmt):
+        item = b'{"filename":' + _json_dumps(row[0]) + \
+               b',"fileinfo":' + (row[1].encode() if row[1] is not None else b'null')
+        if include_owner:
+            item += b',"puid":' + _json_dumps(row[2])
+        items.append(item + b'}')
+
+    pages = -(-total // size)
+    return b'{"items":[' + b','.join(items) + b'],' + \
+        b'"total":' + _json_dumps(total) + \
+        b',"page":' + _json_dumps(page) + \
+        b',"size":' + _json_dumps(size) + \
+        b',"pages":' + _json_dumps(pages) + b'}'
+
+
+@with_db
+def iter_stored_file_records(bucket, batch_size=1000, session=None):
+    # Streams every stored file in the bucket through a server-side
+    # cursor, so memory use does not depend on the size of the bucket.
+    # This is a generator, so the caller must provide a session which
+    # stays open for as long as the iterator is in use.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    stmt = select(StoredFileModel.filename,
+                  cast(StoredFileModel.fileinfo, Text),
+                  StoredFileModel.label,
+                  User.puid)\
+        .join(StoredFileModel.user)\
+        .filter(StoredFileModel.bucket_id == bucket_id)\
+        .order_by(StoredFileModel.id)\
+        .execution_options(stream_results=True)
+    result = session.execute(stmt).yield_per(batch_size)
+    for filename, fileinfo, label, puid in result:
+        yield {'filename': filename,
+               'fileinfo': json.loads(fileinfo) if fileinfo else {},
+               'label': label,
+               'puid': puid}
+
+
+def stored_bytes(fileinfo):
+    if not fileinfo:
+        return 0
+    props = fileinfo.get('props', {})
+    size = props.get('stored_size')
+    if size is None:
+        size = props.get('size')
+    return size or 0
+
+
+def _stored_bytes_expr(fileinfo_column):
+    props = cast(fileinfo_column, JSONB)['props']
+    return func.coalesce(cast(props['stored_size'].astext, BigInteger),
+                         cast(props['size'].astext, BigInteger), 0)
+
+
+def _upsert_usage(model, keys, rows):
+    # rows are dicts of the key columns and the increments to apply.
+    table = model.__table__
+    stmt = pg_insert(table).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={'file_count': table.c.file_count + stmt.excluded.file_count,
+              'total_bytes': table.c.total_bytes + stmt.excluded.total_bytes}
+    )
+
+
+_usage_info_key = 'filestore_usage'
+
+
+def _pending_usage(session, create=False):
+    pending = session.info.get(_usage_info_key)
+    if pending is None and create:
+        pending = session.info[_usage_info_key] = {'buckets': {}, 'owners': {}}
+        if not event.contains(session, 'before_commit', _apply_usage):
+            event.listen(session, 'before_commit', _apply_usage)
+            event.listen(session, 'after_rollback', _discard_usage)
+    return pending
+
+
+def _apply_usage(session):
+    pending = session.info.pop(_usage_info_key, None)
+    if not pending:
+        return
+    # Rows are locked in the order they are listed, so they are always
+    # listed in key order. Transactions which change the counters of
+    # several buckets, such as moves in opposite directions, then take
+    # their locks in the same order and cannot deadlock on them.
+    buckets = [{'bucket_id': bucket_id, 'file_count': files, 'total_bytes': nbytes}
+               for bucket_id, (files, nbytes) in sorted(pending['buckets'].items())
+               if files or nbytes]
+    owners = [{'bucket_id': bucket_id, 'user_id': user_id,
+               'file_count': files, 'total_bytes': nbytes}
+              for (bucket_id, user_id), (files, nbytes) in sorted(pending['owners'].items())
+              if files or nbytes]
+    stmts = []
+    if buckets:
+        stmts.append(_upsert_usage(FilestoreBucketUsageModel, ['bucket_id'], buckets))
+    if owners:
+        stmts.append(_upsert_usage(FilestoreOwnerUsageModel, ['bucket_id', 'user_id'], owners))
+    if not stmts:
+        return
+    stmt = stmts[0]
+    if len(stmts) > 1:
+        # Postgres runs an unreferenced CTE after the main statement, so
+        # the owner rows are always locked before the bucket rows.
+        stmt = stmts[1].add_cte(stmt.cte('bucket_usage'))
+    session.execute(stmt)
+
+
+def _discard_usage(session):
+    session.info.pop(_usage_info_key, None)
+
+
+@with_db
+def adjust_usage(bucket, user_id, files, nbytes, session=None):
+    # Increments are collected on the session and applied together, in
+    # one statement, just before it commits. The counters still always
+    # agree with the committed stored file rows, but the counter rows,
+    # which every change to the bucket shares, are only locked for the
+    # commit rather than for the whole of the operation.
+    if not files and not nbytes:
+        return
+    bucket_id = preprocess_bucket(bucket, session=session)
+    pending = _pending_usage(session, create=True)
+    keys = [(pending['buckets'], bucket_id)]
+    if user_id is not None:
+        keys.append((pending['owners'], (bucket_id, user_id)))
+    for counters, key in keys:
+        current = counters.get(key, (0, 0))
+        counters[key] = (current[0] + files, current[1] + nbytes)
+
+
+def _usage_dict(usage, pending=None):
+    # Includes any increments of the session which are yet to be applied.
+    files, nbytes = pending or (0, 0)
+    if usage is not None:
+        files += usage.file_count
+        nbytes += usage.total_bytes
+    return {'file_count': files, 'total_bytes': nbytes}
+
+
+@with_db
+def get_bucket_usage(bucket, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    usage = session.query(FilestoreBucketUsageModel)\
+        .filter_by(bucket_id=bucket_id).one_or_none()
+    pending = _pending_usage(session)
+    return _usage_dict(usage, pending and pending['buckets'].get(bucket_id))
+
+
+@with_db
+def get_owner_usage(bucket, user, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    user_id = _cached_user_id(user, session=session)
+    usage = session.query(FilestoreOwnerUsageModel)\
+        .filter_by(bucket_id=bucket_id, user_id=user_id).one_or_none()
+    pending = _pending_usage(session)
+    return _usage_dict(usage, pending and pending['owners'].get((bucket_id, user_id)))
+
+
+@with_db
+def get_owners_usage(bucket, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    q = session.query(FilestoreOwnerUsageModel, User.puid)\
+        .join(User, User.id == FilestoreOwnerUsageModel.user_id)\
+        .filter(FilestoreOwnerUsageModel.bucket_id == bucket_id)
+    return [dict(puid=puid, **_usage_dict(usage)) for usage, puid in q.all()]
+
+
+@with_db
+def has_usage(bucket, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    return session.query(FilestoreBucketUsageModel.id)\
+        .filter_by(bucket_id=bucket_id).first() is not None
+
+
+@with_db
+def rebuild_usage(bucket, session=None):
+    # Recomputes the counters from the stored file rows. This is a full
+    # scan of the bucket, needed only to seed the counters for buckets
+    # which predate them, or to repair them.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    size = _stored_bytes_expr(StoredFileModel.fileinfo)
+    rows = session.query(StoredFileModel.user_id,
+                         func.count(StoredFileModel.id),
+                         func.coalesce(func.sum(size), 0))\
+        .filter(StoredFileModel.bucket_id == bucket_id)\
+        .group_by(StoredFileModel.user_id)\
+        .all()
+
+    session.query(FilestoreOwnerUsageModel)\
+        .filter_by(bucket_id=bucket_id).delete(synchronize_session=False)
+    session.query(FilestoreBucketUsageModel)\
+        .filter_by(bucket_id=bucket_id).delete(synchronize_session=False)
+
+    total_files, total_bytes = 0, 0
+    for user_id, files, nbytes in rows:
+        session.add(FilestoreOwnerUsageModel(bucket_id=bucket_id, user_id=user_id,
+                                             file_count=files, total_bytes=nbytes))
+        total_files += files
+        total_bytes += nbytes
+    session.add(FilestoreBucketUsageModel(bucket_id=bucket_id, file_count=total_files,
+                                          total_bytes=total_bytes))
+    return {'file_count': total_files, 'total_bytes': total_bytes}
+
+
 @with_db
 def register_stored_file(filename, bucket, user, interest=None, fileinfo=None, overwrite=True, label=None, session=None):
     if not config.FILESTORE_ENABLED:
@@ -159,6 +433,7 @@ def register_stored_file(filename, bucket, user, interest=None, fileinfo=None, o
                                      interest_id=interest_id,
                                      type='stored_file',
                                      label=label)
+        adjust_usage(bucket_id, user_id, 1, stored_bytes(fileinfo), session=session)
         # TODO Create Log Entry?
     else:
         if not overwrite:
@@ -167,6 +442,9 @@ def register_stored_file(filename, bucket, user, interest=None, fileinfo=None, o
                              f"delete it from the database if this is something "
                              f"you really want to do.")
         else:
+            adjust_usage(bucket_id, existing.user_id, 0,
+                         stored_bytes(fileinfo) - stored_bytes(existing.fileinfo),
+                         session=session)
             existing.fileinfo = fileinfo
             storedfile = existing
             # TODO Create Log Entry?
@@ -174,6 +452,129 @@ def register_stored_file(filename, bucket, user, interest=None, fileinfo=None, o
     return storedfile
 
 
+_user_ids = {}
+_user_ids_max = 10000
+
+
+def _cached_user_id(user, session=None):
+    # User ids never change for a given puid, so the lookup is made once
+    # per process rather than once per upload.
+    if isinstance(user, int):
+        return user
+    if not isinstance(user, str):
+        return preprocess_user(user, session=session)
+    try:
+        return _user_ids[user]
+    except KeyError:
+        pass
+    user_id = preprocess_user(user, session=session)
+    if len(_user_ids) >= _user_ids_max:
+        _user_ids.clear()
+    _user_ids[user] = user_id
+    return user_id
+
+
+@with_db
+def insert_stored_file(filename, bucket_id, user, interest=None, fileinfo=None,
+                       label=None, intent=None, session=None):
+    # Registers an uploaded file in a single statement. The artefact and
+    # stored file rows are inserted and the upload's journal intent
+    # cleared in one round trip. The usage counters are adjusted along
+    # with everything else at commit. Any existing
+    # record of the file must already have been removed, as it is when an
+    # upload overwrites a file, so the new file always belongs to user.
+    # Returns a row with the id of the stored file.
+    if not config.FILESTORE_ENABLED:
+        raise EnvironmentError("Filestore not enabled on this component. "
+                               "Use the filestore API on the filestore component instead.")
+
+    if filename is None:
+        raise AttributeError("name cannot be None")
+
+    user_id = _cached_user_id(user, session=session)
+    interest_id = preprocess_interest(interest, session=session) if interest else None
+
+    sf_table = StoredFileModel.__table__
+    artefact_table = ArtefactModel.__table__
+
+    # Column defaults are not applied to an insert from a select, so
+    # those the ORM would have filled in are given here.
+    artefact = insert(artefact_table)\
+        .from_select(['type', 'user_id', 'interest_id', 'label', 'active', 'created_at'],
+                     select(literal('stored_file'),
+                            literal(user_id, Integer),
+                            literal(interest_id, Integer),
+                            literal(label, String),
+                            literal(True, Boolean),
+                            literal(arrow.utcnow(), artefact_table.c.created_at.type)))\
+        .returning(artefact_table.c.id)\
+        .cte('artefact')
+
+    ctes = [artefact]
+    if intent is not None:
+        intent_table = FilestoreIntentModel.__table__
+        ctes.append(delete(intent_table).where(intent_table.c.id == intent).cte('intent'))
+
+    stmt = insert(sf_table)\
+        .from_select(['id', 'filename', 'bucket_id', 'fileinfo'],
+                     select(artefact.c.id,
+                            literal(filename, String),
+                            literal(bucket_id, Integer),
+                            bindparam('fileinfo', fileinfo, type_=sf_table.c.fileinfo.type)))\
+        .returning(sf_table.c.id)
+    for cte in ctes:
+        stmt = stmt.add_cte(cte)
+
+    # Anything the ORM has pending for this file, such as the removal of
+    # an overwritten row, must reach the database first.
+    session.flush()
+    try:
+        rv = session.execute(stmt).one()
+    except IntegrityError:
+        raise FileExistsError(f"'{filename}' already exists in the database but not "
+                              f"in the filesystem. This needs to be manually resolved.")
+    adjust_usage(bucket_id, user_id, 1, stored_bytes(fileinfo), session=session)
+    return rv
+
+
+def _allocate_ids(table, count, session):
+    # Draws ids for a batch of new rows from the table's own sequence in
+    # one round trip, so the rows can then be inserted in bulk with their
+    # ids already known.
+    sequence = func.pg_get_serial_sequence(f'"{table.name}"', 'id')
+    q = select(func.nextval(sequence)).select_from(func.generate_series(1, count))
+    return list(session.execute(q).scalars())
+
+
+@with_db
+def register_stored_files(bucket, user, files, interest=None, label=None, session=None):
+    # Registers many new files, given as (filename, fileinfo) pairs, with
+    # a fixed number of statements regardless of how many there are. Any
+    # existing records for these files must already have been removed.
+    # Returns the ids of the stored files by filename.
+    if not config.FILESTORE_ENABLED:
+        raise EnvironmentError("Filestore not enabled on this component. "
+                               "Use the filestore API on the filestore component instead.")
+    if not files:
+        return {}
+
+    bucket_id = preprocess_bucket(bucket, session=session)
+    user_id = _cached_user_id(user, session=session)
+    interest_id = preprocess_interest(interest) if interest else None
+
+    session.flush()
+    ids = _allocate_ids(ArtefactModel.__table__, len(files), session)
+    session.execute(insert(ArtefactModel.__table__),
+                    [{'id': sf_id, 'type': 'stored_file', 'user_id': user_id,
+                      'interest_id': interest_id, 'label': label} for sf_id in ids])
+    session.execute(insert(StoredFileModel.__table__),
+                    [{'id': sf_id, 'filename': filename, 'bucket_id': bucket_id,
+                      'fileinfo': fileinfo} for sf_id, (filename, fileinfo) in zip(ids, files)])
+    adjust_usage(bucket_id, user_id, len(files),
+                 sum(stored_bytes(fileinfo) for _, fileinfo in files), session=session)
+    return {filename: sf_id for sf_id, (filename, _) in zip(ids, files)}
+
+
 @with_db
 def change_file_bucket(filename, bucket, target_bucket, user, interest=None, session=None):
     if not config.FILESTORE_ENABLED:
@@ -183,33 +584,336 @@ def change_file_bucket(filename, bucket, target_bucket, user, interest=None, ses
     storedfile: StoredFileModel = get_stored_file(filename=filename, bucket=bucket, session=session)
 
     target_bucket = preprocess_bucket(target_bucket)
+    source_bucket = storedfile.bucket_id
     storedfile.bucket_id = target_bucket
 
+    nbytes = stored_bytes(storedfile.fileinfo)
+    adjust_usage(source_bucket, storedfile.user_id, -1, -nbytes, session=session)
+    adjust_usage(target_bucket, storedfile.user_id, 1, nbytes, session=session)
+
+    # Pending processing follows the file to its new bucket.
+    session.query(FilestoreJobModel)\
+        .filter(FilestoreJobModel.filename == filename,
+                FilestoreJobModel.bucket_id == source_bucket,
+                FilestoreJobModel.status.in_(['pending', 'running']))\
+        .update({'bucket_id': target_bucket}, synchronize_session=False)
+
     # TODO Create Log Entry?
 
     session.add(storedfile)
     return storedfile
 
 
-@with_db
-def get_storedfile_owner(id=None, filename=None, bucket=None, session=None):
-    sf = get_stored_file(id=id, filename=filename, bucket=bucket, session=session)
-    user = get_artefact_owner(sf.id, session=None)
-    if not sf.interest:
+def _owner_from(user, interest_model):
+    if not interest_model:
         return {'user': user}
     try:
         from tendril.interests import type_codes
-        interest = type_codes[sf.interest.type](sf.interest, can_create=False)
+        interest = type_codes[interest_model.type](interest_model, can_create=False)
         return {'user': user, 'interest': interest}
     except ImportError:
         return {'user': user}
 
 
 @with_db
-def delete_stored_file(filename, bucket, user, session=None):
-    sf = get_stored_file(filename=filename, bucket=bucket, session=session)
+def get_stored_file_with_owner(filename, bucket, session=None):
+    # The stored file, with its owner and interest loaded in the same
+    # query.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    sf = session.query(StoredFileModel)\
+        .join(StoredFileModel.user)\
+        .options(contains_eager(StoredFileModel.user),
+                 joinedload(StoredFileModel.interest))\
+        .filter(StoredFileModel.bucket_id == bucket_id,
+                StoredFileModel.filename == filename)\
+        .one()
+    return sf, _owner_from(sf.user, sf.interest)
+
+
+@with_db
+def get_storedfile_owner(id=None, filename=None, bucket=None, session=None):
+    sf = get_stored_file(id=id, filename=filename, bucket=bucket, session=session)
+    user = get_artefact_owner(sf.id, session=None)
+    return _owner_from(user, sf.interest)
+
+
+@with_db
+def get_stored_files_with_owners(bucket, filenames=None, prefix=None, session=None):
+    # Loads the files, their owners and their interests in a single
+    # joined query, for checking access to many files at once.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    q = session.query(StoredFileModel)\
+        .join(StoredFileModel.user)\
+        .options(contains_eager(StoredFileModel.user),
+                 joinedload(StoredFileModel.interest))\
+        .filter(StoredFileModel.bucket_id == bucket_id)
+    if filenames is not None:
+        q = q.filter(StoredFileModel.filename.in_(filenames))
+    if prefix:
+        q = q.filter(StoredFileModel.filename.startswith(prefix, autoescape=True))
+    q = q.order_by(StoredFileModel.filename)
+    return [{'filename': sf.filename,
+             'fileinfo': dict(sf.fileinfo or {}),
+             'owner': _owner_from(sf.user, sf.interest)}
+            for sf in q.all()]
+
+
+@with_db
+def delete_stored_file(filename, bucket, user, storedfile=None, session=None):
+    sf = storedfile or get_stored_file(filename=filename, bucket=bucket, session=session)
 
     # TODO Create Log Entry and archive log?
 
+    session.query(FilestoreJobModel)\
+        .filter(FilestoreJobModel.filename == filename,
+                FilestoreJobModel.bucket_id == sf.bucket_id,
+                FilestoreJobModel.status.in_(['pending', 'running']))\
+        .delete(synchronize_session=False)
+    adjust_usage(sf.bucket_id, sf.user_id, -1, -stored_bytes(sf.fileinfo), session=session)
     session.delete(sf)
     return
+
+
+def _job_dict(job):
+    return {'id': job.id,
+            'bucket_id': job.bucket_id,
+            'filename': job.filename,
+            'stage': job.stage,
+            'status': job.status,
+            'attempts': job.attempts,
+            'params': dict(job.params or {}),
+            'result': job.result,
+            'error': job.error,
+            'created_at': job.created_at,
+            'updated_at': job.updated_at}
+
+
+@with_db
+def enqueue_job(bucket, filename, stage, params=None, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    job = FilestoreJobModel(bucket_id=bucket_id, filename=filename,
+                            stage=stage, status='pending', attempts=0,
+                            params=params)
+    session.add(job)
+    return job
+
+
+@with_db
+def claim_jobs(stages, limit=1, lease=300, max_attempts=None, session=None):
+    # Claimed jobs are leased rather than held. A worker which dies
+    # while running a job simply lets the lease expire, after which the
+    # job becomes claimable again. SKIP LOCKED keeps concurrent workers,
+    # in this process or any other, off each other's rows. A job whose
+    # lease has expired on its last allowed attempt is marked failed
+    # instead, so a job which keeps killing or hanging its worker is not
+    # retried forever.
+    now = func.now()
+    q = session.query(FilestoreJobModel)\
+        .filter(FilestoreJobModel.stage.in_(stages),
+                FilestoreJobModel.run_after <= now,
+                or_(FilestoreJobModel.status == 'pending',
+                    FilestoreJobModel.status == 'running'))\
+        .order_by(FilestoreJobModel.id)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)
+    claimed = []
+    for job in q.all():
+        if job.status == 'running' and max_attempts is not None \
+                and job.attempts >= max_attempts:
+            logger.warning(f"Processing job {job.id} for {job.filename} was abandoned "
+                           f"on its last allowed attempt. Marking it failed.")
+            job.status = 'failed'
+            job.error = f"Lease expired on attempt {job.attempts} of {max_attempts}"
+            continue
+        job.status = 'running'
+        job.attempts = job.attempts + 1
+        job.run_after = now + datetime.timedelta(seconds=lease)
+        claimed.append(job)
+    return [{'id': job.id,
+             'bucket_id': job.bucket_id,
+             'filename': job.filename,
+             'stage': job.stage,
+             'attempts': job.attempts,
+             'params': dict(job.params or {})} for job in claimed]
+
+
+@with_db
+def complete_job(job_id, result=None, session=None):
+    job = session.query(FilestoreJobModel).filter_by(id=job_id).one()
+    job.status = 'done'
+    job.result = result
+    job.error = None
+    try:
+        sf = get_stored_file(filename=job.filename, bucket=job.bucket_id, session=session)
+    except NoResultFound:
+        return
+    if sf.fileinfo is None:
+        sf.fileinfo = {}
+    sf.fileinfo.setdefault('stages', {})[job.stage] = result
+
+
+@with_db
+def fail_job(job_id, error, retry_after=None, session=None):
+    job = session.query(FilestoreJobModel).filter_by(id=job_id).one()
+    job.error = error
+    if retry_after is None:
+        job.status = 'failed'
+    else:
+        job.status = 'pending'
+        job.run_after = func.now() + datetime.timedelta(seconds=retry_after)
+
+
+@with_db
+def cancel_job(job_id, reason=None, session=None):
+    job = session.query(FilestoreJobModel).filter_by(id=job_id).one()
+    job.status = 'cancelled'
+    job.error = reason
+
+
+@with_db
+def get_file_jobs(bucket, filename, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    q = session.query(FilestoreJobModel)\
+        .filter_by(bucket_id=bucket_id, filename=filename)\
+        .order_by(FilestoreJobModel.id)
+    return [_job_dict(job) for job in q.all()]
+
+
+@with_db
+def create_intent(bucket, op, filename, owner, target_bucket=None, params=None, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    if target_bucket is not None:
+        target_bucket = preprocess_bucket(target_bucket, session=session)
+    intent = FilestoreIntentModel(bucket_id=bucket_id, op=op, filename=filename,
+                                  target_bucket_id=target_bucket, owner=owner,
+                                  params=params)
+    session.add(intent)
+    session.flush()
+    return intent.id
+
+
+@with_db
+def create_intents(bucket, op, owner, intents, session=None):
+    # Records intents for many files, given as (filename, params) pairs,
+    # in bulk. Returns their ids.
+    bucket_id = preprocess_bucket(bucket, session=session)
+    table = FilestoreIntentModel.__table__
+    ids = _allocate_ids(table, len(intents), session)
+    session.execute(insert(table),
+                    [{'id': intent_id, 'bucket_id': bucket_id, 'op': op, 'filename': filename,
+                      'target_bucket_id': None, 'owner': owner, 'params': params}
+                     for intent_id, (filename, params) in zip(ids, intents)])
+    return ids
+
+
+@with_db
+def clear_intent(intent_id, session=None):
+    session.query(FilestoreIntentModel)\
+        .filter_by(id=intent_id)\
+        .delete(synchronize_session=False)
+
+
+@with_db
+def clear_intents(intent_ids, session=None):
+    session.query(FilestoreIntentModel)\
+        .filter(FilestoreIntentModel.id.in_(intent_ids))\
+        .delete(synchronize_session=False)
+
+
+@with_db
+def get_pending_intents(buckets, session=None):
+    q = session.query(FilestoreIntentModel)\
+        .filter(FilestoreIntentModel.bucket_id.in_(buckets))\
+        .order_by(FilestoreIntentModel.id)
+    return [{'id': intent.id,
+             'bucket_id': intent.bucket_id,
+             'op': intent.op,
+             'filename': intent.filename,
+             'target_bucket_id': intent.target_bucket_id,
+             'params': dict(intent.params or {}),
+             'owner': intent.owner,
+             'created_at': intent.created_at} for intent in q.all()]
+
+
+@with_db
+def enqueue_replication_event(bucket, replica, op, filename, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    event = FilestoreReplicationEventModel(bucket_id=bucket_id, replica=replica,
+                                           op=op, filename=filename,
+                                           status='pending', attempts=0)
+    session.add(event)
+    return event
+
+
+@with_db
+def claim_replication_events(limit=100, lease=300, session=None):
+    # Leased in the same way as processing jobs, so events held by a
+    # worker which dies become claimable again once the lease expires.
+    now = func.now()
+    q = session.query(FilestoreReplicationEventModel)\
+        .filter(FilestoreReplicationEventModel.run_after <= now,
+                or_(FilestoreReplicationEventModel.status == 'pending',
+                    FilestoreReplicationEventModel.status == 'running'))\
+        .order_by(FilestoreReplicationEventModel.id)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)
+    events = q.all()
+    for row in events:
+        row.status = 'running'
+        row.attempts = row.attempts + 1
+        row.run_after = now + datetime.timedelta(seconds=lease)
+    return [{'id': row.id,
+             'bucket_id': row.bucket_id,
+             'replica': row.replica,
+             'op': row.op,
+             'filename': row.filename,
+             'attempts': row.attempts} for row in events]
+
+
+@with_db
+def complete_replication_events(event_ids, session=None):
+    # Applied events carry no further information, and are removed
+    # rather than kept, so the table holds only outstanding work.
+    session.query(FilestoreReplicationEventModel)\
+        .filter(FilestoreReplicationEventModel.id.in_(event_ids))\
+        .delete(synchronize_session=False)
+
+
+@with_db
+def retry_replication_events(event_ids, error, retry_after, session=None):
+    session.query(FilestoreReplicationEventModel)\
+        .filter(FilestoreReplicationEventModel.id.in_(event_ids))\
+        .update({'status': 'pending',
+                 'error': error,
+                 'run_after': func.now() + datetime.timedelta(seconds=retry_after)},
+                synchronize_session=False)
+
+
+@with_db
+def get_replication_status(bucket, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    q = session.query(FilestoreReplicationEventModel.replica,
+                      func.count(FilestoreReplicationEventModel.id),
+                      func.min(FilestoreReplicationEventModel.created_at),
+                      func.max(FilestoreReplicationEventModel.attempts),
+                      func.extract('epoch', func.now() - func.min(FilestoreReplicationEventModel.created_at)))\
+        .filter(FilestoreReplicationEventModel.bucket_id == bucket_id)\
+        .group_by(FilestoreReplicationEventModel.replica)
+    return {replica: {'pending': count,
+                      'oldest_pending': oldest,
+                      'max_attempts': attempts,
+                      'lag': float(lag or 0)}
+            for replica, count, oldest, attempts, lag in q.all()}
+
+
+@with_db
+def get_replication_errors(bucket, replica, limit=10, session=None):
+    bucket_id = preprocess_bucket(bucket, session=session)
+    q = session.query(FilestoreReplicationEventModel.filename,
+                      FilestoreReplicationEventModel.error)\
+        .filter(FilestoreReplicationEventModel.bucket_id == bucket_id,
+                FilestoreReplicationEventModel.replica == replica,
+                FilestoreReplicationEventModel.error.isnot(None))\
+        .order_by(FilestoreReplicationEventModel.id)\
+        .limit(limit)
+    return [{'filename': filename, 'error': error} for filename, error in q.all()]
@@ -1,16 +1,22 @@
 
 
 from urllib.parse import urljoin
+from sqlalchemy import func
 from sqlalchemy import Column
 from sqlalchemy import String
+from sqlalchemy import Text
 from sqlalchemy import Integer
+from sqlalchemy import BigInteger
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy_json import mutable_json_type
 from sqlalchemy.dialects.postgresql import JSONB
 
 from tendril.artefacts.db.model import ArtefactModel
+from tendril.authn.db.model import User
 
 from tendril.utils.db import DeclBase
 from tendril.utils.db import BaseMixin
@@ -57,3 +63,78 @@ class StoredFileModel(ArtefactModel):
         UniqueConstraint('filename', 'bucket_id'),
     )
 
+
+class FilestoreJobModel(DeclBase, BaseMixin):
+    bucket_id = Column(Integer(),
+                       ForeignKey('FilestoreBucket.id'), nullable=False)
+    filename = Column(String(255), nullable=False)
+    stage = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    params = Column(mutable_json_type(dbtype=JSONB, nested=True))
+    result = Column(mutable_json_type(dbtype=JSONB, nested=True))
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(),
+                        onupdate=func.now())
+    # Earliest time the job may be claimed. For running jobs, this is
+    # the expiry of the claim, after which another worker may take over.
+    run_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    bucket = relationship("FilestoreBucketModel")
+
+    __table_args__ = (
+        Index('ix_FilestoreJob_claim', 'status', 'run_after'),
+        Index('ix_FilestoreJob_file', 'bucket_id', 'filename'),
+    )
+
+
+class FilestoreReplicationEventModel(DeclBase, BaseMixin):
+    bucket_id = Column(Integer(),
+                       ForeignKey('FilestoreBucket.id'), nullable=False)
+    # Identifies the replica without recording its URI, which may carry
+    # credentials.
+    replica = Column(String(16), nullable=False)
+    op = Column(String(20), nullable=False)
+    filename = Column(String(255), nullable=False)
+    status = Column(String(20), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    run_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    bucket = relationship("FilestoreBucketModel")
+
+    __table_args__ = (
+        Index('ix_FilestoreReplicationEvent_claim', 'status', 'run_after'),
+        Index('ix_FilestoreReplicationEvent_replica', 'bucket_id', 'replica', 'created_at'),
+    )
+
+
+class FilestoreIntentModel(DeclBase, BaseMixin):
+    bucket_id = Column(Integer(),
+                       ForeignKey('FilestoreBucket.id'), nullable=False)
+    op = Column(String(20), nullable=False)
+    filename = Column(String(255), nullable=False)
+    target_bucket_id = Column(Integer(),
+                              ForeignKey('FilestoreBucket.id'), nullable=True)
+    params = Column(mutable_json_type(dbtype=JSONB, nested=True))
+    owner = Column(String(255), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class FilestoreBucketUsageModel(DeclBase, BaseMixin):
+    bucket_id = Column(Integer(),
+                       ForeignKey('FilestoreBucket.id'), nullable=False, unique=True)
+    file_count = Column(BigInteger, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+
+
+class FilestoreOwnerUsageModel(DeclBase, BaseMixin):
+    bucket_id = Column(Integer(),
+                       ForeignKey('FilestoreBucket.id'), nullable=False)
+    user_id = Column(Integer(), ForeignKey(User.id), nullable=False)
+    file_count = Column(BigInteger, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('bucket_id', 'user_id'),
+    )
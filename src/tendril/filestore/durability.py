@@ -0,0 +1,105 @@
+
+
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+NONE = 'none'
+FSYNC = 'fsync'
+GROUP = 'group'
+
+MODES = [NONE, FSYNC, GROUP]
+
+
+def _load_syncfs():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        syncfs = libc.syncfs
+    except (OSError, AttributeError, TypeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    syncfs.restype = ctypes.c_int
+    return syncfs
+
+
+_syncfs = _load_syncfs()
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_file_and_dir(path):
+    fsync_path(path)
+    fsync_path(os.path.dirname(path))
+
+
+class _Batch(object):
+    def __init__(self):
+        self.paths = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupSyncer(object):
+    # Coalesces durability requests arriving within a short window into
+    # a single flush. The first writer into an empty window waits out the
+    # window and then flushes on behalf of everyone who joined it. Where
+    # syncfs is available, one call covers the whole batch, file data and
+    # directory entries alike.
+    def __init__(self, root, window=0.01):
+        self._root = root
+        self._window = window
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def sync(self, path):
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.paths.append(path)
+
+        if leader:
+            time.sleep(self._window)
+            with self._lock:
+                self._batch = None
+            try:
+                self._flush(batch.paths)
+            except OSError as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+
+    def _flush(self, paths):
+        if _syncfs is not None:
+            fd = os.open(self._root, os.O_RDONLY)
+            try:
+                if _syncfs(fd) != 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno), self._root)
+            finally:
+                os.close(fd)
+            return
+        dirs = set()
+        for path in paths:
+            fsync_path(path)
+            dirs.add(os.path.dirname(path))
+        for d in dirs:
+            fsync_path(d)
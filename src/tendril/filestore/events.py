@@ -0,0 +1,252 @@
+
+
+import json
+import uuid
+import select
+import asyncio
+import datetime
+import threading
+from collections import deque
+from sqlalchemy import func
+from sqlalchemy import event
+from sqlalchemy import select as sql_select
+
+from tendril import config
+from tendril.utils.db import get_session
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+UPLOAD = 'upload'
+MOVE = 'move'
+DELETE = 'delete'
+PURGE = 'purge'
+
+PROCESS = 'process'
+POSTGRES = 'postgres'
+
+_channel = 'filestore_events'
+
+
+class Subscription(object):
+    # A subscriber's view of the feed, consumed from its own event loop.
+    # A subscriber which falls too far behind is cut off rather than
+    # allowed to hold events without bound. It then receives None, and
+    # should start over from a fresh listing.
+    def __init__(self, feed, buckets, loop, max_pending):
+        self._feed = feed
+        self._buckets = buckets
+        self._loop = loop
+        self._max_pending = max_pending
+        self._queue = asyncio.Queue()
+        self._overflowed = False
+        self.reset = False
+
+    def wants(self, event):
+        if self._buckets is None:
+            return True
+        return event['bucket'] in self._buckets or event.get('to_bucket') in self._buckets
+
+    def offer(self, event):
+        # May be called from any thread.
+        if not self.wants(event):
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The subscriber's loop has gone away.
+            self._feed.unsubscribe(self)
+
+    def _put(self, event):
+        if self._overflowed:
+            return
+        if self._queue.qsize() >= self._max_pending:
+            logger.warning("Dropping a filestore change feed subscriber which fell behind")
+            self._overflowed = True
+            self._feed.unsubscribe(self)
+            event = None
+        self._queue.put_nowait(event)
+
+    async def get(self):
+        return await self._queue.get()
+
+    def close(self):
+        self._feed.unsubscribe(self)
+
+
+class ChangeFeed(object):
+    # Broadcasts bucket change events to the subscribers in this process.
+    # Each event is given an id, and recent events are kept so that a
+    # subscriber reconnecting with the last id it saw misses nothing. Ids
+    # carry an epoch unique to this feed, so an id from another process,
+    # or from before a restart, is recognized as one which cannot be
+    # resumed from.
+    def __init__(self, backlog=1000, max_pending=1000):
+        self._epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._backlog = deque(maxlen=backlog)
+        self._max_pending = max_pending
+        self._subscribers = set()
+
+    def dispatch(self, event):
+        with self._lock:
+            self._seq += 1
+            event = dict(event, id=f'{self._epoch}-{self._seq}')
+            self._backlog.append((self._seq, event))
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.offer(event)
+
+    def _parse_id(self, event_id):
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self._epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def subscribe(self, buckets=None, last_event_id=None):
+        subscription = Subscription(self, set(buckets) if buckets else None,
+                                    asyncio.get_running_loop(), self._max_pending)
+        with self._lock:
+            if last_event_id:
+                seq = self._parse_id(last_event_id)
+                oldest = self._backlog[0][0] if self._backlog else self._seq + 1
+                if seq is None or seq < oldest - 1:
+                    # Events since then are no longer known.
+                    subscription.reset = True
+                else:
+                    for event_seq, past in self._backlog:
+                        if event_seq > seq and subscription.wants(past):
+                            subscription._queue.put_nowait(past)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': config.FILESTORE_EVENTS_BACKEND,
+                    'subscribers': len(self._subscribers),
+                    'published': self._seq,
+                    'backlog': len(self._backlog)}
+
+
+class _PostgresListener(object):
+    # Receives events published by any process through Postgres NOTIFY,
+    # on a connection of its own, and dispatches them to the local feed.
+    # Requires psycopg2.
+    def __init__(self, feed, retry_interval=5):
+        self._feed = feed
+        self._retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='filestore-events-listener')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Filestore change feed listener failed : {e}")
+                self._stop.wait(self._retry_interval)
+
+    def _listen(self):
+        with get_session() as session:
+            engine = session.get_bind()
+        raw = engine.raw_connection()
+        # Kept out of the pool, since it is switched to autocommit.
+        raw.detach()
+        conn = getattr(raw, 'dbapi_connection', None) or raw.connection
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {_channel}')
+            logger.info("Listening for filestore change events")
+            while not self._stop.is_set():
+                if select.select([conn], [], [], self._retry_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        self._feed.dispatch(json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning(f"Ignoring malformed filestore change event {notify.payload!r}")
+        finally:
+            conn.close()
+
+
+_feed = ChangeFeed(backlog=config.FILESTORE_EVENTS_BACKLOG,
+                   max_pending=config.FILESTORE_EVENTS_MAX_PENDING)
+_listener = None
+
+_info_key = 'filestore_events'
+
+
+def _flush(session):
+    for e in session.info.pop(_info_key, []):
+        _feed.dispatch(e)
+
+
+def _discard(session):
+    session.info.pop(_info_key, None)
+
+
+def publish(bucket, kind, filename=None, session=None, **data):
+    # Events published within a transaction are only delivered if and
+    # when it commits. With the postgres backend, they are sent with
+    # NOTIFY, which Postgres itself holds until the commit and then
+    # delivers to every process, this one included.
+    e = {'type': kind, 'bucket': bucket.name, 'filename': filename,
+         'time': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    e.update(data)
+
+    if config.FILESTORE_EVENTS_BACKEND == POSTGRES:
+        if session is None:
+            with get_session() as session:
+                session.execute(sql_select(func.pg_notify(_channel, json.dumps(e))))
+        else:
+            session.execute(sql_select(func.pg_notify(_channel, json.dumps(e))))
+        return
+
+    if session is None:
+        _feed.dispatch(e)
+        return
+    pending = session.info.get(_info_key)
+    if pending is None:
+        pending = session.info[_info_key] = []
+        if not event.contains(session, 'after_commit', _flush):
+            event.listen(session, 'after_commit', _flush)
+            event.listen(session, 'after_rollback', _discard)
+    pending.append(e)
+
+
+def subscribe(buckets=None, last_event_id=None):
+    return _feed.subscribe(buckets=buckets, last_event_id=last_event_id)
+
+
+def stats():
+    return _feed.stats()
+
+
+def init():
+    global _listener
+    if config.FILESTORE_EVENTS_BACKEND != POSTGRES or _listener is not None:
+        return
+    _listener = _PostgresListener(_feed)
+    _listener.start()
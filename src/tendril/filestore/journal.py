@@ -0,0 +1,205 @@
+
+
+import os
+import socket
+import hashlib
+import datetime
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.orm.exc import NoResultFound
+
+from tendril import config
+from tendril.utils.db import get_session
+from tendril.filestore import replication
+from tendril.filestore.db.controller import create_intent
+from tendril.filestore.db.controller import create_intents
+from tendril.filestore.db.controller import clear_intent
+from tendril.filestore.db.controller import clear_intents
+from tendril.filestore.db.controller import get_pending_intents
+from tendril.filestore.db.controller import get_stored_file
+from tendril.filestore.db.controller import register_stored_file
+from tendril.filestore.db.controller import change_file_bucket
+from tendril.filestore.db.controller import delete_stored_file
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+UPLOAD = 'upload'
+MOVE = 'move'
+DELETE = 'delete'
+
+_hostname = socket.gethostname()
+
+
+def _owner():
+    return f"{_hostname}:{os.getpid()}"
+
+
+def begin(bucket, op, filename, target_bucket=None, **params):
+    # Intents are committed on their own before the filesystem is
+    # touched. The operation clears its intent in the same transaction
+    # that records its outcome in the database, so an intent which
+    # survives marks an operation whose database step never committed.
+    #
+    # Operations begin their intents before taking their file locks.
+    # Locking pins the operation's connection, and an intent written
+    # after that would need a second one from the pool while the first
+    # is held.
+    with get_session() as session:
+        return create_intent(bucket.id, op, filename, _owner(),
+                             target_bucket=target_bucket.id if target_bucket else None,
+                             params=params, session=session)
+
+
+def begin_batch(bucket, op, params):
+    # As begin, for many files at once. params maps each filename to the
+    # params of its intent. Each file still gets an intent of its own, so
+    # recovery need not know they were part of a batch.
+    with get_session() as session:
+        return create_intents(bucket.id, op, _owner(), list(params.items()),
+                              session=session)
+
+
+_abandoned_info_key = 'filestore_abandoned_intents'
+
+
+@contextmanager
+def refusable(session, *intent_ids):
+    # Wraps the checks an operation makes under its locks, before it
+    # touches the filesystem. Should they refuse it, nothing was done
+    # and its intents are removed. This waits until the operation's
+    # transaction has ended and its connection has gone back to the pool.
+    try:
+        yield
+    except BaseException:
+        if not event.contains(session, 'after_transaction_end', _clear_abandoned):
+            event.listen(session, 'after_transaction_end', _clear_abandoned)
+        session.info.setdefault(_abandoned_info_key, []).extend(intent_ids)
+        raise
+
+
+def _clear_abandoned(session, transaction):
+    if transaction.parent is not None:
+        return
+    intent_ids = session.info.pop(_abandoned_info_key, None)
+    if not intent_ids:
+        return
+    try:
+        with get_session() as s:
+            clear_intents(intent_ids, session=s)
+    except Exception as e:
+        logger.error(f"Unable to clear abandoned intents {intent_ids} : {e}")
+
+
+def clear(intent_id, session=None):
+    clear_intent(intent_id, session=session)
+
+
+def clear_batch(intent_ids, session=None):
+    clear_intents(intent_ids, session=session)
+
+
+def _is_abandoned(intent, stale_age):
+    host, _, pid = intent['owner'].rpartition(':')
+    if host == _hostname:
+        if int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+    # We cannot see processes on other hosts. Give them time.
+    age = datetime.datetime.now(datetime.timezone.utc) - intent['created_at']
+    return age.total_seconds() > stale_age
+
+
+def _db_has(filename, bucket, session):
+    try:
+        get_stored_file(filename=filename, bucket=bucket.id, session=session)
+    except NoResultFound:
+        return False
+    return True
+
+
+def _recover_upload(bucket, intent, session):
+    filename = intent['filename']
+    params = intent['params']
+    if not bucket.fs.exists(filename):
+        logger.info(f"Rolling back incomplete upload of {filename} to bucket {bucket.name}")
+        return
+    if _db_has(filename, bucket, session) and not params.get('overwrite'):
+        return
+    logger.warning(f"Replaying interrupted upload of {filename} to bucket {bucket.name}")
+    encoding = params.get('encoding')
+    sha256hash = hashlib.sha256()
+    size = 0
+    for chunk in bucket.iter_bytes(filename, fileinfo={'props': {'encoding': encoding}}):
+        sha256hash.update(chunk)
+        size += len(chunk)
+    fileinfo = bucket._fileinfo(filename, sha256hash.hexdigest(), size, encoding)
+    register_stored_file(filename, bucket.id, params['user'], params.get('interest'),
+                         fileinfo, label=params.get('label'), session=session)
+    replication.record(bucket, filename, replication.PUT, session=session)
+
+
+def _recover_move(bucket, target, intent, session):
+    filename = intent['filename']
+    in_source = bucket.fs.exists(filename)
+    in_target = target.fs.exists(filename)
+    if in_target and not in_source:
+        logger.warning(f"Replaying interrupted move of {filename} from bucket "
+                       f"{bucket.name} to {target.name}")
+        if _db_has(filename, target, session):
+            delete_stored_file(filename, target.id, intent['params']['user'], session=session)
+        change_file_bucket(filename, bucket.id, target.id, intent['params']['user'], session=session)
+        replication.record(bucket, filename, replication.DELETE, session=session)
+        replication.record(target, filename, replication.PUT, session=session)
+    elif in_target and in_source and not _db_has(filename, target, session):
+        logger.info(f"Rolling back incomplete move of {filename} from bucket "
+                    f"{bucket.name} to {target.name}")
+        target._remove_file(filename)
+
+
+def _recover_delete(bucket, intent, session):
+    filename = intent['filename']
+    if bucket.fs.exists(filename):
+        logger.info(f"Rolling back incomplete delete of {filename} from bucket {bucket.name}")
+        return
+    if _db_has(filename, bucket, session):
+        logger.warning(f"Replaying interrupted delete of {filename} from bucket {bucket.name}")
+        delete_stored_file(filename, bucket.id, intent['params']['user'], session=session)
+        replication.record(bucket, filename, replication.DELETE, session=session)
+
+
+def recover(resolve_bucket, bucket_ids):
+    # Only operations which were in flight are examined, so recovery
+    # costs O(pending operations) regardless of the size of the buckets.
+    stale_age = config.FILESTORE_JOURNAL_STALE_AGE
+    intents = get_pending_intents(bucket_ids)
+    for intent in intents:
+        if not _is_abandoned(intent, stale_age):
+            continue
+        bucket = resolve_bucket(intent['bucket_id'])
+        target = None
+        if intent['target_bucket_id'] is not None:
+            target = resolve_bucket(intent['target_bucket_id'])
+            if target is None:
+                logger.warning(f"Cannot recover {intent['op']} of {intent['filename']}. Target "
+                               f"bucket {intent['target_bucket_id']} is not available here.")
+                continue
+        try:
+            with get_session() as session:
+                if intent['op'] == UPLOAD:
+                    _recover_upload(bucket, intent, session)
+                elif intent['op'] == MOVE:
+                    _recover_move(bucket, target, intent, session)
+                elif intent['op'] == DELETE:
+                    _recover_delete(bucket, intent, session)
+                clear_intent(intent['id'], session=session)
+        except Exception as e:
+            logger.error(f"Unable to recover {intent['op']} of {intent['filename']} "
+                         f"in bucket {bucket.name} : {e}")
@@ -0,0 +1,118 @@
+
+
+import hashlib
+import threading
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import event
+
+from tendril import config
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+PROCESS = 'process'
+DATABASE = 'database'
+
+
+class FileLockManager(object):
+    # Per (bucket, filename) locks. Locks are tied to the database
+    # session of the operation which takes them and are held until its
+    # transaction ends, since another operation on the same file must
+    # not see the database until this one has committed. A session which
+    # already holds a lock may take it again.
+    #
+    # Process locks serialize operations within this process. The
+    # database backend also takes a transaction scoped advisory lock,
+    # which serializes operations across processes and hosts sharing the
+    # database.
+    _info_key = 'filestore_file_locks'
+
+    def __init__(self, backend=PROCESS):
+        self._backend = backend
+        self._mutex = threading.Lock()
+        self._locks = {}
+        self._on_transaction_end = self._release_held
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @staticmethod
+    def _advisory_key(key):
+        digest = hashlib.sha256(f'{key[0]}:{key[1]}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+    def _acquire(self, key):
+        with self._mutex:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release(self, key):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _release_held(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        held = session.info.pop(self._info_key, None)
+        if not held:
+            return
+        for key in held:
+            self._release(key)
+
+    @contextmanager
+    def lock(self, session, *keys):
+        if session is None:
+            # Nothing to tie the locks to. Hold them for the block only.
+            keys = sorted(set(keys))
+            for key in keys:
+                self._acquire(key)
+            try:
+                yield
+            finally:
+                for key in reversed(keys):
+                    self._release(key)
+            return
+
+        held = session.info.get(self._info_key)
+        if held is None:
+            held = session.info[self._info_key] = []
+            if not event.contains(session, 'after_transaction_end', self._on_transaction_end):
+                event.listen(session, 'after_transaction_end', self._on_transaction_end)
+        # Always taken in the same order, so that operations which lock
+        # two files cannot deadlock each other.
+        acquired = []
+        try:
+            for key in sorted(set(keys)):
+                if key in held:
+                    continue
+                self._acquire(key)
+                acquired.append(key)
+            # Begin the transaction, if it has not begun, so that there
+            # is one to end.
+            session.connection()
+        except BaseException:
+            for key in acquired:
+                self._release(key)
+            raise
+        held.extend(acquired)
+        if self._backend == DATABASE:
+            for key in acquired:
+                session.execute(select(func.pg_advisory_xact_lock(self._advisory_key(key))))
+        yield
+
+
+_manager = FileLockManager(backend=config.FILESTORE_FILE_LOCKS)
+
+
+def lock_files(session, *targets):
+    # Each target is a (bucket, filename) pair.
+    return _manager.lock(session, *[(bucket.id, filename) for bucket, filename in targets])
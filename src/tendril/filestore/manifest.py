@@ -0,0 +1,85 @@
+
+
+import io
+import csv
+import json
+import zlib
+
+from tendril.utils.db import get_session
+from tendril.filestore.db.controller import iter_stored_file_records
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+FIELDS = ['filename', 'size', 'stored_size', 'encoding', 'sha256',
+          'owner', 'label', 'created', 'modified']
+
+_flush_rows = 500
+
+
+def _entry(record):
+    fileinfo = record['fileinfo']
+    props = fileinfo.get('props', {})
+    return {'filename': record['filename'],
+            'size': props.get('size'),
+            'stored_size': props.get('stored_size'),
+            'encoding': props.get('encoding'),
+            'sha256': fileinfo.get('hash', {}).get('sha256'),
+            'owner': record['puid'],
+            'label': record['label'],
+            'created': props.get('created'),
+            'modified': props.get('modified')}
+
+
+def _iter_ndjson(records):
+    lines = []
+    for record in records:
+        lines.append(json.dumps(_entry(record), separators=(',', ':')))
+        if len(lines) >= _flush_rows:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def _iter_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(_entry(record))
+        count += 1
+        if count >= _flush_rows:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue().encode()
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_manifest(bucket, fmt='ndjson', gzip=False):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported manifest format {fmt}")
+    with get_session() as session:
+        records = iter_stored_file_records(bucket.id, session=session)
+        chunks = _iter_ndjson(records) if fmt == 'ndjson' else _iter_csv(records)
+        if gzip:
+            chunks = _gzipped(chunks)
+        for chunk in chunks:
+            yield chunk
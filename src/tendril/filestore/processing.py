@@ -0,0 +1,155 @@
+
+
+import mimetypes
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm.exc import NoResultFound
+
+from tendril import config
+from tendril.utils.db import get_session
+from tendril.filestore.db.controller import enqueue_job
+from tendril.filestore.db.controller import claim_jobs
+from tendril.filestore.db.controller import complete_job
+from tendril.filestore.db.controller import fail_job
+from tendril.filestore.db.controller import cancel_job
+from tendril.filestore.db.controller import get_stored_file
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+_stages = {}
+
+
+def register_stage(name):
+    """
+    Register a post-upload processing stage. The decorated function is
+    called from a worker thread as ``func(bucket, filename, fileinfo)``
+    and may return a JSON serializable result, which is written back into
+    the stored file's ``fileinfo['stages'][name]``. Raising an exception
+    causes the job to be retried, up to FILESTORE_PROCESSING_MAX_ATTEMPTS.
+    """
+    def decorator(func):
+        _stages[name] = func
+        return func
+    return decorator
+
+
+def available_stages():
+    return list(_stages.keys())
+
+
+@register_stage('mimetype')
+def _mimetype_stage(bucket, filename, fileinfo):
+    mimetype, _ = mimetypes.guess_type(filename)
+    return {'mimetype': mimetype}
+
+
+class ProcessingWorkerPool(object):
+    def __init__(self, resolve_bucket, workers=2, poll_interval=5,
+                 lease=300, max_attempts=3):
+        self._resolve_bucket = resolve_bucket
+        self._workers = workers
+        self._poll_interval = poll_interval
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        if self._threads:
+            return
+        logger.info(f"Starting {self._workers} filestore processing workers")
+        for idx in range(self._workers):
+            t = threading.Thread(target=self._run, daemon=True,
+                                 name=f'filestore-processing-{idx}')
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def wake(self, *_):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                jobs = claim_jobs(available_stages(), lease=self._lease,
+                                  max_attempts=self._max_attempts)
+            except Exception as e:
+                logger.error(f"Unable to claim filestore processing jobs : {e}")
+                jobs = []
+            if not jobs:
+                self._wake.wait(self._poll_interval)
+                self._wake.clear()
+                continue
+            for job in jobs:
+                self._execute(job)
+
+    def _execute(self, job):
+        filename = job['filename']
+        bucket = self._resolve_bucket(job['bucket_id'])
+        if bucket is None:
+            fail_job(job['id'], f"Bucket {job['bucket_id']} is not available here",
+                     retry_after=self._lease)
+            return
+        try:
+            with get_session() as session:
+                sf = get_stored_file(filename=filename, bucket=bucket.id, session=session)
+                fileinfo = dict(sf.fileinfo or {})
+        except NoResultFound:
+            cancel_job(job['id'], reason="Stored file no longer exists")
+            return
+
+        logger.debug(f"Running stage {job['stage']} for {filename} in bucket {bucket.name}")
+        try:
+            result = _stages[job['stage']](bucket, filename, fileinfo)
+        except Exception as e:
+            logger.warning(f"Stage {job['stage']} failed for {filename} in "
+                           f"bucket {bucket.name} (attempt {job['attempts']}) : {e}")
+            retry_after = None
+            if job['attempts'] < self._max_attempts:
+                retry_after = self._poll_interval * 2 ** job['attempts']
+            fail_job(job['id'], str(e), retry_after=retry_after)
+        else:
+            complete_job(job['id'], result)
+
+
+_pool = None
+
+
+def init(resolve_bucket):
+    global _pool
+    _pool = ProcessingWorkerPool(
+        resolve_bucket,
+        workers=config.FILESTORE_PROCESSING_WORKERS,
+        poll_interval=config.FILESTORE_PROCESSING_POLL_INTERVAL,
+        lease=config.FILESTORE_PROCESSING_LEASE,
+        max_attempts=config.FILESTORE_PROCESSING_MAX_ATTEMPTS,
+    )
+    _pool.start()
+
+
+def enqueue(bucket, filename, stages, session):
+    queued = []
+    for stage in stages:
+        if stage not in _stages:
+            logger.warning(f"Unknown processing stage {stage} configured "
+                           f"for bucket {bucket.name}. Skipping.")
+            continue
+        enqueue_job(bucket.id, filename, stage, session=session)
+        queued.append(stage)
+    if queued and _pool is not None:
+        # Workers only see the jobs once the upload is committed.
+        event.listen(session, 'after_commit', _pool.wake, once=True)
+    return queued
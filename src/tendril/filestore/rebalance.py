@@ -0,0 +1,112 @@
+
+
+"""
+Moves files between filestore nodes to match the hash ring, after
+FILESTORE_REMOTE_NODES or FILESTORE_REMOTE_PARTITIONED_BUCKETS has been
+changed. Run it from a component configured with the new node list,
+naming any nodes which are being removed so that their files are
+found::
+
+    python -m tendril.filestore.rebalance --previous-node http://old:8039 --dry-run
+
+The tool is safe to interrupt and rerun. Each file is copied to its new
+node before it is removed from the old one.
+"""
+
+import asyncio
+import argparse
+from httpx import HTTPStatusError
+
+from tendril.utils.www import async_client
+
+from tendril.filestore import ring
+from tendril.filestore.buckets import get_bucket
+from tendril.filestore.buckets import available_buckets
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+async def _misplaced(bucket, node, client):
+    # Collected up front, since moving files out of the node while paging
+    # through it would shift the pages.
+    rv = []
+    async for item in bucket.iter_info(nodes=[node], client=client):
+        target = ring.node_for(bucket.name, item['filename'])
+        if target != node:
+            rv.append((item['filename'], item['fileinfo']['hash']['sha256'], target))
+    return rv
+
+
+async def _relocate(bucket, filename, sha256, source, target, client):
+    try:
+        await bucket.copy_to_node(filename, target, source_node=source, client=client)
+    except HTTPStatusError as e:
+        if e.response.status_code != 409:
+            raise
+        # Left behind by an earlier, interrupted run. The source copy is
+        # only dropped if the target already has the same content.
+        existing = [item async for item in bucket.iter_info(filenames=[filename],
+                                                            nodes=[target], client=client)
+                    if item['filename'] == filename]
+        if not existing or existing[0]['fileinfo']['hash']['sha256'] != sha256:
+            raise FileExistsError(f"A different {filename} already exists on {target}")
+    await bucket.delete(filename, node=source, client=client)
+
+
+async def rebalance_bucket(bucket, previous_nodes=None, dry_run=False, client=None):
+    if client is None:
+        async with async_client(**bucket._async_http_client_args()) as client:
+            return await rebalance_bucket(bucket, previous_nodes=previous_nodes,
+                                          dry_run=dry_run, client=client)
+
+    # Any node, old or new, may hold files of any bucket.
+    nodes = list(dict.fromkeys(ring.get_ring().nodes + list(previous_nodes or [])))
+    result = {'moved': [], 'failed': {}}
+    for node in nodes:
+        for filename, sha256, target in await _misplaced(bucket, node, client):
+            logger.info(f"{'Would move' if dry_run else 'Moving'} {filename} of "
+                        f"bucket {bucket.name} from {node} to {target}")
+            if dry_run:
+                result['moved'].append(filename)
+                continue
+            try:
+                await _relocate(bucket, filename, sha256, node, target, client)
+            except Exception as e:
+                logger.error(f"Unable to move {filename} of bucket {bucket.name} "
+                             f"from {node} to {target} : {e}")
+                result['failed'][filename] = str(e)
+            else:
+                result['moved'].append(filename)
+    return result
+
+
+async def rebalance(bucket_names=None, previous_nodes=None, dry_run=False):
+    rv = {}
+    for bucket_name in bucket_names or available_buckets():
+        rv[bucket_name] = await rebalance_bucket(get_bucket(bucket_name),
+                                                 previous_nodes=previous_nodes,
+                                                 dry_run=dry_run)
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move filestore files to the nodes the hash ring places them on."
+    )
+    parser.add_argument('--bucket', action='append', dest='buckets',
+                        help="Bucket to rebalance. May be repeated. Defaults to all buckets.")
+    parser.add_argument('--previous-node', action='append', dest='previous_nodes',
+                        help="Node which held files before the change and is no "
+                             "longer configured. May be repeated.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Report the files which would be moved without moving them.")
+    args = parser.parse_args()
+    result = asyncio.run(rebalance(args.buckets, args.previous_nodes, args.dry_run))
+    for bucket_name, outcome in result.items():
+        logger.info(f"Rebalanced bucket {bucket_name} : {len(outcome['moved'])} "
+                    f"{'to move' if args.dry_run else 'moved'}, {len(outcome['failed'])} failed")
+
+
+if __name__ == '__main__':
+    main()
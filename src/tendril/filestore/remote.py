@@ -1,5 +1,10 @@
 
 
+import os
+import json
+import time
+import asyncio
+import tempfile
 from tendril.authn.client import IntramuralAuthenticator
 from tendril.utils.www import async_client
 from tendril.utils.www import with_async_client_cl
@@ -7,8 +12,13 @@ from tendril.utils.www import with_async_client_cl
 from tendril.config import FILESTORE_REMOTE_AUDIENCE
 from tendril.config import FILESTORE_REMOTE_CLIENT_ID
 from tendril.config import FILESTORE_REMOTE_CLIENT_SECRET
+from tendril.config import FILESTORE_REMOTE_PAGE_SIZE
+from tendril.config import FILESTORE_REMOTE_DISCOVERY_TTL
+from tendril.config import FILESTORE_REMOTE_DISCOVERY_CACHE
 
 from .base import FilestoreBucketBase
+from . import content_cache
+from . import ring
 
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
@@ -21,28 +31,186 @@ _authenticator = IntramuralAuthenticator(
 )
 
 
-def get_remote_bucket_list(remote_uri):
-    # TODO This causes issue with the asyncio loop because
-    #  asyncio.run() causes a loop to start and stop, and this
-    #  breaks things when something else wants a loop.
-    #  We aren't using this in any case because it uses up M2M
-    #  access tokens for every component.
-    #  This should be reconsidered seriously before multiple
-    #  file management servers can be supported,
-    #
-    # async with async_client(base_url=remote_uri, auth=_authenticator) as client:
-    #     response = await client.get('/v1/filestore/buckets')
-    #     return response.json()["available_buckets"]
-    return['incoming', 'cdn', 'outgoing']
+class RemoteBucketDiscovery(object):
+    # Discovers the buckets available on the remote filestore. The last
+    # known list is kept on disk, so components start without making a
+    # network call, and is refreshed in the background once it is older
+    # than the TTL. Processes sharing the cache file share its age, so
+    # only one of them needs to spend an access token on each refresh.
+    _retry_interval = 30
+
+    def __init__(self, remote_uri, cache_path=None, ttl=300):
+        self._remote_uri = remote_uri
+        self._cache_path = cache_path
+        self._ttl = ttl
+        self._buckets = None
+        self._fetched_at = 0
+        self._next_attempt = 0
+        self._refreshing = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self):
+        for listener in self._listeners:
+            try:
+                listener(self._buckets)
+            except Exception as e:
+                logger.error(f"Error applying discovered remote buckets : {e}")
+
+    def _load(self):
+        if not self._cache_path:
+            return False
+        try:
+            with open(self._cache_path, 'r') as f:
+                content = json.load(f)
+            fetched_at = os.path.getmtime(self._cache_path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read remote bucket cache {self._cache_path} : {e}")
+            return False
+        if content.get('remote_uri') != self._remote_uri:
+            return False
+        if fetched_at <= self._fetched_at:
+            return False
+        self._buckets = content['buckets']
+        self._fetched_at = fetched_at
+        return True
+
+    def _save(self):
+        if not self._cache_path:
+            return
+        cache_dir = os.path.dirname(self._cache_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=cache_dir, prefix='.remote-buckets-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'remote_uri': self._remote_uri,
+                           'buckets': self._buckets}, f)
+            os.replace(path, self._cache_path)
+        except OSError as e:
+            logger.warning(f"Unable to write remote bucket cache {self._cache_path} : {e}")
+
+    @property
+    def buckets(self):
+        # The cached bucket configurations, keyed by bucket name. This
+        # never touches the network, and is None until a list has been
+        # obtained at least once.
+        if self._buckets is None:
+            self._load()
+        return self._buckets
+
+    @property
+    def is_stale(self):
+        now = time.time()
+        return now - self._fetched_at > self._ttl and now >= self._next_attempt
+
+    async def _fetch(self):
+        async with async_client(base_url=self._remote_uri, auth=_authenticator) as client:
+            response = await client.get('/v1/filestore/buckets')
+            response.raise_for_status()
+            content = response.json()
+        if 'buckets' in content:
+            return content['buckets']
+        # Older filestore components only report bucket names.
+        return {name: {} for name in content['available_buckets']}
+
+    async def _refresh(self):
+        try:
+            if not self._load() or self.is_stale:
+                self._buckets = await self._fetch()
+                self._fetched_at = time.time()
+                self._save()
+                logger.info(f"Discovered remote filestore buckets : {list(self._buckets.keys())}")
+        except Exception as e:
+            self._next_attempt = time.time() + self._retry_interval
+            logger.warning(f"Unable to discover buckets on the remote filestore "
+                           f"at {self._remote_uri} : {e}")
+            return self._buckets
+        finally:
+            self._refreshing = None
+        self._notify()
+        return self._buckets
+
+    def _start_refresh(self):
+        loop = asyncio.get_running_loop()
+        if self._refreshing is None or self._refreshing.get_loop() is not loop:
+            self._refreshing = loop.create_task(self._refresh())
+        return self._refreshing
+
+    async def refresh(self):
+        return await asyncio.shield(self._start_refresh())
+
+    def refresh_in_background(self):
+        # Schedules a refresh if the list is stale. Safe to call from
+        # synchronous code; nothing happens if no event loop is running.
+        if not self.is_stale:
+            return False
+        try:
+            self._start_refresh()
+        except RuntimeError:
+            return False
+        return True
+
+    async def get(self):
+        if self.buckets is None:
+            return await self.refresh()
+        self.refresh_in_background()
+        return self._buckets
+
+
+_discovery = None
+
+
+def get_remote_discovery(remote_uri):
+    global _discovery
+    if _discovery is None:
+        _discovery = RemoteBucketDiscovery(
+            remote_uri,
+            cache_path=FILESTORE_REMOTE_DISCOVERY_CACHE,
+            ttl=FILESTORE_REMOTE_DISCOVERY_TTL
+        )
+    return _discovery
 
 
 class FilestoreBucketRemote(FilestoreBucketBase):
+    # Proxy to a bucket on the remote filestore. Where the filestore is
+    # spread across several nodes, each operation is sent to the node
+    # which holds the bucket, or the file, according to the hash ring.
+    _spool_size = 2 ** 22
+
     def _async_http_client_args(self):
         return {
             'base_url': self.uri,
             'auth': _authenticator
         }
 
+    def _url(self, node, endpoint):
+        return f"{node.rstrip('/')}/v1/filestore/{self.name}/{endpoint}"
+
+    def _node_for(self, filename=None):
+        return ring.node_for(self.name, filename)
+
+    @property
+    def nodes(self):
+        return ring.bucket_nodes(self.name)
+
+    def _node_groups(self, filenames=None):
+        if filenames is None:
+            return [(node, None) for node in self.nodes]
+        groups = {}
+        for filename in filenames:
+            groups.setdefault(self._node_for(filename), []).append(filename)
+        return list(groups.items())
+
+    @staticmethod
+    def _upload_filename(file):
+        if isinstance(file, tuple):
+            return file[0]
+        return os.path.basename(getattr(file, 'name', ''))
+
     @with_async_client_cl()
     async def upload(self, file, actual_user=None, interest=None, label=None, overwrite=False, client=None):
         params = {}
@@ -52,49 +220,246 @@ class FilestoreBucketRemote(FilestoreBucketBase):
             params['interest'] = interest
         if label:
             params['label'] = label
-        response = await client.post(f'/v1/filestore/{self.name}/upload',
+        if overwrite:
+            params['overwrite'] = overwrite
+        node = self._node_for(self._upload_filename(file))
+        response = await client.post(self._url(node, 'upload'),
                                      files={'file': file}, params=params)
         response.raise_for_status()
         return response.json()
 
     @with_async_client_cl()
     async def move(self, filename, target_bucket, actual_user=None, overwrite=False, client=None):
+        node = self._node_for(filename)
+        if ring.node_for(target_bucket, filename) != node:
+            return await self._move_across(filename, target_bucket, actual_user=actual_user,
+                                           overwrite=overwrite, client=client)
         params = {}
         if actual_user:
             params['actual_user'] = actual_user
         data = {"to_bucket": target_bucket,
                 "filename": filename,
                 "overwrite": overwrite}
-        response = await client.post(f'/v1/filestore/{self.name}/move',
+        response = await client.post(self._url(node, 'move'),
                                      json=data, params=params)
         response.raise_for_status()
         return response.json()
 
+    @with_async_client_cl()
+    async def copy(self, filename, target_bucket, actual_user=None, overwrite=False, client=None):
+        node = self._node_for(filename)
+        target_node = ring.node_for(target_bucket, filename)
+        if target_node != node:
+            # No server side copy between nodes. The copy is made through
+            # this component instead.
+            return await self.copy_to_node(filename, target_node, target_bucket=target_bucket,
+                                           actual_user=actual_user, overwrite=overwrite,
+                                           source_node=node, client=client)
+        params = {}
+        if actual_user:
+            params['actual_user'] = actual_user
+        data = {"to_bucket": target_bucket,
+                "filename": filename,
+                "overwrite": overwrite}
+        response = await client.post(self._url(node, 'copy'),
+                                     json=data, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def _get_owner(self, client, node, filename):
+        response = await client.get(self._url(node, 'ls_fast'),
+                                    params={'include_owner': True,
+                                            'filenames': [filename]})
+        response.raise_for_status()
+        for item in response.json()['items']:
+            if item['filename'] == filename:
+                return item['puid']
+        raise FileNotFoundError(f"Requested file {filename} does not exist in "
+                                f"the bucket {self.name}.")
+
+    @with_async_client_cl()
+    async def copy_to_node(self, filename, target_node, target_bucket=None,
+                           actual_user=None, overwrite=False, source_node=None, client=None):
+        # Copies a file between nodes through this component. Files are
+        # uploaded on behalf of their owner, but interests and labels
+        # are not carried across.
+        source_node = source_node or self._node_for(filename)
+        target_bucket = target_bucket or self.name
+        if actual_user is None:
+            actual_user = await self._get_owner(client, source_node, filename)
+        spool = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+        try:
+            async for chunk in self._iter_download(client, filename, node=source_node):
+                spool.write(chunk)
+            spool.seek(0)
+            params = {'actual_user': actual_user}
+            if overwrite:
+                params['overwrite'] = overwrite
+            response = await client.post(
+                f"{target_node.rstrip('/')}/v1/filestore/{target_bucket}/upload",
+                files={'file': (filename, spool)}, params=params
+            )
+            response.raise_for_status()
+            return response.json()
+        finally:
+            spool.close()
+
+    async def _move_across(self, filename, target_bucket, actual_user=None, overwrite=False, client=None):
+        # The source and target are on different nodes. The file is copied
+        # to the target and only then deleted from the source, so a failure
+        # part way leaves a duplicate rather than losing the file.
+        source_node = self._node_for(filename)
+        result = await self.copy_to_node(filename, ring.node_for(target_bucket, filename),
+                                         target_bucket=target_bucket, actual_user=actual_user,
+                                         overwrite=overwrite, source_node=source_node,
+                                         client=client)
+        await self.delete(filename, node=source_node, client=client)
+        return result
+
     @with_async_client_cl()
     async def list(self, client=None):
-        response = await client.get(f'/v1/filestore/{self.name}/ls_fs')
+        rv = []
+        for node in self.nodes:
+            response = await client.get(self._url(node, 'ls_fs'))
+            response.raise_for_status()
+            rv.extend(response.json())
+        return rv
+
+    async def _get_info_page(self, client, node, page, size, include_owner, filenames):
+        params = {'include_owner': include_owner, 'page': page, 'size': size}
+        if filenames:
+            params['filenames'] = filenames
+        response = await client.get(self._url(node, 'ls'), params=params)
         response.raise_for_status()
         return response.json()
 
+    async def _iter_node_info(self, client, node, include_owner, filenames, page_size):
+        # Pages through the bucket on one node, requesting the next page
+        # while the current one is being consumed.
+        def _fetch(page):
+            return asyncio.ensure_future(self._get_info_page(
+                client, node, page, page_size, include_owner, filenames))
+
+        page = 1
+        pending = _fetch(page)
+        try:
+            while pending is not None:
+                content = await pending
+                pending = None
+                items = content['items']
+                if items and page * page_size < content['total']:
+                    page += 1
+                    pending = _fetch(page)
+                for item in items:
+                    yield item
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def iter_info(self, include_owner=False, filenames=None,
+                        page_size=FILESTORE_REMOTE_PAGE_SIZE, nodes=None, client=None):
+        if client is None:
+            async with async_client(**self._async_http_client_args()) as client:
+                async for item in self.iter_info(include_owner=include_owner,
+                                                 filenames=filenames,
+                                                 page_size=page_size,
+                                                 nodes=nodes,
+                                                 client=client):
+                    yield item
+            return
+
+        groups = [(node, filenames) for node in nodes] if nodes else self._node_groups(filenames)
+        for node, node_filenames in groups:
+            async for item in self._iter_node_info(client, node, include_owner,
+                                                   node_filenames, page_size):
+                yield item
+
     @with_async_client_cl()
     async def list_info(self, include_owner=False, filenames=None, client=None):
-        response = await client.get(f'/v1/filestore/{self.name}/ls',
-                                    params={'include_owner': include_owner})
-        response.raise_for_status()
-        return response.json()['items']
+        return [item async for item in self.iter_info(include_owner=include_owner,
+                                                      filenames=filenames,
+                                                      client=client)]
 
     @with_async_client_cl()
-    async def find(self, spec, client=None):
-        raise NotImplementedError
+    async def get_fileinfo(self, filename, client=None):
+        async for item in self.iter_info(filenames=[filename], client=client):
+            if item['filename'] == filename:
+                return item['fileinfo']
+        raise FileNotFoundError(f"Requested file {filename} does not exist in "
+                                f"the bucket {self.name}.")
+
+    async def _iter_download(self, client, filename, node=None):
+        node = node or self._node_for(filename)
+        async with client.stream('GET', self._url(node, f'download/{filename}')) as response:
+            if response.status_code == 404:
+                raise FileNotFoundError(f"Requested file {filename} does not exist in "
+                                        f"the bucket {self.name}.")
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                yield chunk
 
     @with_async_client_cl()
-    async def delete(self, filename, user, client=None):
-        raise NotImplementedError
+    async def fetch_path(self, filename, sha256=None, client=None):
+        # Returns the path to a local copy of the file in the content
+        # cache, downloading it only if its current content is not
+        # already there. The hash is looked up from the remote listing
+        # if it is not provided.
+        cache = content_cache.get_cache()
+        if not cache.enabled:
+            raise EnvironmentError("The remote filestore content cache is not enabled.")
+        if sha256 is None:
+            sha256 = (await self.get_fileinfo(filename, client=client))['hash']['sha256']
+        return await cache.get_or_fill(sha256, lambda: self._iter_download(client, filename))
 
     @with_async_client_cl()
-    async def prune(self, user, client=None):
-        raise NotImplementedError
+    async def open(self, filename, sha256=None, client=None):
+        # Returns a binary file object with the content of the file.
+        if content_cache.get_cache().enabled:
+            path = await self.fetch_path(filename, sha256=sha256, client=client)
+            return open(path, 'rb')
+        spool = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+        async for chunk in self._iter_download(client, filename):
+            spool.write(chunk)
+        spool.seek(0)
+        return spool
+
+    async def fetch(self, filename, sha256=None, client=None):
+        with await self.open(filename, sha256=sha256, client=client) as f:
+            return f.read()
 
     @with_async_client_cl()
-    async def purge(self, user, client=None):
-        raise NotImplementedError
+    async def delete(self, filename, user=None, *, node=None, client=None):
+        params = {'filename': filename}
+        if user:
+            params['actual_user'] = user
+        node = node or self._node_for(filename)
+        response = await client.post(self._url(node, 'delete'), params=params)
+        response.raise_for_status()
+        return response.json()
+
+    @with_async_client_cl()
+    async def delete_batch(self, filenames, user=None, *,
+                           batch_size=FILESTORE_REMOTE_PAGE_SIZE, client=None):
+        params = {}
+        if user:
+            params['actual_user'] = user
+        rv = {'deleted': [], 'failed': {}}
+        for node, node_filenames in self._node_groups(list(filenames)):
+            for idx in range(0, len(node_filenames), batch_size):
+                response = await client.post(self._url(node, 'delete_batch'),
+                                             json={'filenames': node_filenames[idx:idx + batch_size]},
+                                             params=params)
+                response.raise_for_status()
+                result = response.json()
+                rv['deleted'].extend(result['deleted'])
+                rv['failed'].update(result['failed'])
+        return rv
+
+    @with_async_client_cl()
+    async def purge(self, user=None, client=None):
+        params = {}
+        if user:
+            params['actual_user'] = user
+        for node in self.nodes:
+            response = await client.post(self._url(node, 'purge'), params=params)
+            response.raise_for_status()
@@ -0,0 +1,194 @@
+
+
+import os
+import uuid
+import hashlib
+import threading
+from fs import open_fs
+from fs.copy import copy_file
+from sqlalchemy import event
+
+from tendril import config
+from tendril.filestore.db.controller import enqueue_replication_event
+from tendril.filestore.db.controller import claim_replication_events
+from tendril.filestore.db.controller import complete_replication_events
+from tendril.filestore.db.controller import retry_replication_events
+from tendril.filestore.db.controller import get_replication_status
+from tendril.filestore.db.controller import get_replication_errors
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+PUT = 'put'
+DELETE = 'delete'
+
+
+def replica_key(uri):
+    return hashlib.sha256(uri.encode()).hexdigest()[:16]
+
+
+def record(bucket, filename, op, session):
+    # Called within the transaction which records the change, so an
+    # event exists exactly when the change was committed.
+    if not bucket.replicas:
+        return
+    for uri in bucket.replicas:
+        enqueue_replication_event(bucket.id, replica_key(uri), op, filename, session=session)
+    if _pool is not None:
+        event.listen(session, 'after_commit', _pool.wake, once=True)
+
+
+def sync_file(bucket, replica_fs, filename):
+    # Makes the replica's copy of the file match the bucket as it is now,
+    # rather than replaying the recorded operation. This is idempotent
+    # and independent of the order in which events are applied, so
+    # retries, duplicates and coalesced events are all harmless.
+    if bucket.fs.exists(filename):
+        subdir, name = os.path.split(filename)
+        if subdir:
+            replica_fs.makedirs(subdir, recreate=True)
+        partial = os.path.join(subdir, f'.{name}.{uuid.uuid4().hex}.partial')
+        try:
+            copy_file(bucket.fs, filename, replica_fs, partial)
+            replica_fs.move(partial, filename, overwrite=True)
+            if not bucket.fs.exists(filename):
+                # Deleted while it was being copied. The event for the
+                # delete may already have been applied.
+                replica_fs.remove(filename)
+        finally:
+            if replica_fs.exists(partial):
+                replica_fs.remove(partial)
+    elif replica_fs.exists(filename):
+        replica_fs.remove(filename)
+
+
+class ReplicationWorkerPool(object):
+    def __init__(self, resolve_bucket, workers=1, batch_size=100, poll_interval=5,
+                 lease=300, max_backoff=300):
+        self._resolve_bucket = resolve_bucket
+        self._workers = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease = lease
+        self._max_backoff = max_backoff
+        self._replica_fs = {}
+        self._fs_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        if self._threads:
+            return
+        logger.info(f"Starting {self._workers} filestore replication workers")
+        for idx in range(self._workers):
+            t = threading.Thread(target=self._run, daemon=True,
+                                 name=f'filestore-replication-{idx}')
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def wake(self, *_):
+        self._wake.set()
+
+    def _get_replica_fs(self, bucket, replica):
+        with self._fs_lock:
+            key = (bucket.id, replica)
+            if key not in self._replica_fs:
+                uris = {replica_key(uri): uri for uri in bucket.replicas}
+                if replica not in uris:
+                    return None
+                self._replica_fs[key] = open_fs(uris[replica], create=True)
+            return self._replica_fs[key]
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                events = claim_replication_events(limit=self._batch_size, lease=self._lease)
+            except Exception as e:
+                logger.error(f"Unable to claim filestore replication events : {e}")
+                events = []
+            if not events:
+                self._wake.wait(self._poll_interval)
+                self._wake.clear()
+                continue
+            self._apply(events)
+
+    def _apply(self, events):
+        # Events for the same file in the same replica collapse into a
+        # single sync of that file.
+        targets = {}
+        for e in events:
+            targets.setdefault((e['bucket_id'], e['replica'], e['filename']), []).append(e)
+
+        done, failed = [], {}
+        for (bucket_id, replica, filename), file_events in targets.items():
+            ids = [e['id'] for e in file_events]
+            attempts = max(e['attempts'] for e in file_events)
+            bucket = self._resolve_bucket(bucket_id)
+            try:
+                if bucket is None:
+                    raise EnvironmentError(f"Bucket {bucket_id} is not available here")
+                replica_fs = self._get_replica_fs(bucket, replica)
+                if replica_fs is None:
+                    # The replica has been removed from the configuration.
+                    logger.info(f"Dropping replication of {filename} to a replica no "
+                                f"longer configured for bucket {bucket.name}")
+                else:
+                    sync_file(bucket, replica_fs, filename)
+            except Exception as e:
+                logger.warning(f"Unable to replicate {filename} in bucket {bucket_id} "
+                               f"(attempt {attempts}) : {e}")
+                retry_after = min(self._poll_interval * 2 ** attempts, self._max_backoff)
+                failed.setdefault((str(e), retry_after), []).extend(ids)
+            else:
+                done.extend(ids)
+
+        if done:
+            complete_replication_events(done)
+        for (error, retry_after), ids in failed.items():
+            retry_replication_events(ids, error, retry_after)
+
+
+_pool = None
+
+
+def init(resolve_bucket):
+    global _pool
+    _pool = ReplicationWorkerPool(
+        resolve_bucket,
+        workers=config.FILESTORE_REPLICATION_WORKERS,
+        batch_size=config.FILESTORE_REPLICATION_BATCH_SIZE,
+        poll_interval=config.FILESTORE_REPLICATION_POLL_INTERVAL,
+        lease=config.FILESTORE_REPLICATION_LEASE,
+        max_backoff=config.FILESTORE_REPLICATION_MAX_BACKOFF,
+    )
+    _pool.start()
+
+
+def status(bucket):
+    # Replication lag is the age of the oldest event not yet applied to
+    # the replica. A replica which is fully caught up has a lag of 0.
+    pending = get_replication_status(bucket.id)
+    rv = []
+    for idx, uri in enumerate(bucket.replicas):
+        key = replica_key(uri)
+        replica = {'replica': key, 'index': idx, 'pending': 0,
+                   'oldest_pending': None, 'lag': 0.0, 'errors': []}
+        if key in pending:
+            replica.update(pending[key])
+            replica.pop('max_attempts')
+            replica['errors'] = get_replication_errors(bucket.id, key)
+        rv.append(replica)
+    return rv
@@ -0,0 +1,81 @@
+
+
+import bisect
+import hashlib
+
+from tendril import config
+
+
+class HashRing(object):
+    # Consistent hash ring over the filestore nodes. Each node is placed
+    # on the ring at several points, so that adding or removing a node
+    # moves only about 1/N of the keys, spread evenly over the others.
+    def __init__(self, nodes, vnodes=64):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self._nodes = list(dict.fromkeys(nodes))
+        self._vnodes = vnodes
+        points = []
+        for node in self._nodes:
+            for idx in range(vnodes):
+                points.append((self._hash(f'{node}#{idx}'), node))
+        points.sort()
+        self._points = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    def node_for(self, key):
+        idx = bisect.bisect(self._points, self._hash(key))
+        if idx == len(self._points):
+            idx = 0
+        return self._owners[idx]
+
+
+def configured_nodes():
+    if config.FILESTORE_REMOTE_NODES:
+        return list(config.FILESTORE_REMOTE_NODES)
+    if config.FILESTORE_REMOTE_URI:
+        return [config.FILESTORE_REMOTE_URI]
+    return []
+
+
+_ring = None
+
+
+def get_ring():
+    global _ring
+    if _ring is None:
+        _ring = HashRing(configured_nodes(), vnodes=config.FILESTORE_RING_VNODES)
+    return _ring
+
+
+def is_partitioned(bucket_name):
+    return bucket_name in (config.FILESTORE_REMOTE_PARTITIONED_BUCKETS or [])
+
+
+def placement_key(bucket_name, filename=None):
+    # Unpartitioned buckets are placed whole, by name. Files in
+    # partitioned buckets are placed individually.
+    if filename is not None and is_partitioned(bucket_name):
+        return f'{bucket_name}/{filename}'
+    return bucket_name
+
+
+def node_for(bucket_name, filename=None, ring=None):
+    ring = ring or get_ring()
+    return ring.node_for(placement_key(bucket_name, filename))
+
+
+def bucket_nodes(bucket_name, ring=None):
+    # The nodes which may hold files of the bucket.
+    ring = ring or get_ring()
+    if is_partitioned(bucket_name):
+        return list(ring.nodes)
+    return [ring.node_for(placement_key(bucket_name))]
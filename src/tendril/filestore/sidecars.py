@@ -0,0 +1,183 @@
+
+
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from tendril import config
+from tendril.filestore import compression
+
+from tendril.utils import log
+logger = log.get_logger(__name__, log.DEFAULT)
+
+
+SUFFIXES = ['.gz', '.br']
+
+_chunk_size = 2 ** 20
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=config.FILESTORE_SIDECAR_WORKERS)
+    return _executor
+
+
+def _suffixes():
+    if brotli is None:
+        return ['.gz']
+    return SUFFIXES
+
+
+def _tmp_path(path, suffix):
+    # Hidden, so that a sidecar being written is never listed, nor
+    # reachable through a signed prefix URL.
+    head, tail = os.path.split(path)
+    return os.path.join(head, f'.{tail}{suffix}.tmp')
+
+
+def _remove_tmp(path, suffixes=None):
+    for suffix in suffixes or SUFFIXES:
+        try:
+            os.remove(_tmp_path(path, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _remove(path, suffixes=None):
+    for suffix in suffixes or SUFFIXES:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _generate(path, encoding=None, suffixes=None):
+    # Runs in a worker process. Writes each sidecar to a temporary name
+    # and renames it into place, so nginx never serves a partial sidecar.
+    # If the source changes or disappears while we are working, whatever
+    # we produced is stale and is discarded.
+    suffixes = suffixes or SUFFIXES
+    try:
+        before = os.stat(path)
+    except FileNotFoundError:
+        return False
+
+    compressors = {}
+    targets = {}
+    for suffix in suffixes:
+        if suffix == '.gz':
+            compressors[suffix] = zlib.compressobj(9, zlib.DEFLATED, 31)
+        elif suffix == '.br':
+            compressors[suffix] = brotli.Compressor(quality=11)
+        targets[suffix] = open(_tmp_path(path, suffix), 'wb')
+
+    try:
+        with open(path, 'rb') as source:
+            if encoding:
+                source = compression.decompressing_reader(source)
+            while True:
+                chunk = source.read(_chunk_size)
+                if not chunk:
+                    break
+                for suffix, c in compressors.items():
+                    if suffix == '.br':
+                        targets[suffix].write(c.process(chunk))
+                    else:
+                        targets[suffix].write(c.compress(chunk))
+        for suffix, c in compressors.items():
+            targets[suffix].write(c.finish() if suffix == '.br' else c.flush())
+    except Exception:
+        for target in targets.values():
+            target.close()
+        _remove_tmp(path, suffixes)
+        raise
+    finally:
+        for target in targets.values():
+            target.close()
+
+    try:
+        after = os.stat(path)
+    except FileNotFoundError:
+        after = None
+
+    if after is None or (after.st_mtime_ns, after.st_size, after.st_ino) != \
+            (before.st_mtime_ns, before.st_size, before.st_ino):
+        _remove_tmp(path, suffixes)
+        return False
+
+    for suffix in suffixes:
+        os.replace(_tmp_path(path, suffix), path + suffix)
+    return True
+
+
+class SidecarGenerator(object):
+    def __init__(self, bucket, extensions):
+        self._bucket = bucket
+        self._extensions = extensions or []
+        self._futures = {}
+
+    @property
+    def enabled(self):
+        return bool(self._extensions)
+
+    @property
+    def exclude_patterns(self):
+        # Sidecars, and sidecars being written or orphaned mid-write.
+        return ['{}*{}{}{}'.format(prefix, ext, suffix, tmp)
+                for ext in self._extensions
+                for suffix in SUFFIXES
+                for prefix, tmp in (('', ''), ('.', '.tmp'))]
+
+    def applies(self, filename):
+        if not self.enabled:
+            return False
+        _, ext = os.path.splitext(filename)
+        return ext in self._extensions
+
+    def _syspath(self, filename):
+        fs = self._bucket.fs
+        if not fs.hassyspath(filename):
+            return None
+        return fs.getsyspath(filename)
+
+    def generate(self, filename, encoding=None):
+        if not self.applies(filename):
+            return None
+        path = self._syspath(filename)
+        if not path:
+            logger.warning(f"Cannot generate sidecars for {filename} in bucket "
+                           f"{self._bucket.name}, which is not on a local filesystem.")
+            return None
+        logger.debug(f"Queueing sidecar generation for {filename} in bucket {self._bucket.name}")
+        future = _get_executor().submit(_generate, path, encoding, _suffixes())
+        future.add_done_callback(lambda f: self._done(filename, f))
+        self._futures[filename] = future
+        return future
+
+    def _done(self, filename, future):
+        if self._futures.get(filename) is future:
+            self._futures.pop(filename, None)
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e:
+            logger.error(f"Sidecar generation failed for {filename} in bucket "
+                         f"{self._bucket.name} : {e}")
+
+    def remove(self, filename):
+        if not self.applies(filename):
+            return
+        path = self._syspath(filename)
+        if not path:
+            return
+        future = self._futures.pop(filename, None)
+        if future:
+            future.cancel()
+        _remove(path)
@@ -0,0 +1,84 @@
+
+
+import hmac
+import time
+import base64
+import hashlib
+import posixpath
+
+from tendril import config
+
+
+def enabled():
+    return bool(config.FILESTORE_SIGNING_KEY)
+
+
+def _key():
+    if not enabled():
+        raise EnvironmentError("Signed filestore URLs are not enabled. "
+                               "Set FILESTORE_SIGNING_KEY to use them.")
+    return config.FILESTORE_SIGNING_KEY.encode()
+
+
+def _payload(bucket, scope, expires, encoding):
+    return '\n'.join([bucket, scope, str(expires), encoding or '']).encode()
+
+
+def _signature(bucket, scope, expires, encoding):
+    digest = hmac.new(_key(), _payload(bucket, scope, expires, encoding),
+                      hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def _scope(filepath=None, prefix=None):
+    if prefix is not None:
+        return f'p:{prefix}'
+    return f'f:{filepath}'
+
+
+def is_safe_path(filepath):
+    # Hidden paths hold the bucket's own working files, such as spools
+    # and partial writes, and are never reachable through a signature.
+    if not filepath or filepath.startswith('/'):
+        return False
+    if filepath == '.':
+        return True
+    if any(part.startswith('.') for part in filepath.split('/')):
+        return False
+    return posixpath.normpath(filepath) == filepath.rstrip('/')
+
+
+def sign(bucket, filepath=None, prefix=None, ttl=None, encoding=None):
+    # Returns the query parameters which authorize access to a single
+    # file, or to every file under a prefix, until the expiry time.
+    if (filepath is None) == (prefix is None):
+        raise ValueError("Exactly one of filepath or prefix is needed to sign")
+    target = filepath if filepath is not None else prefix
+    if prefix is not None and prefix == '':
+        target = '.'
+    if not is_safe_path(target):
+        raise ValueError(f"Refusing to sign unsafe path {target}")
+    ttl = ttl or config.FILESTORE_SIGNED_URL_TTL
+    ttl = min(ttl, config.FILESTORE_SIGNED_URL_MAX_TTL)
+    expires = int(time.time()) + ttl
+    params = {'expires': expires,
+              'sig': _signature(bucket, _scope(filepath, prefix), expires, encoding)}
+    if prefix is not None:
+        params['prefix'] = prefix
+    if encoding:
+        params['enc'] = encoding
+    return params
+
+
+def verify(bucket, filepath, expires, sig, prefix=None, encoding=None):
+    if not enabled() or not sig:
+        return False
+    if expires < time.time():
+        return False
+    if not is_safe_path(filepath):
+        return False
+    if prefix is not None:
+        if prefix and not filepath.startswith(prefix if prefix.endswith('/') else prefix + '/'):
+            return False
+    expected = _signature(bucket, _scope(filepath, prefix), expires, encoding)
+    return hmac.compare_digest(expected, sig)
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from tendril.filestore import base
+from tendril.filestore import signing
+from tendril.filestore.base import FilestoreBucketBase
+
+
+def _row(filename, puid, encoding=None):
+    props = {'size': 10}
+    if encoding:
+        props['encoding'] = encoding
+    return {'filename': filename,
+            'fileinfo': {'props': props},
+            'owner': {'user': SimpleNamespace(puid=puid)}}
+
+
+def test_expose_batch_signs_each_file(monkeypatch):
+    monkeypatch.setattr(signing.config, 'FILESTORE_SIGNING_KEY', 'test-key')
+    rows = [_row('docs/a.pdf', 'owner', encoding='zstd'),
+            _row('docs/.env.pdf', 'owner'),
+            _row('other.pdf', 'someone-else')]
+    monkeypatch.setattr(base, 'get_stored_files_with_owners',
+                        lambda bucket, filenames, session=None: rows)
+
+    bucket = FilestoreBucketBase('osfs:///tmp/test-bucket', 'test')
+    user = SimpleNamespace(id='owner')
+    results = bucket.expose_batch(['docs/a.pdf', 'docs/.env.pdf', 'other.pdf', 'missing.pdf'],
+                                  user, sign=True, ttl=60, session=object())
+
+    signed = results['docs/a.pdf']['signed']
+    assert signed['enc'] == 'zstd'
+    assert signing.verify('test', 'docs/a.pdf', signed['expires'], signed['sig'],
+                          encoding=signed['enc'])
+    assert results['docs/.env.pdf'] == {'error': 'unsignable'}
+    assert results['other.pdf'] == {'error': 'forbidden'}
+    assert results['missing.pdf'] == {'error': 'not_found'}
+
+
+def test_expose_batch_without_signing(monkeypatch):
+    rows = [_row('docs/.env.pdf', 'owner')]
+    monkeypatch.setattr(base, 'get_stored_files_with_owners',
+                        lambda bucket, filenames, session=None: rows)
+
+    bucket = FilestoreBucketBase('osfs:///tmp/test-bucket', 'test')
+    results = bucket.expose_batch(['docs/.env.pdf'], SimpleNamespace(id='owner'),
+                                  session=object())
+
+    assert results['docs/.env.pdf']['uri'] == '/protected/docs/.env.pdf'
+    assert 'signed' not in results['docs/.env.pdf']
@@ -0,0 +1,39 @@
+from tendril.filestore import ring
+from tendril.filestore.ring import HashRing
+
+
+NODES = ['http://node-a:8039', 'http://node-b:8039', 'http://node-c:8039']
+
+
+def test_ring_places_keys_stably():
+    first, second = HashRing(NODES), HashRing(list(reversed(NODES)))
+    for idx in range(200):
+        key = f'bucket/file-{idx}'
+        assert first.node_for(key) == second.node_for(key)
+        assert first.node_for(key) in NODES
+
+
+def test_added_node_only_takes_keys():
+    before = HashRing(NODES)
+    after = HashRing(NODES + ['http://node-d:8039'])
+    keys = [f'bucket/file-{idx}' for idx in range(2000)]
+    misplaced = [key for key in keys if before.node_for(key) != after.node_for(key)]
+    # Every key which moves, moves to the new node, and about a quarter
+    # of them move.
+    assert all(after.node_for(key) == 'http://node-d:8039' for key in misplaced)
+    assert 0.15 < len(misplaced) / len(keys) < 0.35
+
+
+def test_partitioned_buckets_place_files(monkeypatch):
+    monkeypatch.setattr(ring.config, 'FILESTORE_REMOTE_PARTITIONED_BUCKETS', ['spread'])
+    hash_ring = HashRing(NODES)
+
+    assert ring.placement_key('whole', 'a.pdf') == 'whole'
+    assert ring.placement_key('spread', 'a.pdf') == 'spread/a.pdf'
+    assert ring.bucket_nodes('whole', ring=hash_ring) == [hash_ring.node_for('whole')]
+    assert ring.bucket_nodes('spread', ring=hash_ring) == NODES
+
+    placed = {ring.node_for('spread', f'file-{idx}', ring=hash_ring) for idx in range(100)}
+    assert placed == set(NODES)
+    assert {ring.node_for('whole', f'file-{idx}', ring=hash_ring) for idx in range(100)} \
+        == {hash_ring.node_for('whole')}